@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+"""
+Boot-storm benchmark for the MOP daemon.
+
+The harness builds two network namespaces joined by a veth pair, starts
+mopd-gemini.py in one and a crowd of simulated VXT terminals in the
+other. Each virtual terminal boots the way the real hardware does:
+multicast Request Program until a server volunteers, unicast Request
+Program to it, then Request Memory Load acknowledgements until the
+Memory Load with Transfer Address, for the loader and then the X
+server image. Frames can be dropped or delayed on the client side to
+exercise retransmission.
+
+Results (boots/sec, time-to-boot percentiles, daemon CPU per boot and
+peak RSS) can be saved as a baseline and later runs compared against
+it; a regression beyond the tolerance makes the run exit non-zero.
+
+Every run also times the daemon's cold start, from launch to the
+first frame it answers, and takes its resident size at that point.
+Both are held to budgets, so a heavy import creeping back onto the
+startup path fails the run too.
+
+    mopbench.py run -n 50
+    mopbench.py run -n 50 --loss 0.01 --delay 0.002
+    mopbench.py run -n 50 -r 5 --save mopbench-baseline.json
+    mopbench.py run -n 50 -r 5 --baseline mopbench-baseline.json
+    mopbench.py run -n 1 -r 10 --max-startup 0.5 --max-rss 24576
+
+Needs root for the namespaces and packet sockets.
+"""
+
+import argparse
+import heapq
+import json
+import os
+import random
+import select
+import subprocess
+import sys
+import time
+
+from mopcodec import (
+    MOP_DL_MULTICAST, MOP_K_CODE_ASV, MOP_K_CODE_MLD, MOP_K_CODE_MLT, MOP_K_CODE_RML,
+    MOP_K_CODE_RPR, MOP_K_INFO_DLBSZ, MOP_K_PROTO_DL, MOP_K_TRANS_ETHER, MLD_HDR,
+    RML_MSG, XFR_ADDR, mop_decode, mop_frame,
+)
+from mopfile import MopImage, mop_find_image
+from moppf import MopPfReader, mop_pf_open, mop_pf_sendmmsg
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_DAEMON = os.path.join(BENCH_DIR, "mopd-gemini.py")
+BENCH_PROGRAMS = ("VXTLDR021", "VXTEX020A")
+BENCH_SERVER_IF = "mbsrv0"
+BENCH_CLIENT_IF = "mbcli0"
+
+# Virtual terminals use DEC addresses 08-00-2b-ff-xx-xx; the probe uses
+# the one address no terminal gets
+BENCH_MAC_BASE = bytes.fromhex("08002bff0000")
+BENCH_PROBE_MAC = bytes.fromhex("08002bffffff")
+
+# Client-side retry policy
+BENCH_RETRY_TIMEOUT = 1.0
+BENCH_MAX_RETRIES = 10
+BENCH_STARTUP_TIMEOUT = 30.0
+
+# Default budgets for the daemon's cold start: seconds until it answers
+# and resident kB at that point
+BENCH_STARTUP_BUDGET = 1.0
+BENCH_RSS_BUDGET = 32768
+
+# Metrics compared against a baseline, and whether higher is better
+BENCH_METRICS = {
+    "boots_per_sec": True,
+    "p50_seconds": False,
+    "p99_seconds": False,
+    "cpu_per_boot_seconds": False,
+    "peak_rss_kb": False,
+}
+
+def mop_rpr_message(program, data_size=0):
+    """Builds a Request Program for a named image."""
+    name = program.encode("ascii")
+    msg = bytes((MOP_K_CODE_RPR, 0, 1, 0, len(name))) + name + b"\0"
+    if data_size:
+        msg += MOP_K_INFO_DLBSZ.to_bytes(2, "little") + bytes((2,)) + data_size.to_bytes(2, "little")
+    return msg
+
+# --- Virtual Terminals ---
+
+class VirtualTerminal:
+    """One simulated terminal working through its boot programs."""
+    __slots__ = ("mac", "index", "state", "server", "loadnum", "received",
+                 "last", "deadline", "retries", "started", "boot_time")
+
+    def __init__(self, mac):
+        self.mac = mac
+        self.index = 0
+        self.state = "volunteer"      # volunteer, load, done, failed
+        self.server = None
+        self.loadnum = 0
+        self.received = 0
+        self.last = None              # (dst, message) to repeat on timeout
+        self.deadline = None
+        self.retries = 0
+        self.started = None
+        self.boot_time = None
+
+class BootStorm:
+    """
+    Drives many virtual terminals over one packet socket. Lost and
+    delayed frames are simulated here, in both directions.
+    """
+
+    def __init__(self, sock, programs, sizes, data_size=0, loss=0.0,
+                 delay=0.0, jitter=0.0, seed=0):
+        self.sock = sock
+        self.reader = MopPfReader(sock)
+        self.programs = programs
+        self.sizes = sizes            # program -> expected data bytes
+        self.data_size = data_size
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.rng = random.Random(seed)
+        self.terminals = {}
+        self.timers = []              # (deadline, mac)
+        self.delayed = []             # (send time, seq, frame)
+        self.txq = []
+        self.seq = 0
+        self.pending = 0
+        self.retransmits = 0
+        self.errors = []
+
+    def add(self, term, now):
+        self.terminals[term.mac] = term
+        self.pending += 1
+        term.started = now
+        self.request_program(term, now)
+
+    def request_program(self, term, now):
+        term.state = "volunteer"
+        term.server = None
+        term.loadnum = 0
+        term.received = 0
+        self.send(term, MOP_DL_MULTICAST, mop_rpr_message(self.programs[term.index], self.data_size), now)
+
+    def send(self, term, dst, msg, now):
+        term.last = (dst, msg)
+        term.deadline = now + BENCH_RETRY_TIMEOUT
+        heapq.heappush(self.timers, (term.deadline, term.mac))
+        if self.loss and self.rng.random() < self.loss:
+            return
+        frame = mop_frame(dst, term.mac, MOP_K_PROTO_DL, MOP_K_TRANS_ETHER, msg)
+        if self.delay or self.jitter:
+            self.seq += 1
+            when = now + self.delay + self.rng.uniform(0, self.jitter)
+            heapq.heappush(self.delayed, (when, self.seq, frame))
+        else:
+            self.txq.append(frame)
+
+    def finish(self, term, state, now, error=None):
+        term.state = state
+        term.deadline = None
+        self.pending -= 1
+        if state == "done":
+            term.boot_time = now - term.started
+        else:
+            self.errors.append(f"{term.mac.hex()}: {error}")
+
+    def receive(self, now):
+        while True:
+            frame = self.reader.recv()
+            if frame is None:
+                return
+            decoded = mop_decode(frame)
+            if decoded is None:
+                continue
+            dst, src, proto, trans, msg = decoded
+            term = self.terminals.get(dst)
+            if term is None or proto != MOP_K_PROTO_DL:
+                continue
+            if self.loss and self.rng.random() < self.loss:
+                continue
+            self.handle(term, src, msg, now)
+
+    def handle(self, term, src, msg, now):
+        code = msg[0]
+        program = self.programs[term.index]
+        if code == MOP_K_CODE_ASV and term.state == "volunteer":
+            term.state = "load"
+            term.server = bytes(src)
+            term.retries = 0
+            self.send(term, term.server, mop_rpr_message(program, self.data_size), now)
+        elif code in (MOP_K_CODE_MLD, MOP_K_CODE_MLT) and term.state == "load":
+            if len(msg) < MLD_HDR.size or src != term.server:
+                return
+            if msg[1] != term.loadnum:
+                # A repeat of the frame we acknowledged: the ack was lost
+                self.retransmits += 1
+                self.send(term, term.server, term.last[1], now)
+                return
+            term.retries = 0
+            term.loadnum = (term.loadnum + 1) & 0xff
+            ack = RML_MSG.pack(MOP_K_CODE_RML, term.loadnum, 0)
+            if code == MOP_K_CODE_MLD:
+                term.received += len(msg) - MLD_HDR.size
+                self.send(term, term.server, ack, now)
+                return
+            # Memory Load with Transfer Address: this program is loaded
+            self.send(term, term.server, ack, now)
+            term.deadline = None
+            if len(msg) < MLD_HDR.size + XFR_ADDR.size or term.received != self.sizes[program]:
+                self.finish(term, "failed", now,
+                            f"{program}: got {term.received} of {self.sizes[program]} bytes")
+            elif term.index + 1 < len(self.programs):
+                term.index += 1
+                self.request_program(term, now)
+            else:
+                self.finish(term, "done", now)
+
+    def expire(self, now):
+        while self.timers and self.timers[0][0] <= now:
+            deadline, mac = heapq.heappop(self.timers)
+            term = self.terminals[mac]
+            if term.deadline != deadline:
+                continue
+            term.retries += 1
+            if term.retries > BENCH_MAX_RETRIES:
+                self.finish(term, "failed", now,
+                            f"{self.programs[term.index]}: no answer in {term.state}")
+            else:
+                self.retransmits += 1
+                self.send(term, *term.last, now)
+
+    def flush(self, now):
+        while self.delayed and self.delayed[0][0] <= now:
+            self.txq.append(heapq.heappop(self.delayed)[2])
+        while self.txq:
+            # The veth queue may be momentarily full; what is left goes next round
+            sent = mop_pf_sendmmsg(self.sock, self.txq)
+            if not sent:
+                break
+            del self.txq[:sent]
+
+    def wakeup(self, now):
+        deadlines = [d for d in (self.timers[:1] + self.delayed[:1]) if d]
+        if self.txq:
+            return 0
+        return max(0.0, min(d[0] for d in deadlines) - now) if deadlines else 1.0
+
+    def run(self, timeout):
+        end = time.monotonic() + timeout
+        while self.pending and time.monotonic() < end:
+            now = time.monotonic()
+            select.select([self.sock], [], [], self.wakeup(now))
+            now = time.monotonic()
+            self.receive(now)
+            self.expire(now)
+            self.flush(now)
+
+def mop_probe(sock, program, timeout=BENCH_STARTUP_TIMEOUT):
+    """
+    Sends a multicast Request Program every 100 ms until some server
+    volunteers. Returns the monotonic time of the answer, or None.
+    """
+    reader = MopPfReader(sock)
+    frame = mop_frame(MOP_DL_MULTICAST, BENCH_PROBE_MAC, MOP_K_PROTO_DL,
+                      MOP_K_TRANS_ETHER, mop_rpr_message(program))
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        sock.sendmsg(frame)
+        ready, _, _ = select.select([sock], [], [], 0.1)
+        while ready:
+            received = reader.recv()
+            if received is None:
+                break
+            decoded = mop_decode(received)
+            if decoded and decoded[0] == BENCH_PROBE_MAC and decoded[4][0] == MOP_K_CODE_ASV:
+                return time.monotonic()
+    return None
+
+def cmd_client(args):
+    """
+    Body of the client process. Prints a JSON line once the daemon
+    answers, waits for a line on stdin, runs the storm and prints the
+    results as a second JSON line.
+    """
+    sizes = {}
+    for program in args.programs:
+        path = mop_find_image(args.mop_dir, program)
+        if path is None:
+            print(json.dumps({"error": f"no image for {program} in {args.mop_dir}"}), flush=True)
+            return 1
+        sizes[program] = MopImage(path).size
+    sock = mop_pf_open(args.interface)
+    ready_at = mop_probe(sock, args.programs[0])
+    print(json.dumps({"ready_at": ready_at}), flush=True)
+    if ready_at is None:
+        return 1
+    sys.stdin.readline()
+
+    storm = BootStorm(sock, args.programs, sizes, args.data_size, args.loss,
+                      args.delay, args.jitter, args.seed)
+    start = time.monotonic()
+    terminals = []
+    for i in range(args.terminals):
+        now = time.monotonic()
+        term = VirtualTerminal((int.from_bytes(BENCH_MAC_BASE, "big") + i + 1).to_bytes(6, "big"))
+        terminals.append(term)
+        storm.add(term, now)
+        if args.stagger:
+            storm.flush(now)
+            time.sleep(args.stagger)
+    storm.run(args.timeout)
+    wall = time.monotonic() - start
+    print(json.dumps({
+        "wall_seconds": wall,
+        "boot_times": [t.boot_time for t in terminals if t.boot_time is not None],
+        "failed": sum(1 for t in terminals if t.state != "done"),
+        "retransmits": storm.retransmits,
+        "errors": storm.errors[:10],
+    }), flush=True)
+    return 0
+
+# --- Harness ---
+
+def sh(*argv):
+    subprocess.run(argv, check=True)
+
+def netns_setup(srv, cli, mtu):
+    sh("ip", "netns", "add", srv)
+    sh("ip", "netns", "add", cli)
+    sh("ip", "link", "add", BENCH_SERVER_IF, "netns", srv, "mtu", str(mtu),
+       "type", "veth", "peer", "name", BENCH_CLIENT_IF, "netns", cli, "mtu", str(mtu))
+    for ns, ifname in ((srv, BENCH_SERVER_IF), (cli, BENCH_CLIENT_IF)):
+        sh("ip", "-n", ns, "link", "set", "lo", "up")
+        sh("ip", "-n", ns, "link", "set", ifname, "up")
+
+def netns_teardown(*names):
+    for name in names:
+        subprocess.run(("ip", "netns", "del", name), stderr=subprocess.DEVNULL)
+
+def proc_tree(pid):
+    """Returns pid and the pids of its children."""
+    pids = [pid]
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            if int(fields[1]) == pid:
+                pids.append(int(entry))
+    return pids
+
+def proc_cpu(pid):
+    """CPU seconds used by pid and its children so far."""
+    total = 0
+    for p in proc_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+def proc_rss(pid):
+    """Largest current RSS in kB among pid and its children."""
+    rss = 0
+    for p in proc_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        rss = max(rss, int(line.split()[1]))
+        except OSError:
+            continue
+    return rss
+
+def proc_peak_rss(pid):
+    """Largest peak RSS in kB among pid and its children."""
+    peak = 0
+    for p in proc_tree(pid):
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        peak = max(peak, int(line.split()[1]))
+        except OSError:
+            continue
+    return peak
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def run_once(args):
+    """Runs one boot storm and returns its report."""
+    srv, cli = f"mopbench-srv-{os.getpid()}", f"mopbench-cli-{os.getpid()}"
+    daemon = client = None
+    try:
+        netns_setup(srv, cli, args.mtu)
+        daemon_log = open(args.daemon_log, "w") if args.daemon_log else subprocess.DEVNULL
+        spawned = time.monotonic()
+        daemon = subprocess.Popen(
+            ["ip", "netns", "exec", srv, sys.executable, args.daemon, "-f",
+             "-s", args.mop_dir, *args.daemon_args, BENCH_SERVER_IF],
+            stdout=daemon_log, stderr=subprocess.STDOUT)
+        client = subprocess.Popen(
+            ["ip", "netns", "exec", cli, sys.executable, os.path.abspath(__file__), "client",
+             "-i", BENCH_CLIENT_IF, "-n", str(args.terminals), "-s", args.mop_dir,
+             "--data-size", str(args.data_size), "--loss", str(args.loss),
+             "--delay", str(args.delay), "--jitter", str(args.jitter),
+             "--seed", str(args.seed), "--stagger", str(args.stagger),
+             "--timeout", str(args.timeout), *args.programs],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        ready = json.loads(client.stdout.readline() or "{}")
+        if ready.get("ready_at") is None:
+            raise RuntimeError(ready.get("error", "daemon never answered"))
+        startup_rss = proc_rss(daemon.pid)
+        cpu_start = proc_cpu(daemon.pid)
+        client.stdin.write("go\n")
+        client.stdin.flush()
+        result = json.loads(client.stdout.readline() or "{}")
+        cpu = proc_cpu(daemon.pid) - cpu_start
+        rss = proc_peak_rss(daemon.pid)
+        client.wait()
+    finally:
+        for proc in (client, daemon):
+            if proc is not None and proc.poll() is None:
+                proc.terminate()
+                proc.wait()
+        netns_teardown(srv, cli)
+    if "boot_times" not in result:
+        raise RuntimeError("client did not report")
+
+    boots = result["boot_times"]
+    return {
+        "terminals": args.terminals,
+        "programs": list(args.programs),
+        "loss": args.loss,
+        "delay": args.delay,
+        "completed": len(boots),
+        "failed": result["failed"],
+        "retransmits": result["retransmits"],
+        "errors": result["errors"],
+        "startup_seconds": ready["ready_at"] - spawned,
+        "startup_rss_kb": startup_rss,
+        "wall_seconds": result["wall_seconds"],
+        "boots_per_sec": len(boots) / result["wall_seconds"] if boots else 0.0,
+        "p50_seconds": percentile(boots, 50),
+        "p99_seconds": percentile(boots, 99),
+        "cpu_per_boot_seconds": cpu / len(boots) if boots else None,
+        "peak_rss_kb": rss,
+    }
+
+def combine(reports):
+    """Merges the reports of several rounds, taking each metric's median."""
+    report = dict(reports[0])
+    report["rounds"] = len(reports)
+    for key in ("completed", "failed", "retransmits"):
+        report[key] = sum(r[key] for r in reports)
+    report["errors"] = [e for r in reports for e in r["errors"]][:10]
+    for key in ("startup_seconds", "startup_rss_kb", "wall_seconds", *BENCH_METRICS):
+        values = [r[key] for r in reports if r[key] is not None]
+        report[key] = percentile(values, 50)
+    return report
+
+def compare(report, baseline, tolerance):
+    """Prints each metric against the baseline. Returns the regressions."""
+    regressions = []
+    for key, higher_is_better in BENCH_METRICS.items():
+        new, old = report.get(key), baseline.get(key)
+        if new is None or not old:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print(f"  {key:22} {old:12.4f} -> {new:12.4f}  {change:+7.1%}{flag}")
+    return regressions
+
+def check_budgets(report, max_startup, max_rss):
+    """Prints the cold start against its budgets. Returns what was over."""
+    over = []
+    for key, value, budget, unit in (
+            ("startup_seconds", report["startup_seconds"], max_startup, "s"),
+            ("startup_rss_kb", report["startup_rss_kb"], max_rss, " kB")):
+        if not budget:
+            continue
+        flag = ""
+        if value > budget:
+            flag = "  OVER BUDGET"
+            over.append(key)
+        print(f"  {key:22} {value:12g} of {budget:g}{unit}{flag}")
+    return over
+
+def print_report(report):
+    print(f"terminals:      {report['terminals']} booting {' + '.join(report['programs'])}, "
+          f"{report['rounds']} round(s), medians shown")
+    print(f"completed:      {report['completed']} ({report['failed']} failed, "
+          f"{report['retransmits']} client retransmits)")
+    print(f"daemon startup: {report['startup_seconds']:.3f}s, "
+          f"{report['startup_rss_kb']} kB resident")
+    print(f"boots/sec:      {report['boots_per_sec']:.2f}")
+    if report["completed"]:
+        print(f"time to boot:   p50 {report['p50_seconds']:.3f}s, p99 {report['p99_seconds']:.3f}s")
+        print(f"cpu per boot:   {report['cpu_per_boot_seconds'] * 1000:.1f} ms")
+    print(f"peak rss:       {report['peak_rss_kb']} kB")
+    for error in report["errors"]:
+        print(f"  {error}")
+
+def cmd_run(args):
+    if os.geteuid() != 0:
+        print("mopbench: needs root for network namespaces", file=sys.stderr)
+        return 2
+    try:
+        report = combine([run_once(args) for _ in range(args.rounds)])
+    except (RuntimeError, subprocess.CalledProcessError, ValueError) as e:
+        print(f"mopbench: {e}", file=sys.stderr)
+        return 2
+    print_report(report)
+    status = 0 if report["failed"] == 0 else 1
+    print("startup budgets:")
+    if check_budgets(report, args.max_startup, args.max_rss):
+        status = 1
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print(f"against {args.baseline}:")
+        if compare(report, baseline, args.tolerance):
+            status = 1
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=4)
+            f.write("\n")
+    return status
+
+def main():
+    parser = argparse.ArgumentParser(description="Boot-storm benchmark for the MOP daemon")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def storm_options(p):
+        p.add_argument("-n", dest="terminals", type=int, default=20,
+                       help="Number of virtual terminals")
+        p.add_argument("-s", dest="mop_dir", default=os.path.join(BENCH_DIR, "files"),
+                       help="MOP directory holding the images")
+        p.add_argument("--data-size", type=int, default=0,
+                       help="Buffer size the terminals advertise (0: none)")
+        p.add_argument("--loss", type=float, default=0.0,
+                       help="Probability of losing each frame, each way")
+        p.add_argument("--delay", type=float, default=0.0,
+                       help="Seconds added to every frame the terminals send")
+        p.add_argument("--jitter", type=float, default=0.0,
+                       help="Up to this many more seconds of random delay")
+        p.add_argument("--seed", type=int, default=1,
+                       help="Seed for loss and jitter")
+        p.add_argument("--stagger", type=float, default=0.0,
+                       help="Seconds between terminal power-ons")
+        p.add_argument("--timeout", type=float, default=120.0,
+                       help="Give up on terminals not booted after this long")
+
+    p = sub.add_parser("run", help="Run a boot storm against the daemon")
+    storm_options(p)
+    p.add_argument("--daemon", default=BENCH_DAEMON,
+                   help="Daemon script to benchmark")
+    p.add_argument("--daemon-arg", dest="daemon_args", action="append", default=[],
+                   help="Extra daemon argument (repeatable)")
+    p.add_argument("--daemon-log", help="Write the daemon's output here")
+    p.add_argument("--mtu", type=int, default=1500)
+    p.add_argument("-r", dest="rounds", type=int, default=1,
+                   help="Repeat the storm this many times and report medians")
+    p.add_argument("--baseline", help="Compare against this saved report")
+    p.add_argument("--tolerance", type=float, default=0.10,
+                   help="Relative change counted as a regression")
+    p.add_argument("--save", help="Save the report here as a new baseline")
+    p.add_argument("--max-startup", type=float, default=BENCH_STARTUP_BUDGET,
+                   help="Seconds the daemon may take to answer its first frame (0: no budget)")
+    p.add_argument("--max-rss", type=int, default=BENCH_RSS_BUDGET,
+                   help="Resident kB the daemon may have by then (0: no budget)")
+    p.add_argument("programs", nargs="*", default=list(BENCH_PROGRAMS))
+    p.set_defaults(func=cmd_run)
+
+    p = sub.add_parser("client", help="Run the virtual terminals (used by run)")
+    storm_options(p)
+    p.add_argument("-i", dest="interface", required=True)
+    p.add_argument("programs", nargs="+")
+    p.set_defaults(func=cmd_client)
+
+    args = parser.parse_args()
+    if args.terminals <= 0 or not 0 <= args.loss < 1:
+        parser.error("need at least one terminal and a loss below 1")
+    sys.exit(args.func(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+"""
+MOP message encoding and decoding.
+
+This module plays the role of get.c/put.c in the C mopd: it knows the
+wire layout of MOP frames and nothing about sockets or sessions.
+Frames are decoded in place from a memoryview and built as lists of
+buffers so image data can be sent without being copied.
+"""
+
+import struct
+
+# --- Protocol Constants ---
+
+MOP_K_PROTO_DL = 0x6001          # MOP Dump/Load
+MOP_K_PROTO_RC = 0x6002          # MOP Remote Console
+
+MOP_K_TRANS_ETHER = 0            # Ethernet II framing (MOP V3)
+MOP_K_TRANS_8023 = 1             # IEEE 802.3 + SNAP framing (MOP V4)
+
+MOP_DL_MULTICAST = bytes.fromhex("ab0000010000")
+MOP_RC_MULTICAST = bytes.fromhex("ab0000020000")
+
+# Dump/Load message codes
+MOP_K_CODE_MLT = 0               # Memory Load with Transfer Address
+MOP_K_CODE_DCM = 1               # Dump Complete
+MOP_K_CODE_MLD = 2               # Memory Load
+MOP_K_CODE_ASV = 3               # Assistance Volunteer
+MOP_K_CODE_RMD = 4               # Request Memory Dump
+MOP_K_CODE_RPR = 8               # Request Program
+MOP_K_CODE_RML = 10              # Request Memory Load
+MOP_K_CODE_RDS = 12              # Request Dump Service
+MOP_K_CODE_MDD = 14              # Memory Dump Data
+MOP_K_CODE_PLT = 20              # Parameter Load with Transfer Address
+
+# Remote Console message codes
+MOP_K_CODE_RID = 5               # Request ID
+MOP_K_CODE_SID = 7               # System ID
+MOP_K_CODE_RQC = 9               # Request Counters
+MOP_K_CODE_CNT = 11              # Counters
+MOP_K_CODE_RVC = 13              # Reserve Console
+MOP_K_CODE_RLC = 15              # Release Console
+MOP_K_CODE_CCP = 17              # Console Command and Poll
+MOP_K_CODE_CRA = 19              # Console Response and Acknowledge
+
+# Information fields carried in Request Program and System ID
+MOP_K_INFO_VER = 1               # Maintenance version
+MOP_K_INFO_MFCT = 2              # Functions
+MOP_K_INFO_CNU = 3               # Console user
+MOP_K_INFO_RTM = 4               # Reservation timer
+MOP_K_INFO_CSZ = 5               # Console command size
+MOP_K_INFO_RSZ = 6               # Console response size
+MOP_K_INFO_HWA = 7               # Hardware address
+MOP_K_INFO_DEVTYPE = 100         # Communication device
+MOP_K_INFO_SFID = 200            # Software ID
+MOP_K_INFO_PRTY = 300            # System processor
+MOP_K_INFO_DLTY = 400            # Data link type
+MOP_K_INFO_DLBSZ = 401           # Data link buffer size
+
+ETH_ALEN = 6
+ETH_HLEN = 14
+ETH_ZLEN = 60                    # Minimum frame length without FCS
+
+# Largest image chunk sent when the client does not say otherwise
+MOP_DEFAULT_DATA_SIZE = 1000
+# Smallest chunk a client may ask for; below it the default is used, as
+# a tiny one makes for a huge load plan
+MOP_MIN_DATA_SIZE = 128
+
+_ETH_HDR = struct.Struct("!6s6sH")
+_MOP_LEN = struct.Struct("<H")
+_U16_BE = struct.Struct("!H")
+_U16_LE = struct.Struct("<H")
+_LLC_SNAP = bytes.fromhex("aaaa0308002b")
+
+MLD_HDR = struct.Struct("<BBI")  # code, load number, load address
+RML_MSG = struct.Struct("<BBB")  # code, load number, error
+XFR_ADDR = struct.Struct("<I")
+RMD_MSG = struct.Struct("<BIH")  # code, memory address, count
+MDD_HDR = struct.Struct("<BI")   # code, memory address
+CNT_MSG = struct.Struct("<BHH9I8H")  # code, receipt, Ethernet data link counters
+_U32_LE = struct.Struct("<I")
+
+# The counters in a Counters message, in order
+MOP_COUNTER_NAMES = (
+    "seconds_since_zeroed", "bytes_received", "bytes_sent", "frames_received",
+    "frames_sent", "multicast_bytes_received", "multicast_frames_received",
+    "frames_sent_deferred", "frames_sent_one_collision", "frames_sent_collisions",
+    "send_failures", "send_failure_reasons", "receive_failures",
+    "receive_failure_reasons", "unrecognized_destination", "data_overruns",
+    "system_buffer_unavailable", "user_buffer_unavailable",
+)
+
+# --- Address Helpers ---
+
+def mop_eaddr_str(eaddr):
+    """Formats a 6-byte Ethernet address as aa:bb:cc:dd:ee:ff."""
+    return ":".join(f"{b:02x}" for b in eaddr)
+
+def mop_eaddr_bytes(text):
+    """Parses aa:bb:cc:dd:ee:ff (or aa-bb-..., or bare hex) into bytes."""
+    return bytes.fromhex(text.replace(":", "").replace("-", ""))
+
+def mop_is_multicast(eaddr):
+    """True if the Ethernet address has the group bit set."""
+    return bool(eaddr[0] & 1)
+
+# --- Decoding ---
+
+def mop_decode(frame):
+    """
+    Decodes the Ethernet and MOP framing of a received frame.
+    Returns (dst, src, proto, trans, msg) where msg is a memoryview of
+    the MOP message, or None if the frame is not MOP.
+    """
+    if len(frame) < ETH_HLEN + 2:
+        return None
+    dst, src, etype = _ETH_HDR.unpack_from(frame, 0)
+    if etype == MOP_K_PROTO_DL or etype == MOP_K_PROTO_RC:
+        msglen = _MOP_LEN.unpack_from(frame, ETH_HLEN)[0]
+        start = ETH_HLEN + 2
+        trans = MOP_K_TRANS_ETHER
+        proto = etype
+    elif etype <= 1500 and len(frame) >= ETH_HLEN + 8 and \
+            frame[ETH_HLEN:ETH_HLEN + 6] == _LLC_SNAP:
+        proto = _U16_BE.unpack_from(frame, ETH_HLEN + 6)[0]
+        if proto != MOP_K_PROTO_DL and proto != MOP_K_PROTO_RC:
+            return None
+        msglen = etype - 8
+        start = ETH_HLEN + 8
+        trans = MOP_K_TRANS_8023
+    else:
+        return None
+    if msglen < 1 or start + msglen > len(frame):
+        return None
+    return dst, src, proto, trans, frame[start:start + msglen]
+
+def mop_parse_rpr(msg):
+    """
+    Decodes a Request Program message.
+    Returns (devtype, version, progtype, software_id, data_size); the
+    software ID is a str, or "" when the client asks for its default
+    image. data_size is 0 when the client did not advertise one.
+    """
+    if len(msg) < 5:
+        return None
+    devtype, version, progtype, idlen = msg[1], msg[2], msg[3], msg[4]
+    index = 5
+    software_id = ""
+    # Lengths 0xff and 0xfe mean "standard OS" / "maintenance system"
+    if 0 < idlen < 0xfe:
+        software_id = bytes(msg[index:index + idlen]).decode("ascii", "replace")
+        index += idlen
+    data_size = 0
+    index += 1                    # Processor
+    while index + 3 <= len(msg):
+        itype = _U16_LE.unpack_from(msg, index)[0]
+        ilen = msg[index + 2]
+        index += 3
+        if itype == MOP_K_INFO_DLBSZ and ilen == 2 and index + 2 <= len(msg):
+            data_size = _U16_LE.unpack_from(msg, index)[0]
+        index += ilen
+    return devtype, version, progtype, software_id, data_size
+
+def mop_parse_rds(msg):
+    """
+    Decodes a Request Dump Service message.
+    Returns (devtype, version, memory_size, data_size); data_size is 0
+    when the client did not advertise one.
+    """
+    if len(msg) < 8:
+        return None
+    memory_size = _U32_LE.unpack_from(msg, 3)[0]
+    dlbsz = mop_parse_info(msg, 8).get(MOP_K_INFO_DLBSZ)
+    data_size = _U16_LE.unpack(dlbsz)[0] if dlbsz is not None and len(dlbsz) == 2 else 0
+    return msg[1], msg[2], memory_size, data_size
+
+def mop_parse_info(msg, index):
+    """
+    Decodes the information fields from index to the end of a message
+    into a dict of field type to value bytes. A field running past the
+    end of the message ends the list.
+    """
+    info = {}
+    while index + 3 <= len(msg):
+        itype = _U16_LE.unpack_from(msg, index)[0]
+        ilen = msg[index + 2]
+        index += 3
+        if index + ilen > len(msg):
+            break
+        info[itype] = bytes(msg[index:index + ilen])
+        index += ilen
+    return info
+
+def mop_parse_sid(msg):
+    """
+    Decodes a System ID message.
+    Returns (receipt, info): the receipt number of the Request ID it
+    answers (0 when sent unprompted) and its information fields.
+    """
+    if len(msg) < 4:
+        return None
+    return _U16_LE.unpack_from(msg, 2)[0], mop_parse_info(msg, 4)
+
+def mop_parse_counters(msg):
+    """
+    Decodes a Counters message.
+    Returns (receipt, counters): the receipt number of the Request
+    Counters it answers and a dict of counter name to value.
+    """
+    if len(msg) < CNT_MSG.size:
+        return None
+    values = CNT_MSG.unpack_from(msg)
+    return values[1], dict(zip(MOP_COUNTER_NAMES, values[2:]))
+
+# --- Encoding ---
+
+def mop_frame(dst, src, proto, trans, *parts):
+    """
+    Builds a MOP frame around the message parts.
+    Returns a list of buffers suitable for socket.sendmsg(); the parts
+    (typically memoryview slices of an image) are not copied.
+    """
+    msglen = sum(len(p) for p in parts)
+    if trans == MOP_K_TRANS_8023:
+        hdr = _ETH_HDR.pack(dst, src, msglen + 8) + _LLC_SNAP + _U16_BE.pack(proto)
+    else:
+        hdr = _ETH_HDR.pack(dst, src, proto) + _MOP_LEN.pack(msglen)
+    iov = [hdr]
+    iov.extend(parts)
+    pad = ETH_ZLEN - len(hdr) - msglen
+    if pad > 0:
+        iov.append(bytes(pad))
+    return iov
+
+def mop_frame_len(iov):
+    """Returns the on-wire length of a frame built by mop_frame()."""
+    return sum(len(p) for p in iov)
@@ -0,0 +1,419 @@
+"""
+Remote Console for the MOP daemon.
+
+A MOP device with a console carrier (a VAX, a terminal server) lets one
+requester at a time reserve its console, and is then driven with
+Console Command and Poll messages: each carries whatever was typed and
+is answered by a Console Response and Acknowledge holding whatever the
+console printed since. The device only speaks when polled, so the
+requester keeps polling, quickly while the console is busy and backing
+off to a slow keep-alive while it is idle.
+
+MopConsoles runs that exchange for every reserved console inside the
+packet loop, with one timer wheel for all of them, so an idle console
+costs one small frame every couple of seconds and nothing in between.
+Each reservation belongs to a TCP session served by mopd.py's MOPDaemon
+on its own asyncio thread. Sessions post requests to a queue and wake
+the packet loop through a pipe it polls; what comes back is handed over
+in one batch per loop iteration with call_soon_threadsafe(). Both
+directions are bounded: a client typing faster than the device takes
+input is made to wait, and a client not reading its output stops the
+polling of its console until it catches up.
+"""
+
+import asyncio
+import os
+import queue
+import time
+
+from mopcodec import (
+    MOP_K_CODE_CCP, MOP_K_CODE_CRA, MOP_K_CODE_RID, MOP_K_CODE_RLC, MOP_K_CODE_RVC,
+    MOP_K_CODE_SID, MOP_K_INFO_CNU, MOP_K_INFO_CSZ, MOP_K_INFO_RTM, MOP_K_PROTO_RC,
+    MOP_K_TRANS_ETHER, mop_eaddr_bytes, mop_eaddr_str, mop_frame, mop_parse_sid,
+)
+from mopsession import TimerWheel
+
+# Resend a message the device has not answered, up to this many times
+MOP_RC_RETRANSMIT = 0.5
+MOP_RC_MAX_RETRIES = 6
+# Poll interval right after console activity, doubling to the maximum
+# while the console stays quiet
+MOP_RC_POLL_MIN = 0.05
+MOP_RC_POLL_MAX = 2.0
+# Command bytes per poll when the device does not say
+MOP_RC_COMMAND_SIZE = 128
+# Typed bytes the device has not taken yet, per console
+MOP_RC_INPUT_LIMIT = 4096
+# Output waiting for a slow TCP client before polling stops
+MOP_RC_OUTPUT_LIMIT = 65536
+
+MOP_RC_NO_VERIFICATION = bytes(8)
+
+def mop_console_target(line):
+    """
+    Parses the console a TCP client asks for: a device address, then
+    optionally an interface name and a 16-digit hex verification code.
+    Returns (address, interface or None, verification).
+    """
+    words = line.decode("ascii", "replace").split()
+    if not words:
+        raise ValueError("No device address given")
+    try:
+        client = mop_eaddr_bytes(words[0])
+    except ValueError:
+        client = b""
+    if len(client) != 6:
+        raise ValueError(f"Bad device address {words[0]!r}")
+    ifname = None
+    verification = MOP_RC_NO_VERIFICATION
+    for word in words[1:]:
+        if len(word) == 16:
+            try:
+                verification = bytes.fromhex(word)
+                continue
+            except ValueError:
+                pass
+        ifname = word
+    return client, ifname, verification
+
+class RemoteConsole:
+    """State of one reserved (or being reserved) device console."""
+    __slots__ = ("client", "session", "verification", "ifaces", "iface", "trans",
+                 "state", "receipt", "msgnum", "command", "pending", "retries",
+                 "poll", "poll_max", "command_size", "paused", "timer_tick")
+
+    def __init__(self, client, session, verification, ifaces, trans):
+        self.client = client
+        self.session = session
+        self.verification = verification
+        self.ifaces = ifaces          # where to look for the device
+        self.iface = None             # where it answered
+        self.trans = trans
+        self.state = "reserving"      # reserving, reserved
+        self.receipt = 0
+        self.msgnum = 0
+        self.command = None           # command data awaiting acknowledgement
+        self.pending = bytearray()    # typed, not yet sent
+        self.retries = 0
+        self.poll = MOP_RC_POLL_MIN
+        self.poll_max = MOP_RC_POLL_MAX
+        self.command_size = MOP_RC_COMMAND_SIZE
+        self.paused = False
+        self.timer_tick = None
+
+class MopConsoles:
+    """
+    Every Remote Console reservation, driven from the packet loop.
+    Only post() may be called from other threads.
+    """
+
+    def __init__(self, interfaces, trans=MOP_K_TRANS_ETHER, log=None):
+        self.interfaces = interfaces  # name -> InterfaceInfo, kept current by the daemon
+        self.trans = trans
+        self.log = log
+        self.consoles = {}            # device address -> RemoteConsole
+        self.wheel = TimerWheel(tick=MOP_RC_POLL_MIN)
+        self.requests = queue.SimpleQueue()
+        self.rfd, self.wfd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.replies = []             # (session, method, args) for the asyncio side
+        self.receipt = 0
+
+    def __len__(self):
+        return len(self.consoles)
+
+    def fileno(self):
+        return self.rfd
+
+    def post(self, *request):
+        """Queues a request from a TCP session and wakes the packet loop."""
+        self.requests.put(request)
+        try:
+            os.write(self.wfd, b"\0")
+        except BlockingIOError:
+            pass                      # Already due to wake up
+
+    # --- Requests from TCP sessions ---
+
+    def process_requests(self):
+        try:
+            while os.read(self.rfd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while True:
+            try:
+                op, session, *params = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            if op == "open":
+                self.open(session, *params)
+                continue
+            console = self.consoles.get(session.client)
+            if console is None or console.session is not session:
+                continue
+            if op == "input":
+                console.pending += params[0]
+                self.kick(console)
+            elif op == "pause":
+                console.paused = True
+                if console.command is None:
+                    self.wheel.cancel(console)
+            elif op == "resume":
+                console.paused = False
+                self.kick(console)
+            elif op == "close":
+                self.close(console, None)
+        self.flush()
+
+    def open(self, session, ifname, verification):
+        client = session.client
+        if client in self.consoles:
+            self.reply(session, "on_reserved", False,
+                       f"{mop_eaddr_str(client)} is in use by another session")
+            return
+        if ifname is not None:
+            iface = self.interfaces.get(ifname)
+            if iface is None:
+                self.reply(session, "on_reserved", False, f"No interface {ifname}")
+                return
+            ifaces = [iface]
+        else:
+            ifaces = list(self.interfaces.values())
+        console = RemoteConsole(client, session, verification, ifaces, self.trans)
+        self.consoles[client] = console
+        self.reserve(console)
+
+    def reserve(self, console):
+        """Sends Reserve Console and asks for the System ID that confirms it."""
+        self.receipt = self.receipt % 0xffff + 1
+        console.receipt = self.receipt
+        rvc = bytes((MOP_K_CODE_RVC,)) + console.verification
+        rid = bytes((MOP_K_CODE_RID, 0)) + console.receipt.to_bytes(2, "little")
+        for iface in console.ifaces:
+            iface.send(mop_frame(console.client, iface.hwaddr, MOP_K_PROTO_RC, console.trans, rvc))
+            iface.send(mop_frame(console.client, iface.hwaddr, MOP_K_PROTO_RC, console.trans, rid))
+        self.wheel.schedule(console, time.monotonic() + MOP_RC_RETRANSMIT)
+
+    def kick(self, console):
+        """Polls now if the console is free to take a command."""
+        if console.state == "reserved" and console.command is None and not console.paused:
+            self.poll(console)
+
+    def poll(self, console):
+        """Sends the next Console Command and Poll with what has been typed."""
+        console.command = bytes(console.pending[:console.command_size])
+        del console.pending[:len(console.command)]
+        console.retries = 0
+        self.send_command(console)
+
+    def send_command(self, console):
+        iface = console.iface
+        iface.send(mop_frame(console.client, iface.hwaddr, MOP_K_PROTO_RC, console.trans,
+                             bytes((MOP_K_CODE_CCP, console.msgnum)), console.command))
+        self.wheel.schedule(console, time.monotonic() + MOP_RC_RETRANSMIT)
+
+    def close(self, console, reason):
+        """Releases a console and tells its session why, if it is not the one leaving."""
+        if console.state == "reserved":
+            iface = console.iface
+            iface.send(mop_frame(console.client, iface.hwaddr, MOP_K_PROTO_RC, console.trans,
+                                 bytes((MOP_K_CODE_RLC,))))
+        self.wheel.cancel(console)
+        del self.consoles[console.client]
+        if reason is not None:
+            self.reply(console.session, "on_closed", reason)
+        if self.log is not None:
+            self.log.info("%s: console closed: %s", mop_eaddr_str(console.client),
+                          reason or "released by client", extra={"source": console.client})
+
+    # --- Packet loop ---
+
+    def receive(self, iface, src, trans, msg):
+        """Handles a Remote Console message addressed to this host."""
+        console = self.consoles.get(src)
+        if console is None:
+            return
+        code = msg[0]
+        if code == MOP_K_CODE_SID and console.state == "reserving":
+            sid = mop_parse_sid(msg)
+            if sid is None or sid[0] != console.receipt or iface not in console.ifaces:
+                return
+            info = sid[1]
+            if info.get(MOP_K_INFO_CNU) != iface.hwaddr:
+                return                # Not (yet) ours; the retries decide
+            console.state = "reserved"
+            console.iface = iface
+            console.trans = trans
+            console.ifaces = None
+            rtm = info.get(MOP_K_INFO_RTM)
+            if rtm is not None and len(rtm) == 2:
+                # Poll well inside the reservation timer, or lose the console
+                console.poll_max = max(MOP_RC_POLL_MIN,
+                                       min(MOP_RC_POLL_MAX, int.from_bytes(rtm, "little") / 3))
+            csz = info.get(MOP_K_INFO_CSZ)
+            if csz is not None and len(csz) == 2 and int.from_bytes(csz, "little"):
+                console.command_size = int.from_bytes(csz, "little")
+            self.reply(console.session, "on_reserved", True, iface.name)
+            if self.log is not None:
+                self.log.info("%s (%s): console reserved", mop_eaddr_str(src), iface.name,
+                              extra={"source": src})
+            self.poll(console)
+        elif code == MOP_K_CODE_CRA and console.command is not None:
+            if len(msg) < 2 or (msg[1] & 1) != console.msgnum or iface is not console.iface:
+                return                # A repeat of an answer already taken
+            data = bytes(msg[2:])
+            taken = len(console.command)
+            console.command = None
+            console.msgnum ^= 1
+            if data or taken:
+                console.poll = MOP_RC_POLL_MIN
+                self.reply(console.session, "on_output", data, taken)
+            else:
+                console.poll = min(console.poll * 2, console.poll_max)
+            if console.paused:
+                self.wheel.cancel(console)
+            elif console.pending:
+                self.poll(console)
+            else:
+                self.wheel.schedule(console, time.monotonic() + console.poll)
+
+    def expire(self):
+        """Runs due retransmits and polls, then hands replies to the sessions."""
+        for console in self.wheel.advance(time.monotonic()):
+            if console.state == "reserved" and console.command is None:
+                self.poll(console)
+                continue
+            console.retries += 1
+            if console.retries > MOP_RC_MAX_RETRIES:
+                if console.state == "reserving":
+                    self.close(console, "No reservation: no answer, console in use "
+                                        "or wrong verification")
+                else:
+                    console.state = "lost"
+                    self.close(console, "Console stopped answering")
+            elif console.state == "reserving":
+                self.reserve(console)
+            else:
+                self.send_command(console)
+        self.flush()
+
+    def timeout(self):
+        return self.wheel.timeout()
+
+    def reply(self, session, method, *args):
+        self.replies.append((session, method, args))
+
+    def flush(self):
+        if self.replies:
+            batch, self.replies = self.replies, []
+            batch[0][0].loop.call_soon_threadsafe(_deliver, batch)
+
+def _deliver(batch):
+    for session, method, args in batch:
+        getattr(session, method)(*args)
+
+# --- TCP Sessions ---
+
+class ConsoleSession:
+    """The asyncio side of one console reservation, owned by a TCP client."""
+
+    def __init__(self, consoles, client, writer):
+        self.consoles = consoles
+        self.client = client
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.reserved = self.loop.create_future()
+        self.done = asyncio.Event()
+        self.reason = None
+        self.space = asyncio.Event()
+        self.space.set()
+        self.inflight = 0             # typed bytes the device has not taken
+        self.paused = False
+
+    def on_reserved(self, ok, message):
+        if not self.reserved.done():
+            self.reserved.set_result((ok, message))
+
+    def on_output(self, data, taken):
+        self.inflight -= taken
+        if self.inflight < MOP_RC_INPUT_LIMIT:
+            self.space.set()
+        if not data or self.writer.is_closing():
+            return
+        self.writer.write(data)
+        if not self.paused and \
+                self.writer.transport.get_write_buffer_size() > MOP_RC_OUTPUT_LIMIT:
+            self.paused = True
+            self.consoles.post("pause", self)
+            self.loop.create_task(self.resume())
+
+    async def resume(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            return
+        self.paused = False
+        self.consoles.post("resume", self)
+
+    def on_closed(self, reason):
+        self.on_reserved(False, reason)
+        self.reason = reason
+        self.done.set()
+
+    async def write(self, data):
+        """Hands typed bytes to the console, waiting while too many are queued."""
+        await self.space.wait()
+        self.inflight += len(data)
+        if self.inflight >= MOP_RC_INPUT_LIMIT:
+            self.space.clear()
+        self.consoles.post("input", self, data)
+
+async def mop_console_client(consoles, reader, writer, inventory=None):
+    """
+    Serves one TCP client: asks which console it wants, reserves it and
+    relays bytes both ways until either side goes away. The console is
+    released when the client disconnects. With an inventory, the client
+    may ask to SHOW the devices known instead.
+    """
+    prompt = "Console (address [interface] [verification])"
+    if inventory is not None:
+        prompt += " or SHOW [address ...]"
+    writer.write(f"{prompt}: ".encode())
+    await writer.drain()
+    line = await reader.readline()
+    words = line.decode("ascii", "replace").split()
+    if inventory is not None and words and words[0].upper() == "SHOW":
+        writer.write(inventory.report(words[1:]).encode())
+        return
+    try:
+        client, ifname, verification = mop_console_target(line)
+    except ValueError as e:
+        writer.write(f"{e}\n".encode())
+        return
+    session = ConsoleSession(consoles, client, writer)
+    consoles.post("open", session, ifname, verification)
+    ok, message = await session.reserved
+    if not ok:
+        writer.write(f"{message}\n".encode())
+        return
+    writer.write(f"Console of {mop_eaddr_str(client)} reserved on {message}; "
+                 "disconnect to release it\n".encode())
+
+    async def relay():
+        while True:
+            data = await reader.read(MOP_RC_INPUT_LIMIT)
+            if not data:
+                return
+            await session.write(data)
+
+    typing = asyncio.ensure_future(relay())
+    closed = asyncio.ensure_future(session.done.wait())
+    try:
+        await asyncio.wait((typing, closed), return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        typing.cancel()
+        closed.cancel()
+        if session.reason is None:
+            consoles.post("close", session)
+        else:
+            writer.write(f"\n{session.reason}\n".encode())
@@ -2,11 +2,47 @@
 
 import os
 import sys
+import atexit
+import time
+import select
+import signal
+import socket
 import argparse
+import threading
 import logging
+import importlib.util
+from collections import deque
 from logging.handlers import SysLogHandler
-from scapy.all import sniff, Ether, MOP
-from scapy.all import __version__ as scapy_version
+
+from mopcodec import (
+    MOP_K_PROTO_DL, MOP_K_PROTO_RC, MOP_K_TRANS_ETHER, MOP_K_TRANS_8023,
+    MOP_K_CODE_ASV, MOP_K_CODE_CNT, MOP_K_CODE_DCM, MOP_K_CODE_MDD, MOP_K_CODE_RDS, MOP_K_CODE_RMD,
+    MOP_K_CODE_RML, MOP_K_CODE_RPR, MOP_K_CODE_SID, MOP_DEFAULT_DATA_SIZE, MOP_MIN_DATA_SIZE,
+    MDD_HDR, MLD_HDR, RMD_MSG,
+    mop_decode, mop_eaddr_bytes, mop_eaddr_str, mop_frame, mop_is_multicast,
+    mop_parse_rds, mop_parse_rpr,
+)
+from mopdump import (
+    MOP_DUMP_IDLE_TIMEOUT, MOP_DUMP_MAX_SESSIONS, MOP_DUMP_PATH, MOP_DUMP_QUOTA,
+    DumpSession, MopDumpFile, mop_dump_describe, mop_dump_fits, mop_dump_path,
+    mop_dump_resume,
+)
+from mopfile import MopDirectory
+from mopinventory import MOP_INVENTORY_PATH, MOP_INVENTORY_POLL_INTERVAL, MopInventory
+from moploader import mop_load_plan
+from mopreload import (
+    MopReload, mop_handoff_accept, mop_handoff_open, mop_listen_fds, mop_sd_notify,
+)
+from mopsession import DLSession, RequestWindow, SessionTable
+from moppf import MopFanout, MopPfReader, mop_pf_open, mop_pf_sendmmsg
+from moplog import mop_log_start, mop_log_stop
+from mopconsole import MopConsoles
+from moppcap import MOP_PCAP_MAX_FILES, MopPcapWriter, mop_pcap_read
+from mopsched import MOP_SCHED_BURST, MopScheduler, mop_parse_rate
+from mopmetrics import (
+    MOP_DURATION_BUCKETS, Counter, Gauge, Histogram, mop_metrics_document, mop_metrics_log,
+    mop_metrics_serve,
+)
 
 # --- Global Configuration ---
 VERSION = "1.0"
@@ -14,59 +50,1146 @@ MOP_FILE_PATH = "/usr/local/mop"  # Default MOP directory path
 # This can be configured in your system's syslog configuration
 LOG_FACILITY = SysLogHandler.LOG_DAEMON
 
-# --- Placeholder Functions from C Code ---
-# In a real implementation, you would replace these with actual logic.
-# The C code's functions like deviceInitAll(), mopProcessDL(), etc.,
-# would be complex, and these are simplified stubs for demonstration.
+log = logging.getLogger("mopd")
+
+# --- Metrics ---
+
+MOP_PROTO_NAMES = {MOP_K_PROTO_DL: "dl", MOP_K_PROTO_RC: "rc"}
+
+metric_rx = Counter("mopd_rx_frames_total", "MOP frames received", ("interface", "proto"))
+metric_tx = Counter("mopd_tx_frames_total", "MOP frames transmitted", ("interface",))
+metric_tx_dropped = Counter("mopd_tx_dropped_frames_total",
+                            "Frames the kernel would not queue for transmit", ("interface",))
+metric_dropped = Counter("mopd_dropped_frames_total",
+                         "Frames received but not processed", ("proto", "reason"))
+metric_handle = Histogram("mopd_handle_seconds", "Time spent handling one MOP message", ("proto",))
+metric_first_load = Histogram("mopd_first_load_seconds",
+                              "Time from a client's first Request Program to its first Memory Load",
+                              buckets=MOP_DURATION_BUCKETS)
+metric_load = Histogram("mopd_load_seconds", "Duration of completed image loads",
+                        buckets=MOP_DURATION_BUCKETS)
+metric_loads = Counter("mopd_loads_total", "Image loads by outcome", ("result",))
+metric_dumps = Counter("mopd_dumps_total", "Upline dumps by outcome", ("result",))
+metric_dump_bytes = Counter("mopd_dump_bytes_total", "Memory received in upline dumps")
+metric_retransmits = Counter("mopd_retransmits_total", "Memory Load frames sent again", ("reason",))
+metric_sessions = Gauge("mopd_sessions", "Image loads in progress", lambda: len(dl_sessions))
+metric_tx_queued = Gauge("mopd_tx_queued_frames", "Frames held back by transmit pacing",
+                         lambda: sum(len(i.sched) for i in interfaces.values() if i.sched))
+metric_consoles = Gauge("mopd_consoles", "Remote Consoles reserved or being reserved",
+                        lambda: len(consoles) if consoles is not None else 0)
+metric_inventory = Gauge("mopd_inventory_devices", "Devices in the inventory",
+                         lambda: len(inventory) if inventory is not None else 0)
+metric_pcap_dropped = Gauge("mopd_pcap_dropped_frames", "Frames the pcap writer could not keep up with",
+                            lambda: pcap.dropped if pcap is not None else 0)
+
+# Children used for every packet, looked up once
+handle_dl = metric_handle.labels("dl")
+handle_rc = metric_handle.labels("rc")
+
+# --- Interfaces ---
 
 class InterfaceInfo:
-    """A conceptual class to hold interface information."""
-    def __init__(self, name, eaddr):
+    """Holds an interface's address, index, MTU and capture socket."""
+    def __init__(self, name, eaddr, ifindex=0, mtu=1500):
         self.name = name
         self.eaddr = eaddr
+        self.hwaddr = mop_eaddr_bytes(eaddr)
+        self.ifindex = ifindex
+        self.mtu = mtu
+        self.sock = None
+        self.reader = None
+        self.txq = []
+        self.sched = None         # MopScheduler when transmit is paced
+        # Assistance Volunteer from this interface for each framing, less
+        # the destination address, so answering one costs no encoding
+        self.asv = {trans: b"".join(mop_frame(bytes(6), self.hwaddr, MOP_K_PROTO_DL, trans,
+                                              bytes((MOP_K_CODE_ASV,))))[6:]
+                    for trans in (MOP_K_TRANS_ETHER, MOP_K_TRANS_8023)}
+        self.rx = {proto: metric_rx.labels(name, label) for proto, label in MOP_PROTO_NAMES.items()}
+        self.tx = metric_tx.labels(name)
+
+    def open(self):
+        """Opens the filtered capture socket, also used for transmit."""
+        self.sock = mop_handed(f"mop:{self.name}") or mop_pf_open(self.name, fanout)
+        self.reader = MopPfReader(self.sock)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            self.reader = None
+
+    def max_data_size(self, trans):
+        """Largest Memory Load data field that fits in one frame."""
+        overhead = 8 if trans == MOP_K_TRANS_8023 else 2
+        return self.mtu - overhead - MLD_HDR.size
+
+    def send(self, iov):
+        """Queues a frame, given as a list of buffers, for flush()."""
+        if self.sched is None:
+            self.txq.append(iov)
+        elif not self.sched.enqueue(iov):
+            metric_tx_dropped.labels(self.name).inc()
+
+    def flush(self):
+        """
+        Transmits every queued frame with one batched system call; when
+        paced, only the frames the scheduler lets go now.
+        """
+        if self.sched is not None:
+            self.txq = self.sched.dequeue()
+        if not self.txq:
+            return
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+            self.sock.bind((self.name, 0))
+        frames, self.txq = self.txq, []
+        if pcap is not None:
+            for iov in frames:
+                pcap.write(b"".join(iov))
+        try:
+            sent = mop_pf_sendmmsg(self.sock, frames)
+        except OSError as e:
+            sent = 0
+            log.warning("Send on %s failed: %s", self.name, e, extra={"source": self.name})
+        self.tx.inc(sent)
+        if sent < len(frames):
+            metric_tx_dropped.labels(self.name).inc(len(frames) - sent)
 
 def mop_cmp_eaddr(addr1, addr2):
     """Compares two Ethernet addresses."""
     return addr1 != addr2
 
-def mop_process_dl(iface, pkt):
-    """Placeholder for MOP Dump/Load processing."""
-    print(f"Processing MOP Dump/Load packet on {iface.name}")
+# --- Device Handling ---
+
+SYS_CLASS_NET = "/sys/class/net"
+ARPHRD_ETHER = 1
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 1
+
+# Open interfaces, keyed by name
+interfaces = {}
+
+# PACKET_FANOUT groups shared by the worker processes, with --workers
+fanout = None
+
+# Ring of pcap files traffic is recorded to, with -w
+pcap = None
+
+# Remote Console reservations, with --console-port
+consoles = None
+
+# Devices heard from, with --inventory
+inventory = None
+
+# Servers for --metrics-port and --console-port, handed over on reload
+metrics_server = None
+console_server = None
+
+def mop_sysfs_read(name, attr):
+    with open(os.path.join(SYS_CLASS_NET, name, attr)) as f:
+        return f.read().strip()
+
+def mop_device_discover(name):
+    """
+    Builds the InterfaceInfo for an Ethernet interface from sysfs.
+    Returns None for missing or non-Ethernet interfaces.
+    """
+    try:
+        if int(mop_sysfs_read(name, "type")) != ARPHRD_ETHER:
+            return None
+        return InterfaceInfo(name, mop_sysfs_read(name, "address"),
+                             int(mop_sysfs_read(name, "ifindex")),
+                             int(mop_sysfs_read(name, "mtu")))
+    except (OSError, ValueError):
+        return None
+
+def mop_device_names():
+    """Returns the interfaces the daemon should be listening on."""
+    if not args.all:
+        return args.interfaces
+    return sorted(e.name for e in os.scandir(SYS_CLASS_NET) if e.name != "lo")
+
+def mop_device_add(loop, iface):
+    try:
+        iface.open()
+    except OSError as e:
+        log.error("Cannot open %s: %s", iface.name, e)
+        return
+    if args.tx_rate:
+        iface.sched = MopScheduler(args.tx_rate, args.tx_burst)
+    interfaces[iface.name] = iface
+    loop.add_reader(iface.sock.fileno(), lambda: mop_device_read(loop, iface))
+    log.info("Listening on %s (%s, mtu %d)", iface.name, iface.eaddr, iface.mtu)
+
+def mop_device_remove(loop, iface):
+    loop.remove_reader(iface.sock.fileno())
+    iface.close()
+    del interfaces[iface.name]
+    log.info("Stopped listening on %s", iface.name)
+
+def mop_device_rescan(loop):
+    """
+    Brings the open interfaces in line with the system: new interfaces
+    are opened, vanished ones closed, and a changed address, index or
+    MTU reopens the interface.
+    """
+    wanted = {}
+    for name in mop_device_names():
+        iface = mop_device_discover(name)
+        if iface is not None:
+            wanted[name] = iface
+    for name, iface in list(interfaces.items()):
+        new = wanted.get(name)
+        if new is None or (new.hwaddr, new.ifindex, new.mtu) != \
+                (iface.hwaddr, iface.ifindex, iface.mtu):
+            mop_device_remove(loop, iface)
+    for name, iface in wanted.items():
+        if name not in interfaces:
+            mop_device_add(loop, iface)
+
+def mop_device_read(loop, iface):
+    """Drains an interface socket, passing each frame to the engine."""
+    try:
+        frame = iface.reader.recv()
+        while frame is not None:
+            if pcap is not None:
+                pcap.write(frame)
+            mop_process_packet(iface, frame)
+            frame = iface.reader.recv()
+    except OSError:
+        # The interface went away under us (ENETDOWN/ENXIO)
+        mop_device_rescan(loop)
+
+def mop_netlink_open():
+    """Opens an rtnetlink socket reporting link changes, or None."""
+    try:
+        nl = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        nl.bind((0, RTMGRP_LINK))
+    except OSError as e:
+        log.warning("No interface hot-plug: %s", e)
+        return None
+    nl.setblocking(False)
+    return nl
+
+def mop_netlink_drain(nl):
+    """Discards pending link notifications; a rescan reads sysfs anyway."""
+    try:
+        while nl.recv(65536):
+            pass
+    except (BlockingIOError, InterruptedError):
+        pass
+
+# --- Dump/Load Engine ---
+
+# Active loads, keyed by client Ethernet address
+dl_sessions = SessionTable()
+
+# Request Programs answered lately, keyed by client, multicast or not,
+# and the message itself: the program and step in the boot sequence
+dl_requests = RequestWindow()
+
+# Index of the MOP directory, built at startup
+image_index = None
+
+# When each client's first Request Program was seen, until its load starts
+rpr_seen = {}
+
+def mop_dl_image_name(src, software_id):
+    """Returns the image name a Request Program asks for."""
+    if software_id:
+        return software_id
+    return src.hex()
+
+def mop_dl_request_program(iface, dst, src, trans, msg):
+    """
+    Answers a Request Program: volunteer on multicast, load on unicast.
+    Copies of a request already answered within the dedupe window are
+    dropped unparsed, and only the unicast request that commits the
+    client to this server gets a session.
+    """
+    multicast = mop_is_multicast(dst)
+    if not multicast and dst != iface.hwaddr:
+        return
+    request = bytes(msg)
+    now = time.monotonic()
+    if dl_requests.duplicate((src, multicast, request), now):
+        metric_dropped.labels("dl", "duplicate").inc()
+        return
+
+    rpr = mop_parse_rpr(msg)
+    if rpr is None:
+        return
+    devtype, version, progtype, software_id, data_size = rpr
+    name = mop_dl_image_name(src, software_id)
+    image = image_index.lookup(name)
+    if image is None:
+        log.debug("%s: no image for %s in %s", mop_eaddr_str(src), name, args.mop_dir)
+        return
+
+    if dl_sessions.full(src):
+        log.warning("%s: session table full, ignoring request",
+                    mop_eaddr_str(src), extra={"source": src})
+        return
+
+    if multicast:
+        if len(rpr_seen) >= dl_sessions.max_sessions:
+            rpr_seen.clear()
+        rpr_seen.setdefault(src, now)
+        iface.send([src, iface.asv[trans]])
+        return
+
+    sess = dl_sessions.get(src)
+    if sess is not None and sess.request == request and sess.index == 0 \
+            and sess.iface is iface:
+        # The client asked again before taking the first frame; resend it
+        # rather than plan the load over
+        metric_retransmits.labels("requested").inc()
+        sess.retransmits += 1
+        dl_sessions.touch(sess)
+        iface.send(sess.frame)
+        return
+
+    # Honor the buffer size the client advertised, up to what the
+    # interface MTU allows; fall back to the conservative default when
+    # it gives none or one too small to be worth planning for
+    if data_size - MLD_HDR.size >= MOP_MIN_DATA_SIZE:
+        data_size = min(data_size - MLD_HDR.size, iface.max_data_size(trans))
+    else:
+        data_size = min(MOP_DEFAULT_DATA_SIZE, iface.max_data_size(trans))
+    if sess is not None:
+        mop_dl_finished(sess, "restarted")
+    plan = mop_load_plan(image, data_size)
+    sess = DLSession(iface, src, trans, image, plan, request)
+    dl_sessions.add(sess)
+    log.info("%s (%s): loading %s, %d bytes at %#x, %d-byte frames",
+             mop_eaddr_str(src), iface.name, image.path, image.size,
+             image.header.load_addr, data_size, extra={"source": src})
+    iface.send(sess.build_frame())
+    metric_first_load.observe(time.monotonic() - rpr_seen.pop(src, now))
+
+def mop_dl_request_load(iface, dst, src, msg):
+    """
+    Answers a Request Memory Load. The load number the client asks for
+    acknowledges the previous frame when it is one ahead of it, and
+    asks for a retransmission when it repeats it.
+    """
+    sess = dl_sessions.get(src)
+    if sess is None or len(msg) < 3 or dst != iface.hwaddr:
+        return
+    loadnum = msg[1]
+    if loadnum == (sess.loadnum + 1) & 0xff:
+        if sess.index >= sess.plan.count:
+            dl_sessions.remove(sess)
+            elapsed = max(time.monotonic() - sess.started, 1e-6)
+            metric_loads.labels("complete").inc()
+            metric_load.observe(elapsed)
+            mop_dl_finished(sess, "complete")
+            log.info("%s (%s): load complete, %d bytes in %.2fs "
+                     "(%.1f KB/s, %d frames of %d bytes)",
+                     mop_eaddr_str(src), iface.name, sess.image.size, elapsed,
+                     sess.image.size / elapsed / 1024, sess.plan.count,
+                     sess.plan.data_size, extra={"source": src})
+            return
+        sess.index += 1
+        sess.loadnum = loadnum
+        dl_sessions.touch(sess)
+        iface.send(sess.build_frame())
+    elif loadnum == sess.loadnum:
+        if time.monotonic() - sess.last_active < dl_requests.window:
+            # The frame went out moments ago; this copy crossed it
+            metric_dropped.labels("dl", "duplicate").inc()
+            return
+        metric_retransmits.labels("requested").inc()
+        sess.retransmits += 1
+        dl_sessions.touch(sess)
+        iface.send(sess.frame)
+
+def mop_dl_retransmit(sess):
+    """Resends the last frame of a session the client has gone quiet on."""
+    metric_retransmits.labels("timeout").inc()
+    sess.retransmits += 1
+    sess.iface.send(sess.frame)
+
+def mop_flush():
+    """Sends everything queued on every interface this iteration."""
+    for iface in interfaces.values():
+        iface.flush()
+
+def mop_flush_timeout():
+    """Seconds until a paced interface may send again, or None."""
+    waits = [t for t in (i.sched.timeout() for i in interfaces.values() if i.sched)
+             if t is not None]
+    return min(waits) if waits else None
+
+def mop_dl_expire():
+    """Runs due session deadlines and reports reclaimed sessions."""
+    for sess in dl_sessions.expire(mop_dl_retransmit):
+        metric_loads.labels("timeout").inc()
+        mop_dl_finished(sess, "timeout")
+        log.info("%s (%s): load timed out at frame %d of %d",
+                 mop_eaddr_str(sess.client), sess.iface.name, sess.index,
+                 sess.plan.count, extra={"source": sess.client})
+
+# --- Session Snapshots ---
+
+# Seconds between snapshots of the loads for /sessions, with --metrics-port
+MOP_SESSIONS_INTERVAL = 1.0
+# Seconds a finished load stays in the snapshots
+MOP_SESSIONS_LINGER = 10.0
+
+# Loads finished lately, oldest first, as snapshot entries
+dl_finished = deque(maxlen=256)
+sessions_due = 0.0
+
+def mop_dl_entry(sess, now):
+    """Describes a load for the snapshots."""
+    plan = sess.plan
+    if sess.index < plan.count:
+        sent = plan.offsets[sess.index] - sess.image.header.offset
+    else:
+        sent = sess.image.size
+    return {"client": mop_eaddr_str(sess.client), "interface": sess.iface.name,
+            "image": os.path.basename(sess.image.path), "size": sess.image.size,
+            "sent": sent, "frames": sess.index, "count": plan.count,
+            "retransmits": sess.retransmits, "started": sess.started,
+            "elapsed": now - sess.started, "result": None}
+
+def mop_dl_finished(sess, result):
+    """Keeps a finished load in the snapshots for a while."""
+    if metrics_server is None:
+        return
+    now = time.monotonic()
+    entry = mop_dl_entry(sess, now)
+    if result == "complete":
+        entry["sent"] = sess.image.size
+    entry["result"] = result
+    dl_finished.append((now, entry))
+
+def mop_sessions_publish():
+    """
+    Publishes the loads in progress, and those finished lately, at
+    /sessions for mopdgui.py's Sessions tab.
+    """
+    global sessions_due
+    now = time.monotonic()
+    if now < sessions_due:
+        return
+    sessions_due = now + MOP_SESSIONS_INTERVAL
+    while dl_finished and now - dl_finished[0][0] > MOP_SESSIONS_LINGER:
+        dl_finished.popleft()
+    entries = [entry for _, entry in dl_finished]
+    entries.extend(mop_dl_entry(sess, now) for sess in dl_sessions)
+    mop_metrics_document("/sessions", {"pid": os.getpid(), "sessions": entries})
+
+def mop_sessions_timeout():
+    """Seconds until the next snapshot is due."""
+    return max(0.0, sessions_due - time.monotonic())
+
+# --- Upline Dump ---
+
+# Dumps in progress, keyed by client Ethernet address
+dump_sessions = SessionTable(MOP_DUMP_MAX_SESSIONS, idle_timeout=MOP_DUMP_IDLE_TIMEOUT)
+
+def mop_dump_request(iface, dst, src, trans, msg):
+    """
+    Answers a Request Dump Service: volunteer on multicast if the dump
+    fits the quota, start it on unicast.
+    """
+    multicast = mop_is_multicast(dst)
+    if not multicast and dst != iface.hwaddr:
+        return
+    request = bytes(msg)
+    if dl_requests.duplicate((src, multicast, request), time.monotonic()):
+        metric_dropped.labels("dl", "duplicate").inc()
+        return
+    rds = mop_parse_rds(msg)
+    if rds is None:
+        return
+    devtype, version, memory_size, data_size = rds
+
+    sess = dump_sessions.get(src)
+    if sess is not None:
+        if not multicast and sess.request == request and sess.address == 0:
+            # Asked again before sending any memory; ask it again too
+            metric_retransmits.labels("requested").inc()
+            mop_dump_next(sess)
+            return
+        mop_dump_finish(sess, "abandoned, client asked for a new dump")
+    if dump_sessions.full(src):
+        log.warning("%s: too many dumps in progress, ignoring request",
+                    mop_eaddr_str(src), extra={"source": src})
+        return
+    if not mop_dump_fits(args.dump_dir, args.dump_quota, dump_sessions, memory_size):
+        metric_dumps.labels("quota").inc()
+        log.warning("%s: no room for a %d-byte dump in %s", mop_eaddr_str(src),
+                    memory_size, args.dump_dir, extra={"source": src})
+        return
+    if multicast:
+        iface.send([src, iface.asv[trans]])
+        return
+
+    if data_size > MDD_HDR.size:
+        count = min(data_size - MDD_HDR.size, iface.max_data_size(trans))
+    else:
+        count = min(MOP_DEFAULT_DATA_SIZE, iface.max_data_size(trans))
+    try:
+        dump = MopDumpFile(mop_dump_path(args.dump_dir, src))
+    except OSError as e:
+        log.error("%s: cannot create dump file: %s", mop_eaddr_str(src), e,
+                  extra={"source": src})
+        return
+    sess = DumpSession(iface, src, trans, memory_size, count, dump, request)
+    dump_sessions.add(sess)
+    log.info("%s (%s): dumping %d bytes of memory to %s, %d-byte frames",
+             mop_eaddr_str(src), iface.name, memory_size, dump.path, count,
+             extra={"source": src})
+    mop_dump_next(sess)
+
+def mop_dump_next(sess):
+    """Asks for the next piece of memory, or says the dump is complete."""
+    sess.message = mop_dump_message(sess)
+    dump_sessions.touch(sess)
+    mop_dump_retransmit(sess)
+
+def mop_dump_message(sess):
+    if sess.address < sess.memory_size:
+        return RMD_MSG.pack(MOP_K_CODE_RMD, sess.address,
+                            min(sess.count, sess.memory_size - sess.address))
+    return bytes((MOP_K_CODE_DCM,))
+
+def mop_dump_retransmit(sess):
+    sess.iface.send(mop_frame(sess.client, sess.iface.hwaddr, MOP_K_PROTO_DL,
+                              sess.trans, sess.message))
+
+def mop_dump_data(iface, dst, src, msg):
+    """
+    Takes a Memory Dump Data frame. Only the piece asked for is taken;
+    anything else is a repeat, and the retransmit timer asks again if
+    the right one never comes.
+    """
+    sess = dump_sessions.get(src)
+    if sess is None or dst != iface.hwaddr or len(msg) <= MDD_HDR.size:
+        return
+    if MDD_HDR.unpack_from(msg)[1] != sess.address:
+        return
+    data = msg[MDD_HDR.size:MDD_HDR.size + sess.memory_size - sess.address]
+    try:
+        sess.file.write(data)
+    except OSError as e:
+        mop_dump_finish(sess, f"failed: {e}")
+        return
+    sess.address += len(data)
+    metric_dump_bytes.inc(len(data))
+    mop_dump_next(sess)
+    if sess.address >= sess.memory_size:
+        mop_dump_finish(sess, None)
+
+def mop_dump_finish(sess, error):
+    """Closes a dump's file and reports how it ended."""
+    dump_sessions.remove(sess)
+    try:
+        sess.file.close()
+    except OSError as e:
+        error = error or f"failed: {e}"
+    if error is None:
+        metric_dumps.labels("complete").inc()
+        log.info("%s: dump complete in %.1fs", mop_dump_describe(sess),
+                 time.monotonic() - sess.started, extra={"source": sess.client})
+    else:
+        metric_dumps.labels("failed").inc()
+        log.warning("%s: dump %s", mop_dump_describe(sess), error,
+                    extra={"source": sess.client})
+
+def mop_dump_expire():
+    """Runs due dump retransmits and gives up on silent clients."""
+    for sess in dump_sessions.expire(mop_dump_retransmit):
+        mop_dump_finish(sess, "timed out")
 
-def mop_process_rc(iface, pkt):
-    """Placeholder for MOP Remote Console processing."""
-    print(f"Processing MOP Remote Console packet on {iface.name}")
+def mop_process_dl(iface, dst, src, trans, msg):
+    """Processes a MOP Dump/Load message."""
+    code = msg[0]
+    if code == MOP_K_CODE_RPR:
+        mop_dl_request_program(iface, dst, src, trans, msg)
+    elif code == MOP_K_CODE_RML:
+        mop_dl_request_load(iface, dst, src, msg)
+    elif args.dump_dir is None:
+        return
+    elif code == MOP_K_CODE_MDD:
+        mop_dump_data(iface, dst, src, msg)
+    elif code == MOP_K_CODE_RDS:
+        mop_dump_request(iface, dst, src, trans, msg)
+
+def mop_process_rc(iface, dst, src, trans, msg):
+    """Processes a MOP Remote Console message."""
+    if inventory is not None and msg[0] in (MOP_K_CODE_SID, MOP_K_CODE_CNT):
+        inventory.receive(iface, src, trans, msg)
+    if consoles is not None and dst == iface.hwaddr:
+        consoles.receive(iface, src, trans, msg)
+    else:
+        log.debug("%s: Remote Console message %d on %s", mop_eaddr_str(src), msg[0], iface.name)
 
 # --- Core Packet Processing ---
 
-def mop_process_packet(iface_info, packet):
+def mop_process_packet(iface_info, frame):
     """
-    Processes an incoming MOP packet.
+    Processes an incoming frame, given as a memoryview of its bytes.
     This function mimics the mopProcess() function in the C code.
     """
     # Check if the packet is a MOP packet
-    if not packet.haslayer(MOP):
+    decoded = mop_decode(frame)
+    if decoded is None:
+        metric_dropped.labels("other", "undecodable").inc()
         return
+    dst, src, proto, trans, msg = decoded
+    iface_info.rx[proto].inc()
 
     # Ignore our own transmissions by checking the source MAC address
-    if not mop_cmp_eaddr(iface_info.eaddr, packet.src):
+    if not mop_cmp_eaddr(iface_info.hwaddr, src):
+        metric_dropped.labels(MOP_PROTO_NAMES[proto], "own").inc()
+        return
+
+    # MOP V3 is carried in Ethernet II frames, MOP V4 in 802.3/SNAP
+    if (trans == MOP_K_TRANS_ETHER and args.not_v3) or \
+            (trans == MOP_K_TRANS_8023 and args.not_v4):
+        metric_dropped.labels(MOP_PROTO_NAMES[proto], "version").inc()
         return
 
-    mop_layer = packet.getlayer(MOP)
+    if args.debug:
+        log.debug("%s: %s -> %s proto %#06x code %d, %d bytes", iface_info.name,
+                  mop_eaddr_str(src), mop_eaddr_str(dst), proto, msg[0], len(msg))
+
+    start = time.perf_counter()
+    if proto == MOP_K_PROTO_DL:
+        mop_process_dl(iface_info, dst, src, trans, msg)
+        handle_dl.observe(time.perf_counter() - start)
+    else:
+        mop_process_rc(iface_info, dst, src, trans, msg)
+        handle_rc.observe(time.perf_counter() - start)
+
+# --- Capture Loops ---
+
+class MopLoop:
+    """
+    A single-threaded epoll loop: every interface socket (and any other
+    descriptor the daemon watches) is serviced from one epoll instance.
+    """
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.handlers = {}
+        self.timers = []
+        self.signals = {}
+        self.wakeup = None
+
+    def add_reader(self, fd, callback):
+        """Calls callback() whenever fd is readable."""
+        self.handlers[fd] = callback
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def remove_reader(self, fd):
+        if self.handlers.pop(fd, None) is not None:
+            self.epoll.unregister(fd)
+
+    def add_timer(self, timeout, callback):
+        """
+        Calls callback() after every poll. timeout() returns how long the
+        poll may block for the callback's sake, or None for no limit.
+        """
+        self.timers.append((timeout, callback))
+
+    def add_signal(self, signum, callback):
+        """Calls callback() from the loop whenever signum arrives."""
+        if self.wakeup is None:
+            self.wakeup, wakeup_w = socket.socketpair()
+            self.wakeup.setblocking(False)
+            wakeup_w.setblocking(False)
+            signal.set_wakeup_fd(wakeup_w.detach())
+            self.add_reader(self.wakeup.fileno(), self.process_signals)
+        self.signals[signum] = callback
+        signal.signal(signum, lambda signum, frame: None)
+
+    def process_signals(self):
+        try:
+            received = self.wakeup.recv(256)
+        except (BlockingIOError, InterruptedError):
+            return
+        for signum in received:
+            callback = self.signals.get(signum)
+            if callback is not None:
+                callback()
+
+    def run(self):
+        while True:
+            waits = [t for t in (timeout() for timeout, _ in self.timers) if t is not None]
+            for fd, events in self.epoll.poll(min(waits) if waits else -1):
+                callback = self.handlers.get(fd)
+                if callback is not None:
+                    callback()
+            for _, callback in self.timers:
+                callback()
+
+def mop_capture_raw(loop):
+    """
+    Reads MOP frames from one filtered AF_PACKET socket per interface.
+    Non-MOP traffic never leaves the kernel. Interfaces are added and
+    removed as the kernel reports them.
+    """
+    loop.add_timer(dl_sessions.timeout, mop_dl_expire)
+    loop.add_timer(dump_sessions.timeout, mop_dump_expire)
+    if consoles is not None:
+        loop.add_reader(consoles.fileno(), consoles.process_requests)
+        loop.add_timer(consoles.timeout, consoles.expire)
+    if inventory is not None:
+        loop.add_timer(inventory.timeout, inventory.expire)
+    loop.add_timer(mop_flush_timeout, mop_flush)
+    if metrics_server is not None:
+        loop.add_timer(mop_sessions_timeout, mop_sessions_publish)
+    if image_index.fileno() >= 0:
+        loop.add_reader(image_index.fileno(), image_index.process_events)
+    nl = mop_netlink_open()
+    if nl is not None:
+        def on_link_change():
+            mop_netlink_drain(nl)
+            mop_device_rescan(loop)
+        loop.add_reader(nl.fileno(), on_link_change)
+    loop.add_signal(signal.SIGHUP, lambda: mop_reload_start(loop))
+    loop.add_signal(signal.SIGUSR1, lambda: mop_metrics_log(log))
+    mop_device_rescan(loop)
+    if not interfaces and nl is None:
+        sys.exit(1)
+    if handoff_state is not None:
+        mop_resume(handoff_state)
+    mop_sd_notify("READY=1")
+    loop.run()
+
+def mop_capture_scapy():
+    """Debug capture through scapy, dissecting every MOP frame."""
+    from scapy.all import sniff
+    for name in mop_device_names():
+        iface = mop_device_discover(name)
+        if iface is not None:
+            interfaces[name] = iface
+
+    # SIGUSR1 only asks, taking no lock; the metrics go out with the next frame
+    metrics_wanted = []
+    signal.signal(signal.SIGUSR1, lambda signum, frame: metrics_wanted.append(signum))
+
+    def handle(pkt):
+        if metrics_wanted:
+            metrics_wanted.clear()
+            mop_metrics_log(log)
+        if args.debug:
+            log.debug("%s", pkt.summary())
+        iface = interfaces.get(pkt.sniffed_on)
+        if iface is not None:
+            image_index.process_events()
+            mop_dl_expire()
+            mop_flush()
+            frame = memoryview(bytes(pkt))
+            if pcap is not None:
+                pcap.write(frame)
+            mop_process_packet(iface, frame)
+    sniff(iface=list(interfaces), prn=handle, store=0,
+          filter="ether proto 0x6001 or ether proto 0x6002")
+
+# --- Offline Replay ---
+
+def mop_dissector():
+    """
+    Returns a function giving scapy's one-line summary of a frame, or
+    None if scapy is not installed. Importing scapy takes seconds and
+    tens of MB, so it is loaded only for -S and for -d with --replay.
+    """
+    try:
+        from scapy.all import Ether
+    except ImportError:
+        return None
+    return lambda frame: Ether(bytes(frame)).summary()
+
+def mop_replay_server(frames):
+    """
+    Returns the address the clients in a capture sent their unicast
+    Request Program and Request Memory Load messages to, or None.
+    """
+    for frame in frames:
+        decoded = mop_decode(frame)
+        if decoded is None:
+            continue
+        dst, src, proto, trans, msg = decoded
+        if proto == MOP_K_PROTO_DL and msg[0] in (MOP_K_CODE_RPR, MOP_K_CODE_RML) \
+                and not mop_is_multicast(dst):
+            return bytes(dst)
+    return None
+
+def mop_replay(path, server=None, loops=1):
+    """
+    Feeds every frame of a pcap file through mop_process_packet() as
+    fast as it will go, with no sockets involved. The daemon answers as
+    the server the capture's clients were talking to; its replies are
+    counted and discarded. Frames the server sent in the capture are
+    dropped as our own, as they would be live.
+    """
+    frames = [memoryview(frame) for _, frame in mop_pcap_read(path)]
+    if server is None:
+        server = mop_replay_server(frames)
+        if server is None:
+            sys.exit(f"{path}: no unicast requests to tell the server by; use --replay-addr")
+        server = mop_eaddr_str(server)
+    iface = InterfaceInfo("replay", server)
+    dissect = mop_dissector() if args.debug else None
+    loads = metric_loads.labels("complete")
+    loads_before = loads.value
+    sent = 0
+    start = time.perf_counter()
+    for _ in range(loops):
+        # Each pass is a fresh boot, not a copy of the last one
+        dl_requests.clear()
+        for frame in frames:
+            if dissect is not None:
+                log.debug("%s", dissect(frame))
+            mop_process_packet(iface, frame)
+            if iface.txq:
+                sent += len(iface.txq)
+                iface.txq.clear()
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    count = len(frames) * loops
+    print(f"Replayed {count} frames as {server} in {elapsed:.3f}s "
+          f"({count / elapsed:.0f} frames/s): {sent} frames sent, "
+          f"{loads.value - loads_before} loads completed")
+
+# --- Reload ---
+
+# Descriptors handed over by the daemon we replace, by name, until taken
+handed = {}
+# What its sessions were doing, or None if we were not started by a reload
+handoff_state = None
+
+# MopReload while a new daemon is starting on SIGHUP
+reloading = None
+
+def mop_handed(name):
+    """Returns a socket handed over by the daemon we replace, or None."""
+    fd = handed.pop(name, None)
+    return socket.socket(fileno=fd) if fd is not None else None
+
+def mop_take_over(sock):
+    """Takes the sockets and sessions over from the daemon that started us."""
+    global handed, handoff_state
+    try:
+        handed, handoff_state, old_pid = mop_handoff_accept(sock)
+    except (OSError, ValueError) as e:
+        # The old daemon carries on, or is gone with its sockets
+        log.error("Cannot take over from the old daemon: %s", e)
+        sys.exit(1)
+    log.info("Took over %d loads and %d dumps from pid %d",
+             len(handoff_state["loads"]), len(handoff_state["dumps"]), old_pid)
 
-    # Check for MOP V3 or V4 messages based on the protocol type
-    if (mop_layer.type == "MOP_K_PROTO_DL" and args.not_v3):
+def mop_reload_start(loop):
+    """
+    Starts a new daemon on SIGHUP; it takes over once it has indexed
+    the images, and this one keeps serving until then.
+    """
+    global reloading
+    if reloading is not None:
         return
-    if (mop_layer.type == "MOP_K_PROTO_RC" and args.not_v4):
+    reload = MopReload()
+    try:
+        fd = reload.start()
+    except OSError as e:
+        log.error("Cannot start a new daemon: %s", e)
         return
+    reloading = reload
+    loop.add_reader(fd, lambda: mop_reload_ready(loop))
+    log.info("Reloading: started pid %d", reload.process.pid)
 
-    if mop_layer.type == "MOP_K_PROTO_DL":
-        mop_process_dl(iface_info, packet)
-    elif mop_layer.type == "MOP_K_PROTO_RC":
-        mop_process_rc(iface_info, packet)
-    else:
-        # Ignore other MOP types
-        pass
+def mop_reload_ready(loop):
+    global reloading
+    reload, reloading = reloading, None
+    loop.remove_reader(reload.sock.fileno())
+    if not reload.ready():
+        log.error("Reload failed: new daemon exited with status %d; carrying on",
+                  reload.process.returncode)
+        return
+    files, state = mop_snapshot()
+    mop_flush()
+    if pcap is not None:
+        pcap.close()
+    try:
+        reload.hand_off(files, state)
+    except (OSError, ValueError) as e:
+        log.error("Handoff to pid %d failed: %s; carrying on", reload.process.pid, e)
+        mop_pcap_start(args.pcap, keep=True)
+        return
+    log.info("Handed over to pid %d", reload.process.pid)
+    sys.exit(0)
+
+def mop_snapshot():
+    """
+    Returns the descriptors and the session state to hand a new daemon:
+    every socket, the open dump files, and how far each load and dump
+    has got. Reserved consoles are released; their TCP clients reconnect
+    to the same listening socket.
+    """
+    files = []
+    for iface in interfaces.values():
+        files.append((f"mop:{iface.name}", iface.sock))
+    if metrics_server is not None:
+        files.append(("metrics", metrics_server.socket))
+    if console_server is not None and console_server.server is not None:
+        files.append(("console", console_server.server.sockets[0].fileno()))
+        for console in list(consoles.consoles.values()):
+            consoles.close(console, "Server restarting, connect again")
+        consoles.flush()
+
+    now = time.monotonic()
+    loads = [{"iface": sess.iface.name, "client": sess.client.hex(), "trans": sess.trans,
+              "request": sess.request.hex(), "data_size": sess.plan.data_size,
+              "size": sess.image.size, "index": sess.index, "loadnum": sess.loadnum,
+              "elapsed": now - sess.started}
+             for sess in dl_sessions]
+    dumps = []
+    for sess in list(dump_sessions):
+        try:
+            dump = sess.file.suspend()
+        except OSError as e:
+            mop_dump_finish(sess, f"failed: {e}")
+            continue
+        files.append((f"dump:{sess.client.hex()}", sess.file.fd))
+        dumps.append({"iface": sess.iface.name, "client": sess.client.hex(),
+                      "trans": sess.trans, "memory_size": sess.memory_size,
+                      "count": sess.count, "address": sess.address,
+                      "request": sess.request.hex(), "elapsed": now - sess.started,
+                      "file": dump})
+    return files, {"loads": loads, "dumps": dumps}
+
+def mop_resume(state):
+    """
+    Picks up the sessions a reload handed over where they were left. The
+    last frame each client was sent is rebuilt but not sent again: its
+    answer is probably waiting on the socket already, and the retransmit
+    timer covers it if not.
+    """
+    now = time.monotonic()
+    for load in state["loads"]:
+        iface = interfaces.get(load["iface"])
+        client = bytes.fromhex(load["client"])
+        request = bytes.fromhex(load["request"])
+        rpr = mop_parse_rpr(request)
+        image = None
+        if iface is not None and rpr is not None:
+            image = image_index.lookup(mop_dl_image_name(client, rpr[3]))
+        if image is None or image.size != load["size"]:
+            log.warning("%s: cannot resume load, image gone or changed",
+                        mop_eaddr_str(client), extra={"source": client})
+            continue
+        sess = DLSession(iface, client, load["trans"], image,
+                         mop_load_plan(image, load["data_size"]), request)
+        sess.index = load["index"]
+        sess.loadnum = load["loadnum"]
+        sess.started = now - load["elapsed"]
+        sess.build_frame()
+        dl_sessions.add(sess)
+
+    for dump in state["dumps"]:
+        client = bytes.fromhex(dump["client"])
+        fd = handed.pop(f"dump:{dump['client']}", None)
+        if fd is None:
+            continue
+        file = mop_dump_resume(fd, dump["file"])
+        iface = interfaces.get(dump["iface"])
+        if iface is None:
+            file.close()
+            metric_dumps.labels("failed").inc()
+            log.warning("%s: dump abandoned, %s is gone", mop_eaddr_str(client),
+                        dump["iface"], extra={"source": client})
+            continue
+        sess = DumpSession(iface, client, dump["trans"], dump["memory_size"],
+                           dump["count"], file, bytes.fromhex(dump["request"]))
+        sess.address = dump["address"]
+        sess.started = now - dump["elapsed"]
+        sess.message = mop_dump_message(sess)
+        dump_sessions.add(sess)
+
+    for fd in handed.values():
+        os.close(fd)
+    handed.clear()
+
+# --- Worker Processes ---
+
+# A worker that dies is restarted after a delay that doubles, up to the
+# maximum, each time it dies again within WORKER_STARTUP_TIME of starting
+WORKER_RESTART_DELAY = 1.0
+WORKER_RESTART_MAX_DELAY = 30.0
+WORKER_STARTUP_TIME = 10.0
+# Failures like that in a row before the supervisor gives up
+WORKER_MAX_FAILURES = 5
+# Seconds between checks for dead workers while a restart is due
+WORKER_POLL_INTERVAL = 0.2
+
+def mop_run_worker(slot):
+    """
+    Body of a worker process. Each worker runs the whole engine with its
+    own image index and session table; the fanout group makes sure it
+    only sees the clients that hash to it.
+    """
+    global image_index
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    image_index = MopDirectory(args.mop_dir)
+    mop_metrics_start(args.metrics_port + slot if args.metrics_port else None)
+    mop_pcap_start(f"{args.pcap}.{slot}" if args.pcap else None)
+    log.info("Worker %d started (pid %d)", slot, os.getpid())
+    mop_capture_raw(MopLoop())
+
+def mop_supervise(nworkers):
+    """
+    Forks nworkers workers sharing each interface through PACKET_FANOUT,
+    and restarts any worker that dies until told to stop. A worker that
+    keeps dying as soon as it starts stops the lot, and the supervisor
+    exits with status 1 so that the service manager sees the fault.
+    """
+    global fanout
+    fanout = MopFanout()
+    workers = {}
+    started = {}    # slot -> when its worker was started
+    failures = {}   # slot -> deaths soon after starting, in a row
+    restarts = {}   # slot -> when to start its worker again
+    stopping = False
+    failed = False
+
+    def spawn(slot):
+        started[slot] = time.monotonic()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                mop_run_worker(slot)
+            except Exception:
+                log.exception("Worker %d crashed", slot)
+            finally:
+                mop_log_stop()
+                os._exit(1)
+        workers[pid] = slot
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+
+    def dump(signum, frame):
+        for pid in workers:
+            os.kill(pid, signal.SIGUSR1)
+
+    def reload(signum, frame):
+        log.warning("Reload needs a single process; restart to pick up changes")
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGUSR1, dump)
+    signal.signal(signal.SIGHUP, reload)
+    for slot in range(nworkers):
+        spawn(slot)
+    while workers or restarts:
+        if stopping:
+            restarts.clear()
+        now = time.monotonic()
+        for slot, due in list(restarts.items()):
+            if due <= now:
+                del restarts[slot]
+                spawn(slot)
+        if restarts:
+            # Reap while waiting for the next restart
+            time.sleep(max(0.0, min(min(restarts.values()) - now, WORKER_POLL_INTERVAL)))
+            if not workers:
+                continue
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                continue
+        elif workers:
+            pid, status = os.wait()
+        else:
+            continue
+        slot = workers.pop(pid, None)
+        if slot is None or stopping:
+            continue
+        code = os.waitstatus_to_exitcode(status)
+        if time.monotonic() - started[slot] < WORKER_STARTUP_TIME:
+            failures[slot] = failures.get(slot, 0) + 1
+        else:
+            failures[slot] = 0
+        if failures[slot] >= WORKER_MAX_FAILURES:
+            log.error("Worker %d (pid %d) exited with status %d, %d times in a row "
+                      "after starting; giving up", slot, pid, code, failures[slot])
+            failed = True
+            stop(signal.SIGTERM, None)
+            continue
+        delay = min(WORKER_RESTART_DELAY * 2 ** max(failures[slot] - 1, 0),
+                    WORKER_RESTART_MAX_DELAY)
+        log.warning("Worker %d (pid %d) exited with status %d, restarting in %.0fs",
+                    slot, pid, code, delay)
+        restarts[slot] = time.monotonic() + delay
+    if failed:
+        sys.exit(1)
+
+def mop_metrics_start(port):
+    """
+    Serves the metrics on port, if given. The capture loop logs them on
+    SIGUSR1, outside the signal handler: logging from one could deadlock
+    on a lock the interrupted code holds.
+    """
+    global metrics_server
+    # Ignored rather than fatal until the capture loop takes it over
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    if port:
+        try:
+            metrics_server = mop_metrics_serve(port, sock=mop_handed("metrics"))
+        except OSError as e:
+            log.error("Cannot serve metrics on port %d: %s", port, e)
+
+def mop_console_start(port, host):
+    """
+    Serves Remote Consoles to TCP clients on host and port: mopd.py's
+    MOPDaemon runs on a thread of its own and hands each client a
+    reserved console driven from the packet loop. Clients are not
+    authenticated, so host is the loopback address unless told otherwise.
+    """
+    global consoles, console_server
+    # Imported here, as only the console needs mopd.py and its daemon modules
+    from mopd import MOPDaemon
+    consoles = MopConsoles(interfaces, MOP_K_TRANS_8023 if args.not_v3 else MOP_K_TRANS_ETHER, log)
+    # A reload or systemd socket activation may have the socket listening already
+    sock = mop_handed("console") or next(iter(mop_listen_fds().values()), None)
+    console_server = MOPDaemon(port=port, host=host, console=consoles, inventory=inventory,
+                               sock=sock)
+    threading.Thread(target=console_server.start, name="console", daemon=True).start()
+
+def mop_inventory_start(path):
+    """
+    Keeps the inventory of devices in path, polling them for counters
+    every --counter-interval seconds.
+    """
+    global inventory
+    try:
+        inventory = MopInventory(path, interfaces, args.counter_interval, log)
+    except OSError as e:
+        log.error("Cannot keep the inventory in %s: %s", path, e)
+        return
+    atexit.register(inventory.close)
+    log.info("Inventory of %d devices loaded from %s", len(inventory), path)
+
+def mop_pcap_start(path, keep=False):
+    """
+    Starts recording traffic to a pcap ring at path, if given; with keep,
+    after the file the daemon we replace was writing.
+    """
+    global pcap
+    if path:
+        try:
+            pcap = MopPcapWriter(path, args.pcap_size * 1024 * 1024, args.pcap_files, keep)
+            atexit.register(pcap.close)
+        except OSError as e:
+            log.error("Cannot record to %s: %s", path, e)
 
 # --- Main Function and Argument Parsing ---
 
@@ -75,12 +1198,17 @@ def main():
     Main function to parse arguments and start the MOP daemon.
     This function mimics the main() function in the C code.
     """
-    global args
+    global args, image_index
 
     parser = argparse.ArgumentParser(
         description="MOP Dump/Load Daemon",
-        usage="%(prog)s -a [-d -f -v] [-3 | -4]\n"
-              "       %(prog)s [-d -f -v] [-3 | -4] interface [...]"
+        usage="%(prog)s -a [-d -f -S -v] [-3 | -4] [-w FILE] [--rate BPS] [--console-port P]\n"
+              "          [--dump-dir [DIR]] [--inventory [FILE]]\n"
+              "          [--workers N] [--metrics-port P]\n"
+              "       %(prog)s [-d -f -S -v] [-3 | -4] [-w FILE] [--rate BPS] [--console-port P]\n"
+              "          [--dump-dir [DIR]] [--inventory [FILE]]\n"
+              "          [--workers N] [--metrics-port P] interface [...]\n"
+              "       %(prog)s [-d] [-3 | -4] [-s DIR] --replay FILE [--replay-addr ADDR] [--replay-loops N]"
     )
     parser.add_argument("-3", dest="not_v3", action="store_true",
                         help="Do not process MOP V3 messages")
@@ -92,10 +1220,56 @@ def main():
                         help="Print debugging messages")
     parser.add_argument("-f", dest="foreground", action="store_true",
                         help="Run in the foreground")
+    parser.add_argument("-S", dest="scapy", action="store_true",
+                        help="Capture with scapy, if installed (debugging only, slow)")
     parser.add_argument("-s", dest="mop_dir", default=MOP_FILE_PATH,
                         help="Path to the MOP directory")
     parser.add_argument("-v", dest="version", action="store_true",
                         help="Print version information and exit")
+    parser.add_argument("-w", dest="pcap", metavar="FILE",
+                        help="Record MOP traffic to a ring of pcap files "
+                             "(FILE, FILE.1, ...; with workers, FILE.N per worker)")
+    parser.add_argument("--pcap-size", dest="pcap_size", type=int, default=16, metavar="MB",
+                        help="Start a new pcap file once the current one reaches this size")
+    parser.add_argument("--pcap-files", dest="pcap_files", type=int, default=MOP_PCAP_MAX_FILES,
+                        metavar="N", help="Number of pcap files to keep")
+    parser.add_argument("--replay", dest="replay", metavar="FILE",
+                        help="Process the frames of a pcap file offline, as fast as "
+                             "possible, and report frames/sec")
+    parser.add_argument("--replay-addr", dest="replay_addr", metavar="ADDR",
+                        help="Server address to answer as in the replay "
+                             "(default: where the clients sent their requests)")
+    parser.add_argument("--replay-loops", dest="replay_loops", type=int, default=1, metavar="N",
+                        help="Replay the file this many times")
+    parser.add_argument("--rate", dest="tx_rate", type=mop_parse_rate, default=0, metavar="BPS",
+                        help="Pace transmit on each interface to this bitrate, e.g. 2M, "
+                             "sharing it fairly between clients (with workers, per worker)")
+    parser.add_argument("--burst", dest="tx_burst", type=int, default=MOP_SCHED_BURST,
+                        metavar="BYTES", help="Bytes a paced interface may send back to back")
+    parser.add_argument("--dump-dir", dest="dump_dir", nargs="?", const=MOP_DUMP_PATH,
+                        metavar="DIR", help="Take upline dumps from crashed clients into DIR "
+                                            f"(default {MOP_DUMP_PATH})")
+    parser.add_argument("--dump-quota", dest="dump_quota", type=int,
+                        default=MOP_DUMP_QUOTA // (1024 * 1024), metavar="MB",
+                        help="Disk space the dumps may take up; 0 for no limit")
+    parser.add_argument("--console-port", dest="console_port", type=int, default=0, metavar="P",
+                        help="Offer device Remote Consoles to TCP clients on this port")
+    parser.add_argument("--console-bind", dest="console_bind", default="127.0.0.1", metavar="ADDR",
+                        help="Address the console port listens on (default 127.0.0.1); "
+                             "its clients are not authenticated")
+    parser.add_argument("--inventory", dest="inventory", nargs="?", const=MOP_INVENTORY_PATH,
+                        metavar="FILE", help="Keep an inventory of the devices heard in FILE "
+                                             f"(default {MOP_INVENTORY_PATH}), shown by "
+                                             "SHOW on the console port")
+    parser.add_argument("--counter-interval", dest="counter_interval", type=int,
+                        default=MOP_INVENTORY_POLL_INTERVAL, metavar="SECONDS",
+                        help="Poll each device in the inventory for counters this often; "
+                             "0 for never")
+    parser.add_argument("--workers", dest="workers", type=int, default=0,
+                        help="Share the load over this many worker processes")
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int, default=0,
+                        help="Serve Prometheus metrics, and the loads in progress "
+                             "at /sessions, on this local port (worker N uses port + N)")
     parser.add_argument("interfaces", nargs="*",
                         help="Interface(s) to listen on")
 
@@ -106,22 +1280,67 @@ def main():
         sys.exit(0)
 
     # Validate command-line arguments
-    if (args.all and args.interfaces) or (not args.all and not args.interfaces) or (args.not_v3 and args.not_v4):
+    if args.replay:
+        if args.all or args.interfaces or args.workers or args.scapy or args.pcap:
+            parser.error("--replay takes no interfaces and no capture options.")
+        if args.replay_loops < 1:
+            parser.error("--replay-loops needs a positive count.")
+    elif (args.all and args.interfaces) or (not args.all and not args.interfaces) or (args.not_v3 and args.not_v4):
         parser.error("Incorrect usage. See --help for details.")
+    if args.pcap_size < 1 or args.pcap_files < 1:
+        parser.error("--pcap-size and --pcap-files need positive values.")
+    if args.dump_quota < 0:
+        parser.error("--dump-quota cannot be negative.")
+    args.dump_quota *= 1024 * 1024
+    if args.dump_dir is not None:
+        try:
+            os.makedirs(args.dump_dir, mode=0o700, exist_ok=True)
+        except OSError as e:
+            parser.error(f"Cannot create dump directory: {e}")
+    if args.scapy and importlib.util.find_spec("scapy") is None:
+        parser.error("-S needs scapy installed.")
+    if args.workers < 0 or (args.workers and args.scapy):
+        parser.error("--workers needs a positive count and raw capture.")
+    if args.console_port and (args.workers or args.scapy or args.replay):
+        parser.error("--console-port needs raw capture in a single process.")
+    if args.inventory and (args.workers or args.scapy or args.replay):
+        parser.error("--inventory needs raw capture in a single process.")
+    if args.counter_interval < 0:
+        parser.error("--counter-interval cannot be negative.")
+    if args.inventory:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(args.inventory)), exist_ok=True)
+        except OSError as e:
+            parser.error(f"Cannot create inventory directory: {e}")
 
-    # Set up logging to syslog
-    try:
-        handler = SysLogHandler(address="/dev/log", facility=LOG_FACILITY)
-        logging.basicConfig(level=logging.INFO, handlers=[handler],
-                            format='%(name)s: %(message)s')
-        syslog = logging.getLogger("mopd")
-    except Exception as e:
-        syslog = logging.getLogger("mopd")
-        syslog.error(f"Could not open syslog: {e}. Logging to stderr instead.")
-        logging.basicConfig(level=logging.INFO,
-                            format='%(name)s: %(message)s')
+    # Set up logging to syslog, written out by a background thread;
+    # -d logs every packet and turns off rate limiting
+    syslog_error = None
+    if args.replay:
+        handler = logging.StreamHandler()
+    else:
+        try:
+            handler = SysLogHandler(address="/dev/log", facility=LOG_FACILITY)
+        except Exception as e:
+            syslog_error = e
+            handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(name)s: %(message)s'))
+    mop_log_start([handler], debug=args.debug)
+    if syslog_error is not None:
+        log.error("Could not open syslog: %s. Logging to stderr instead.", syslog_error)
+
+    if args.replay:
+        image_index = MopDirectory(args.mop_dir)
+        try:
+            mop_replay(args.replay, args.replay_addr, args.replay_loops)
+        except (OSError, ValueError) as e:
+            sys.exit(f"{parser.prog}: {e}")
+        return
+
+    # Started by a reload: the old daemon has already left the terminal
+    handoff = mop_handoff_open()
         
-    if not args.foreground and not args.debug:
+    if not args.foreground and not args.debug and handoff is None:
         # Forking into a daemon process. Note that this is a simplified
         # version and a proper daemon library would be better.
         try:
@@ -129,7 +1348,7 @@ def main():
             if pid > 0:
                 sys.exit(0)  # Exit parent process
         except OSError as e:
-            syslog.error(f"Cannot fork: {e}")
+            log.error("Cannot fork: %s", e)
             sys.exit(1)
 
         # It's good practice to redirect standard file descriptors in a daemon
@@ -138,29 +1357,37 @@ def main():
         sys.stdout.close()
         sys.stderr.close()
         
-    syslog.info(f"{parser.prog} {VERSION} started.")
+    log.info("%s %s started.", parser.prog, VERSION)
     
     # --- Packet Sniffing Loop ---
-    
-    # Placeholder for device initialization. In a real scenario, this
-    # would discover interfaces and their MAC addresses.
-    # For this example, we'll create a dummy interface info object.
-    
+
     if args.all:
-        print("Starting MOP daemon on all interfaces...")
-        # Get a list of all active network interfaces
-        interfaces_to_sniff = [iface.name for iface in os.scandir('/sys/class/net') if iface.is_dir() and iface.name != 'lo']
+        log.info("Starting MOP daemon on all interfaces")
     else:
-        interfaces_to_sniff = args.interfaces
-        print(f"Starting MOP daemon on interfaces: {', '.join(interfaces_to_sniff)}")
+        log.info("Starting MOP daemon on interfaces: %s", ", ".join(args.interfaces))
 
-    # Create dummy interface info for demonstration
-    iface_info = InterfaceInfo("eth0", "00:00:00:00:00:00")
-    
-    # Scapy's sniff function is the equivalent of the C code's main loop
-    # that "selects" on descriptors.
-    print("Sniffing packets... Press Ctrl+C to stop.")
-    sniff(iface=interfaces_to_sniff, prn=lambda pkt: mop_process_packet(iface_info, pkt), store=0)
+    # The capture loop is the equivalent of the C code's main loop that
+    # "selects" on descriptors.
+    if args.workers:
+        log.info("Running %d worker processes", args.workers)
+        mop_supervise(args.workers)
+        return
+
+    image_index = MopDirectory(args.mop_dir)
+    log.info("Indexed %d images in %s", len(image_index.entries), args.mop_dir)
+    if handoff is not None:
+        mop_take_over(handoff)
+    mop_metrics_start(args.metrics_port)
+    mop_pcap_start(args.pcap, keep=handoff is not None)
+    if args.inventory:
+        # After any takeover, so the old daemon has written its last records
+        mop_inventory_start(args.inventory)
+    if args.console_port:
+        mop_console_start(args.console_port, args.console_bind)
+    if args.scapy:
+        mop_capture_scapy()
+    else:
+        mop_capture_raw(MopLoop())
 
 if __name__ == "__main__":
     main()
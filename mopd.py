@@ -1,89 +1,335 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import signal
 import socket
+import sys
 import threading
 import time
-import logging
 from daemon import DaemonContext
 import pidfile
 
+from mopconsole import mop_console_client
+from moplog import mop_log_start
+from mopreload import (
+    MopReload, mop_handoff_accept, mop_handoff_open, mop_listen_fds, mop_sd_notify,
+)
+from mopmetrics import (
+    MOP_DURATION_BUCKETS, Counter, Gauge, Histogram, mop_metrics_log, mop_metrics_serve,
+)
+
 # Configuration
+LISTEN_HOST = '0.0.0.0'
 LISTEN_PORT = 4343
+LISTEN_BACKLOG = 1024
+MAX_CLIENTS = 10000
+LINE_LIMIT = 4096          # Longest line a client may send
+DRAIN_TIMEOUT = 5.0        # Seconds stop() waits for clients to finish
+HANDOFF_TIMEOUT = 5.0      # Seconds a reloaded daemon waits for the old one to exit
 LOG_FILE = '/var/log/mopd.log'
 PID_FILE = '/var/run/mopd.pid'
+WELCOME = b"Welcome to MOP-D Service\n"
+REPLY = b"Message received\n"
 
-# Set up logging
-logging.basicConfig(
-    filename=LOG_FILE,
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+# Metrics
+metric_connections = Counter("mopd_connections_total", "Client connections", ("result",))
+metric_clients = Gauge("mopd_clients", "Connected clients")
+metric_lines = Counter("mopd_lines_total", "Lines received from clients")
+metric_bytes_sent = Counter("mopd_sent_bytes_total", "Bytes sent to clients")
+metric_line = Histogram("mopd_line_seconds", "Time from reading a line to its reply being sent")
+metric_session = Histogram("mopd_session_seconds", "Duration of client connections",
+                           buckets=MOP_DURATION_BUCKETS)
+
+def raise_fd_limit(wanted):
+    """Raises the soft open-files limit so wanted clients fit."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < wanted:
+        new = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new, hard))
+
+class Line:
+    """A received line, decoded only if the log record is written out."""
+    __slots__ = ("data",)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return self.data.decode(errors='replace').strip()
 
 class MOPDaemon:
-    def __init__(self, port=LISTEN_PORT):
+    def __init__(self, port=LISTEN_PORT, host=LISTEN_HOST, backlog=LISTEN_BACKLOG,
+                 max_clients=MAX_CLIENTS, metrics_port=None, console=None,
+                 inventory=None, sock=None, handoff=None, argv=None):
         self.port = port
+        self.host = host
+        self.backlog = backlog
+        self.max_clients = max_clients
+        self.metrics_port = metrics_port
+        self.console = console     # MopConsoles when clients get Remote Consoles
+        self.inventory = inventory # MopInventory they may query instead
+        self.sock = sock           # Listening socket from systemd, instead of binding port
+        self.handoff = handoff     # (files, state) taken over from the daemon we replace
+        self.argv = argv           # Command line to start the daemon that replaces us
         self.running = False
-        self.socket = None
+        self.server = None
+        self.metrics = None
+        self.loop = None
+        self.clients = {}          # handler task -> (StreamReader, StreamWriter, connected)
+        self.stopped = None
+        self.reloading = None      # MopReload while a new daemon is starting
+        self.handing_off = False
 
-    def handle_client(self, client_socket, address):
-        """Handle incoming client connections"""
-        logging.info(f"Connection from {address}")
+    async def handle_client(self, reader, writer, resumed=None):
+        """
+        Handle incoming client connections. A connection taken over from
+        the daemon we replace gives how long it has been open in resumed,
+        and gets no welcome.
+        """
+        address = writer.get_extra_info('peername')
+        if len(self.clients) >= self.max_clients:
+            metric_connections.labels("rejected").inc()
+            writer.write(b"Server is full, try again later\n")
+            writer.close()
+            return
+        task = asyncio.current_task()
+        connected = time.monotonic() - (resumed or 0.0)
+        self.clients[task] = (reader, writer, connected)
+        metric_connections.labels("accepted" if resumed is None else "resumed").inc()
+        metric_clients.inc()
+        if resumed is None:
+            logging.info("Connection from %s", address)
         try:
-            client_socket.send(b"Welcome to MOP-D Service\n")
-            while self.running:
-                data = client_socket.recv(1024)
-                if not data:
+            if resumed is None:
+                writer.write(WELCOME)
+                await writer.drain()
+                metric_bytes_sent.inc(len(WELCOME))
+            if self.console is not None:
+                await mop_console_client(self.console, reader, writer, self.inventory)
+                return
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # Line longer than LINE_LIMIT; drop what was buffered
+                    logging.warning("Overlong line from %s, discarded", address,
+                                    extra={"source": address[0]})
+                    continue
+                if not line:
                     break
-                logging.info(f"Received from {address}: {data.decode().strip()}")
-                client_socket.send(b"Message received\n")
+                start = time.perf_counter()
+                metric_lines.inc()
+                logging.info("Received from %s: %s", address, Line(line),
+                             extra={"source": address[0]})
+                writer.write(REPLY)
+                await writer.drain()
+                metric_bytes_sent.inc(len(REPLY))
+                metric_line.observe(time.perf_counter() - start)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
         except Exception as e:
-            logging.error(f"Error handling client {address}: {e}")
+            logging.error("Error handling client %s: %s", address, e)
         finally:
-            client_socket.close()
-            logging.info(f"Connection from {address} closed")
+            self.clients.pop(task, None)
+            metric_clients.dec()
+            if not self.handing_off:
+                metric_session.observe(time.monotonic() - connected)
+                writer.close()
+                logging.info("Connection from %s closed", address)
+
+    async def serve(self):
+        """Accept clients until stop() is called, then drain them"""
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        if threading.current_thread() is threading.main_thread():
+            # Otherwise the host program owns the signals
+            self.loop.add_signal_handler(signal.SIGUSR1, mop_metrics_log, logging.getLogger())
+        files, state = self.handoff or ({}, {})
+        metrics_sock = files.pop("metrics", None)
+        if self.metrics_port:
+            if metrics_sock is not None:
+                metrics_sock = socket.socket(fileno=metrics_sock)
+            self.metrics = mop_metrics_serve(self.metrics_port, sock=metrics_sock)
+        raise_fd_limit(self.max_clients + 64)
+        sock = files.pop("listen", None)
+        sock = socket.socket(fileno=sock) if sock is not None else self.sock
+        if sock is not None:
+            self.server = await asyncio.start_server(self.handle_client, sock=sock,
+                                                     limit=LINE_LIMIT)
+        else:
+            self.server = await asyncio.start_server(
+                self.handle_client, self.host, self.port,
+                backlog=self.backlog, limit=LINE_LIMIT, reuse_address=True)
+        for i, client in enumerate(state.get("clients", ())):
+            fd = files.pop(f"client{i}", None)
+            if fd is not None:
+                await self.resume_client(socket.socket(fileno=fd), client)
+        for fd in files.values():
+            os.close(fd)
+        logging.info("MOP-D started on port %d", self.server.sockets[0].getsockname()[1])
+        mop_sd_notify("READY=1")
+        await self.stopped.wait()
+
+        self.server.close()
+        if self.clients and not self.handing_off:
+            # Clients finish the lines they already sent, then see EOF
+            logging.info("Draining %d clients", len(self.clients))
+            for reader, _, _ in self.clients.values():
+                reader.feed_eof()
+            done, pending = await asyncio.wait(set(self.clients), timeout=DRAIN_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        # Since Python 3.12 this waits for every connection to close, so
+        # only once the clients have been drained
+        await self.server.wait_closed()
 
     def start(self):
         """Start the MOP daemon"""
         self.running = True
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        
         try:
-            self.socket.bind(('0.0.0.0', self.port))
-            self.socket.listen(5)
-            logging.info(f"MOP-D started on port {self.port}")
-            
-            while self.running:
-                try:
-                    client_socket, address = self.socket.accept()
-                    client_thread = threading.Thread(
-                        target=self.handle_client,
-                        args=(client_socket, address)
-                    )
-                    client_thread.daemon = True
-                    client_thread.start()
-                except Exception as e:
-                    if self.running:
-                        logging.error(f"Error accepting connection: {e}")
+            asyncio.run(self.serve())
         except Exception as e:
-            logging.error(f"Failed to start MOP-D: {e}")
+            logging.error("Failed to start MOP-D: %s", e)
         finally:
-            if self.socket:
-                self.socket.close()
+            self.running = False
 
     def stop(self):
-        """Stop the MOP daemon"""
+        """Stop the MOP daemon; safe to call from any thread"""
         self.running = False
-        if self.socket:
-            self.socket.close()
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    # --- Reload ---
+
+    def reload(self):
+        """
+        Hands the listening socket and every client over to a freshly
+        started copy of the daemon; safe to call from any thread
+        """
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.start_reload)
+
+    def start_reload(self):
+        if self.reloading is not None or self.handing_off:
+            return
+        reload = MopReload(self.argv)
+        try:
+            fd = reload.start()
+        except OSError as e:
+            logging.error("Cannot start a new daemon: %s", e)
+            return
+        self.reloading = reload
+        self.loop.add_reader(fd, self.reload_ready)
+        logging.info("Reloading: started pid %d", reload.process.pid)
+
+    def reload_ready(self):
+        reload = self.reloading
+        self.loop.remove_reader(reload.sock.fileno())
+        if not reload.ready():
+            self.reloading = None
+            logging.error("Reload failed: new daemon exited with status %d; carrying on",
+                          reload.process.returncode)
+            return
+        self.loop.create_task(self.hand_off(reload))
+
+    async def hand_off(self, reload):
+        """
+        Stops serving and passes the listening socket, the metrics
+        socket and each client, with any input not yet handled, to the
+        new daemon.
+        """
+        self.handing_off = True
+        clients = list(self.clients.items())
+        for task, (reader, writer, _) in clients:
+            writer.transport.pause_reading()
+            task.cancel()
+        await asyncio.gather(*(task for task, _ in clients), return_exceptions=True)
+
+        files = [("listen", self.server.sockets[0].fileno())]
+        if self.metrics is not None:
+            files.append(("metrics", self.metrics.socket))
+        state = []
+        handed = []
+        now = time.monotonic()
+        for task, (reader, writer, connected) in clients:
+            if writer.is_closing():
+                continue
+            handed.append(writer.transport)
+            reader.feed_eof()
+            pending = await reader.read()
+            files.append((f"client{len(state)}", writer.get_extra_info('socket').fileno()))
+            state.append({"peer": str(writer.get_extra_info('peername')),
+                          "connected": now - connected, "pending": pending.hex()})
+        try:
+            reload.hand_off(files, {"clients": state})
+        except (OSError, ValueError) as e:
+            # Too late to carry on: the clients are no longer served here
+            logging.error("Handoff to pid %d failed: %s", reload.process.pid, e)
+        else:
+            logging.info("Handed %d clients over to pid %d", len(state), reload.process.pid)
+        # The new daemon has its own copies now. Aborting ours lets
+        # serve() finish, as since Python 3.12 the server waits for every
+        # connection to close; unlike close() it leaves them unflushed.
+        for transport in handed:
+            transport.abort()
+        self.stopped.set()
+
+    async def resume_client(self, sock, client):
+        """Serves a client handed over by the daemon we replace."""
+        reader, writer = await asyncio.open_connection(sock=sock, limit=LINE_LIMIT)
+        reader.feed_data(bytes.fromhex(client["pending"]))
+        self.loop.create_task(self.handle_client(reader, writer, client["connected"]))
+
+def mop_wait_exit(pid, timeout):
+    """Waits up to timeout seconds for process pid to exit."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return
+        time.sleep(0.05)
 
-def run_daemon():
-    daemon = MOPDaemon()
+def run_daemon(debug=False, metrics_port=None):
+    # Socket activation hands us the listening socket; a reload hands
+    # us everything the old daemon had. The old daemon keeps the pid
+    # file until it exits, and has already left the terminal behind.
+    sock = next(iter(mop_listen_fds().values()), None)
+    # Saved before daemonizing moves us to /tmp, for the reload to run
+    argv = [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:]
+    handoff = mop_handoff_open()
+    if handoff is not None:
+        files, state, old_pid = mop_handoff_accept(handoff)
+        handoff = (files, state)
+        mop_wait_exit(old_pid, HANDOFF_TIMEOUT)
+    preserve = [sock] if sock is not None else []
+    if handoff is not None:
+        preserve.extend(handoff[0].values())
+    daemon = MOPDaemon(metrics_port=metrics_port, sock=sock, handoff=handoff, argv=argv)
     with DaemonContext(
         pidfile=pidfile.PIDLockFile(PID_FILE),
         umask=0o002,
-        working_directory='/tmp'
+        working_directory='/tmp',
+        detach_process=False if handoff is not None else None,
+        files_preserve=preserve,
+        signal_map={signal.SIGTERM: lambda signum, frame: daemon.stop(),
+                    signal.SIGHUP: lambda signum, frame: daemon.reload()}
     ):
+        # Opened after daemonizing, which closes every inherited descriptor
+        handler = logging.FileHandler(LOG_FILE)
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        mop_log_start([handler], debug=debug)
         daemon.start()
 
 if __name__ == "__main__":
-    run_daemon()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="MOP-D service daemon")
+    parser.add_argument("-d", dest="debug", action="store_true",
+                        help="Log every message and turn off rate limiting")
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int,
+                        help="Serve Prometheus metrics on this local port")
+    args = parser.parse_args()
+    run_daemon(args.debug, args.metrics_port)
@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 import socket
+import selectors
 import threading
 import time
 import logging
 import os
 import sys
 import json
+import queue
+import bisect
+import http.client
+import urllib.request
+from collections import deque
 from datetime import datetime
 from pathlib import Path
 
@@ -13,20 +19,308 @@ from pathlib import Path
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, simpledialog
 
+from mopinventory import MOP_INVENTORY_PATH, mop_inventory_detail
+
 # Configuration
 CONFIG_DIR = Path.home() / ".mopd"
 CONFIG_FILE = CONFIG_DIR / "config.json"
 LOG_FILE = CONFIG_DIR / "mopd.log"
 PID_FILE = CONFIG_DIR / "mopd.pid"
 
+# Session events waiting for the GUI; newer events are lost once it is full
+EVENT_QUEUE_SIZE = 10000
+# Most events the GUI handles per refresh
+EVENT_BATCH = 5000
+
+class ClientQueue:
+    """Outbound data waiting to be written to one client."""
+    __slots__ = ("sock", "address", "chunks", "dropped")
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.chunks = deque()
+        self.dropped = 0
+
+class BroadcastHub:
+    """
+    Writes replies and broadcasts to every client from a single thread.
+
+    Each client has a bounded queue; a selector watches only the clients
+    with data pending and writes with MSG_DONTWAIT, so a slow peer never
+    blocks the sender or the other clients. When a client's queue is
+    full the policy decides: "drop" disconnects it, "coalesce" discards
+    the new messages and later tells the client how many it missed.
+    """
+
+    def __init__(self, queue_size=256, policy="drop"):
+        self.queue_size = queue_size
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.dirty = set()
+        self.selector = None
+        self.thread = None
+        self.running = False
+        self.wake_r = self.wake_w = None
+
+    def __len__(self):
+        with self.lock:
+            return len(self.clients)
+
+    def start(self):
+        self.selector = selectors.DefaultSelector()
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+            self.thread = None
+        with self.lock:
+            for client in self.clients.values():
+                self.close_socket(client.sock)
+            self.clients.clear()
+            self.dirty.clear()
+        for sock in (self.wake_r, self.wake_w):
+            if sock is not None:
+                sock.close()
+        self.wake_r = self.wake_w = None
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+
+    def wake(self):
+        try:
+            self.wake_w.send(b"\0")
+        except (AttributeError, BlockingIOError, OSError):
+            pass
+
+    def add(self, sock, address):
+        with self.lock:
+            self.clients[sock] = ClientQueue(sock, address)
+            return len(self.clients)
+
+    def remove(self, sock):
+        with self.lock:
+            removed = self.clients.pop(sock, None) is not None
+            if removed:
+                self.dirty.add(sock)
+            count = len(self.clients)
+        if removed:
+            self.wake()
+        return count
+
+    def send(self, sock, data):
+        """Queues data for one client."""
+        with self.lock:
+            client = self.clients.get(sock)
+            if client is None:
+                return
+            self._enqueue(client, data)
+        self.wake()
+
+    def broadcast(self, sender, data):
+        """Queues data for every client except the sender."""
+        with self.lock:
+            for sock, client in list(self.clients.items()):
+                if sock is not sender:
+                    self._enqueue(client, data)
+        self.wake()
+
+    def _enqueue(self, client, data):
+        # Called with the lock held
+        if len(client.chunks) < self.queue_size:
+            client.chunks.append(data)
+            self.dirty.add(client.sock)
+        elif self.policy == "coalesce":
+            client.dropped += 1
+        else:
+            logging.warning(f"Client {client.address} too slow, disconnecting")
+            del self.clients[client.sock]
+            self.dirty.add(client.sock)
+            self.close_socket(client.sock)
+
+    @staticmethod
+    def close_socket(sock):
+        # Shutting down also wakes the client's reader thread out of recv()
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def run(self):
+        while self.running:
+            for key, events in self.selector.select():
+                if key.fileobj is self.wake_r:
+                    try:
+                        while self.wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    self.flush(key.fileobj)
+            self.update_interest()
+
+    def flush(self, sock):
+        """Writes as much of a client's queue as the socket takes."""
+        with self.lock:
+            client = self.clients.get(sock)
+            if client is None:
+                return
+            if client.dropped and len(client.chunks) < self.queue_size:
+                client.chunks.append(f"[{client.dropped} messages dropped]\n".encode())
+                client.dropped = 0
+            try:
+                while client.chunks:
+                    data = client.chunks[0]
+                    sent = sock.send(data, socket.MSG_DONTWAIT)
+                    if sent < len(data):
+                        client.chunks[0] = data[sent:]
+                        break
+                    client.chunks.popleft()
+            except (BlockingIOError, InterruptedError):
+                pass
+            except OSError:
+                del self.clients[sock]
+                client.chunks.clear()
+                self.close_socket(sock)
+            self.dirty.add(sock)
+
+    def update_interest(self):
+        """Watches for writability only the clients with queued data."""
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            for sock in dirty:
+                client = self.clients.get(sock)
+                wanted = client is not None and bool(client.chunks or client.dropped)
+                try:
+                    registered = self.selector.get_key(sock) is not None
+                except (KeyError, ValueError):
+                    registered = False
+                if wanted and not registered:
+                    try:
+                        self.selector.register(sock, selectors.EVENT_WRITE)
+                    except KeyError:
+                        # The fd was reused before a closed client was unregistered
+                        stale = self.selector.get_map()[sock.fileno()].fileobj
+                        self.selector.unregister(stale)
+                        self.selector.register(sock, selectors.EVENT_WRITE)
+                elif not wanted and registered:
+                    self.selector.unregister(sock)
+
+class LogTailer:
+    """
+    Follows a log file from a background thread.
+
+    Only bytes appended since the last read are read; a file that was
+    truncated is read again from the start, and one that was rotated is
+    finished off before the new file is opened. Complete lines collect in
+    a ring of the last max_lines, which take() hands to the Tk thread.
+    """
+
+    def __init__(self, path, max_lines=1000, interval=0.5):
+        self.path = path
+        self.max_lines = max_lines
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.lines = deque(maxlen=max_lines)
+        self.partial = b""
+        self.file = None
+        self.ident = None
+        self.offset = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def take(self):
+        """Returns the lines read since the last call."""
+        with self.lock:
+            lines = list(self.lines)
+            self.lines.clear()
+        return lines
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.poll()
+            except OSError as e:
+                print(f"Error reading {self.path}: {e}")
+            self.stopped.wait(self.interval)
+
+    def poll(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        ident = (st.st_dev, st.st_ino)
+        if self.file is not None and ident != self.ident:
+            # Rotated: take what was written before the rename, then switch
+            self.read()
+            self.file.close()
+            self.file = None
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+            self.ident = ident
+            self.offset = self.tail_offset(st.st_size)
+            self.partial = b""
+        elif st.st_size < self.offset:
+            # Truncated in place
+            self.offset = 0
+            self.partial = b""
+        if st.st_size > self.offset:
+            self.read()
+
+    def tail_offset(self, size):
+        """Where to start in a newly opened file: about max_lines from the end."""
+        start = max(0, size - self.max_lines * 256)
+        if start:
+            self.file.seek(start)
+            start += len(self.file.readline())
+        return start
+
+    def read(self):
+        self.file.seek(self.offset)
+        data = self.file.read()
+        self.offset += len(data)
+        if not data:
+            return
+        data = self.partial + data
+        lines = data.split(b"\n")
+        self.partial = lines.pop()
+        self.deliver(lines)
+
+    def deliver(self, lines):
+        """Hands complete lines over to take()."""
+        with self.lock:
+            self.lines.extend(line.decode(errors='replace') for line in lines)
+
 class MOPDaemon:
     def __init__(self, port=4343, host="0.0.0.0"):
         self.port = port
         self.host = host
         self.running = False
         self.socket = None
-        self.clients = []
         self.load_config()
+        self.hub = BroadcastHub(self.client_queue_size, self.slow_client_policy)
         
         # Setup logging
         if not CONFIG_DIR.exists():
@@ -44,7 +338,12 @@ class MOPDaemon:
             "port": 4343,
             "host": "0.0.0.0",
             "max_clients": 10,
-            "welcome_message": "Welcome to MOP-D Service"
+            "welcome_message": "Welcome to MOP-D Service",
+            "client_queue_size": 256,
+            "slow_client_policy": "drop",
+            "log_lines": 1000,
+            "inventory_file": MOP_INVENTORY_PATH,
+            "sessions_urls": ["http://127.0.0.1:9100/sessions"]
         }
         
         if CONFIG_FILE.exists():
@@ -55,17 +354,32 @@ class MOPDaemon:
                     self.host = config.get("host", defaults["host"])
                     self.max_clients = config.get("max_clients", defaults["max_clients"])
                     self.welcome_message = config.get("welcome_message", defaults["welcome_message"])
+                    self.client_queue_size = config.get("client_queue_size", defaults["client_queue_size"])
+                    self.slow_client_policy = config.get("slow_client_policy", defaults["slow_client_policy"])
+                    self.log_lines = config.get("log_lines", defaults["log_lines"])
+                    self.inventory_file = config.get("inventory_file", defaults["inventory_file"])
+                    self.sessions_urls = config.get("sessions_urls", defaults["sessions_urls"])
             except Exception as e:
                 print(f"Error loading config: {e}")
                 self.port = defaults["port"]
                 self.host = defaults["host"]
                 self.max_clients = defaults["max_clients"]
                 self.welcome_message = defaults["welcome_message"]
+                self.client_queue_size = defaults["client_queue_size"]
+                self.slow_client_policy = defaults["slow_client_policy"]
+                self.log_lines = defaults["log_lines"]
+                self.inventory_file = defaults["inventory_file"]
+                self.sessions_urls = defaults["sessions_urls"]
         else:
             self.port = defaults["port"]
             self.host = defaults["host"]
             self.max_clients = defaults["max_clients"]
             self.welcome_message = defaults["welcome_message"]
+            self.client_queue_size = defaults["client_queue_size"]
+            self.slow_client_policy = defaults["slow_client_policy"]
+            self.log_lines = defaults["log_lines"]
+            self.inventory_file = defaults["inventory_file"]
+            self.sessions_urls = defaults["sessions_urls"]
             self.save_config()
     
     def save_config(self):
@@ -74,7 +388,12 @@ class MOPDaemon:
             "port": self.port,
             "host": self.host,
             "max_clients": self.max_clients,
-            "welcome_message": self.welcome_message
+            "welcome_message": self.welcome_message,
+            "client_queue_size": self.client_queue_size,
+            "slow_client_policy": self.slow_client_policy,
+            "log_lines": self.log_lines,
+            "inventory_file": self.inventory_file,
+            "sessions_urls": self.sessions_urls
         }
         
         try:
@@ -85,37 +404,33 @@ class MOPDaemon:
     
     def handle_client(self, client_socket, address):
         """Handle incoming client connections"""
-        self.clients.append((client_socket, address))
-        logging.info(f"Connection from {address}, Total clients: {len(self.clients)}")
+        count = self.hub.add(client_socket, address)
+        logging.info(f"Connection from {address}, Total clients: {count}")
         
         try:
-            client_socket.send(f"{self.welcome_message}\n".encode())
+            self.hub.send(client_socket, f"{self.welcome_message}\n".encode())
             while self.running:
                 data = client_socket.recv(1024)
                 if not data:
                     break
-                message = data.decode().strip()
+                message = data.decode(errors="replace").strip()
                 logging.info(f"Received from {address}: {message}")
-                client_socket.send(b"Message received\n")
+                self.hub.send(client_socket, b"Message received\n")
                 
                 # Broadcast to other clients
-                for sock, addr in self.clients:
-                    if sock != client_socket:
-                        try:
-                            sock.send(f"Broadcast from {address}: {message}\n".encode())
-                        except:
-                            self.clients.remove((sock, addr))
+                self.hub.broadcast(client_socket, f"Broadcast from {address}: {message}\n".encode())
         except Exception as e:
             logging.error(f"Error handling client {address}: {e}")
         finally:
-            if (client_socket, address) in self.clients:
-                self.clients.remove((client_socket, address))
+            count = self.hub.remove(client_socket)
             client_socket.close()
-            logging.info(f"Connection from {address} closed, Total clients: {len(self.clients)}")
+            logging.info(f"Connection from {address} closed, Total clients: {count}")
     
     def start(self):
         """Start the MOP daemon"""
         self.running = True
+        self.hub = BroadcastHub(self.client_queue_size, self.slow_client_policy)
+        self.hub.start()
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         
@@ -127,7 +442,7 @@ class MOPDaemon:
             while self.running:
                 try:
                     client_socket, address = self.socket.accept()
-                    if len(self.clients) >= self.max_clients:
+                    if len(self.hub) >= self.max_clients:
                         client_socket.send(b"Server is full, try again later\n")
                         client_socket.close()
                         continue
@@ -153,17 +468,428 @@ class MOPDaemon:
         """Stop the MOP daemon"""
         self.running = False
         # Close all client connections
-        for client_socket, address in self.clients:
-            try:
-                client_socket.close()
-            except:
-                pass
-        self.clients.clear()
+        self.hub.stop()
         
         if self.socket:
             self.socket.close()
         logging.info("MOP-D stopped")
 
+# --- Sessions Dashboard ---
+
+SESSIONS_INTERVAL = 1.0    # Seconds between polls of the daemons' /sessions
+SESSIONS_TIMEOUT = 2.0     # Seconds to wait for a daemon to answer a poll
+DASHBOARD_INTERVAL = 0.5   # Seconds between dashboard refreshes
+SPARK_SAMPLES = 60         # Throughput samples kept per session
+SESSION_LINGER = 10.0      # Seconds a finished session stays listed
+ROW_HEIGHT = 22
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+class SessionPoller:
+    """
+    Follows the program loads of mopd-gemini.py from a background thread.
+
+    Each daemon started with --metrics-port serves a snapshot of its loads
+    at /sessions; every worker has a port of its own, so there may be
+    several URLs. Successive snapshots are turned into events on a bounded
+    queue the Tk thread drains: "start" (the load), "sent" (bytes),
+    "retransmit" (frames), "end" (result) and "error" (text, or None once
+    the daemon answers again), then one "sample" per round of polls.
+    """
+
+    def __init__(self, urls, interval=SESSIONS_INTERVAL):
+        self.urls = list(urls)
+        self.interval = interval
+        self.events = queue.Queue(EVENT_QUEUE_SIZE)
+        self.known = {}           # key -> [bytes sent, retransmits, finished]
+        self.failing = set()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+
+    def post(self, kind, key, value=None):
+        """Queues an event for the GUI. Never blocks."""
+        try:
+            self.events.put_nowait((kind, key, value, time.monotonic()))
+        except queue.Full:
+            pass
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.poll()
+            self.post("sample", None)
+            self.stopped.wait(self.interval)
+
+    def poll(self):
+        seen = set()
+        for url in self.urls:
+            try:
+                with urllib.request.urlopen(url, timeout=SESSIONS_TIMEOUT) as response:
+                    snapshot = json.load(response)
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                if url not in self.failing:
+                    self.failing.add(url)
+                    self.post("error", url, str(e))
+                continue
+            if url in self.failing:
+                self.failing.discard(url)
+                self.post("error", url, None)
+            for entry in snapshot["sessions"]:
+                key = (url, snapshot["pid"], entry["client"], entry["started"])
+                seen.add(key)
+                state = self.known.get(key)
+                if state is None:
+                    state = self.known[key] = [0, 0, False]
+                    self.post("start", key, entry)
+                if entry["sent"] > state[0]:
+                    self.post("sent", key, entry["sent"] - state[0])
+                    state[0] = entry["sent"]
+                if entry["retransmits"] > state[1]:
+                    self.post("retransmit", key, entry["retransmits"] - state[1])
+                    state[1] = entry["retransmits"]
+                if entry["result"] and not state[2]:
+                    self.post("end", key, entry["result"])
+                    state[2] = True
+        for key in [k for k in self.known if k not in seen]:
+            # Gone without finishing: the daemon stopped or cannot be reached
+            if not self.known.pop(key)[2]:
+                self.post("end", key, "lost")
+
+class SessionView:
+    """What the dashboard knows about one program load."""
+
+    def __init__(self, entry, started):
+        self.client = entry["client"]
+        self.interface = entry["interface"]
+        self.image = entry["image"]
+        self.size = max(entry["size"], 1)
+        self.started = started
+        self.ended = None
+        self.result = None
+        self.bytes_sent = 0
+        self.sampled = 0
+        self.retransmits = 0
+        self.rates = deque([0.0] * SPARK_SAMPLES, maxlen=SPARK_SAMPLES)
+
+class SessionDashboard(ttk.Frame):
+    """
+    Per-load progress bars and throughput sparklines.
+
+    Only the rows that fit in the window exist as canvas items; scrolling
+    and refreshes rewrite those in place, so drawing costs the same for
+    five sessions or five hundred.
+    """
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.sessions = {}        # key -> SessionView
+        self.order = []           # keys, oldest session first
+        self.errors = {}          # URL -> why it cannot be polled
+        self.top = 0
+        self.rows = []
+        self.active = 0
+        self.retransmits = 0
+        self.sampled = None
+        self.total_rates = deque([0.0] * SPARK_SAMPLES, maxlen=SPARK_SAMPLES)
+
+        header = ttk.Frame(self)
+        header.pack(fill='x', padx=5, pady=5)
+        self.summary = ttk.Label(header, text="No sessions")
+        self.summary.pack(side='left')
+        self.total_canvas = tk.Canvas(header, width=200, height=24, highlightthickness=0)
+        self.total_canvas.pack(side='right')
+        self.total_line = self.total_canvas.create_line(0, 23, 200, 23, fill='blue')
+
+        body = ttk.Frame(self)
+        body.pack(fill='both', expand=True, padx=5, pady=5)
+        self.scrollbar = ttk.Scrollbar(body, orient='vertical', command=self.scroll)
+        self.scrollbar.pack(side='right', fill='y')
+        self.canvas = tk.Canvas(body, background='white', highlightthickness=0)
+        self.canvas.pack(side='left', fill='both', expand=True)
+        self.canvas.bind('<Configure>', self.resize)
+        self.canvas.bind('<MouseWheel>', lambda e: self.scroll('scroll', -1 if e.delta > 0 else 1, 'units'))
+        self.canvas.bind('<Button-4>', lambda e: self.scroll('scroll', -1, 'units'))
+        self.canvas.bind('<Button-5>', lambda e: self.scroll('scroll', 1, 'units'))
+
+    def apply(self, events):
+        """Folds a batch of session events into the session views."""
+        for kind, key, value, when in events:
+            if kind == "sample":
+                self.sample(when)
+                continue
+            if kind == "error":
+                if value is None:
+                    self.errors.pop(key, None)
+                else:
+                    self.errors[key] = value
+                continue
+            view = self.sessions.get(key)
+            if kind == "start":
+                if view is None:
+                    self.order.append(key)
+                self.sessions[key] = SessionView(value, when)
+                continue
+            if view is None:
+                continue
+            if kind == "sent":
+                view.bytes_sent += value
+            elif kind == "retransmit":
+                view.retransmits += value
+            elif kind == "end":
+                view.ended = when
+                view.result = value
+
+    def sample(self, now):
+        """Takes one throughput sample per session and drops stale ones."""
+        interval = now - self.sampled if self.sampled is not None else SESSIONS_INTERVAL
+        self.sampled = now
+        interval = max(interval, 1e-3)
+        total = 0.0
+        active = 0
+        retransmits = 0
+        stale = False
+        for view in self.sessions.values():
+            rate = (view.bytes_sent - view.sampled) / interval
+            view.sampled = view.bytes_sent
+            view.rates.append(rate)
+            total += rate
+            retransmits += view.retransmits
+            if view.ended is None:
+                active += 1
+            elif now - view.ended > SESSION_LINGER:
+                stale = True
+        if stale:
+            for key in self.order:
+                view = self.sessions[key]
+                if view.ended is not None and now - view.ended > SESSION_LINGER:
+                    del self.sessions[key]
+            self.order = [k for k in self.order if k in self.sessions]
+        self.active = active
+        self.retransmits = retransmits
+        self.total_rates.append(total)
+
+    def resize(self, event=None):
+        """Creates as many row item sets as fit in the canvas."""
+        self.canvas.delete('row')
+        self.rows = []
+        for i in range(self.canvas.winfo_height() // ROW_HEIGHT + 1):
+            y = i * ROW_HEIGHT
+            tag = (f"row{i}", 'row')
+            self.rows.append((
+                f"row{i}",
+                self.canvas.create_text(5, y + 11, anchor='w', tags=tag),
+                self.canvas.create_rectangle(170, y + 5, 330, y + 17, outline='grey', tags=tag),
+                self.canvas.create_rectangle(170, y + 5, 170, y + 17, fill='green', width=0, tags=tag),
+                self.canvas.create_line(340, y + 18, 460, y + 18, fill='blue', tags=tag),
+                self.canvas.create_text(470, y + 11, anchor='w', tags=tag),
+            ))
+        self.render()
+
+    def scroll(self, action, amount, unit=None):
+        if action == 'moveto':
+            self.top = int(float(amount) * len(self.order))
+        elif unit == 'pages':
+            self.top += int(amount) * max(1, len(self.rows) - 1)
+        else:
+            self.top += int(amount)
+        self.render()
+
+    @staticmethod
+    def spark_points(rates, x, y, width, height):
+        peak = max(rates) or 1.0
+        step = width / (len(rates) - 1)
+        points = []
+        for i, rate in enumerate(rates):
+            points += (x + i * step, y + height - rate / peak * height)
+        return points
+
+    def render(self):
+        """Redraws the visible rows and the summary."""
+        count = len(self.order)
+        visible = len(self.rows)
+        self.top = max(0, min(self.top, count - visible + 1))
+        text = (f"Loads: {self.active} active, {count} listed   "
+                f"Throughput: {format_bytes(self.total_rates[-1])}/s   "
+                f"Retransmits: {self.retransmits}")
+        if self.errors:
+            url, error = next(iter(self.errors.items()))
+            text += f"   Cannot poll {url}: {error}"
+        self.summary.config(text=text)
+        self.total_canvas.coords(self.total_line,
+                                 *self.spark_points(self.total_rates, 0, 2, 200, 20))
+        for i, (tag, label, _, bar, spark, stats) in enumerate(self.rows):
+            n = self.top + i
+            if n >= count:
+                self.canvas.itemconfigure(tag, state='hidden')
+                continue
+            view = self.sessions[self.order[n]]
+            y = i * ROW_HEIGHT
+            color = 'grey' if view.ended is not None else 'black'
+            done = min(view.bytes_sent / view.size, 1.0)
+            self.canvas.itemconfigure(tag, state='normal')
+            self.canvas.itemconfigure(label, text=f"{view.client} {view.interface}", fill=color)
+            self.canvas.coords(bar, 170, y + 5, 170 + 160 * done, y + 17)
+            self.canvas.itemconfigure(bar, fill='green' if view.result in (None, "complete") else 'red')
+            self.canvas.coords(spark, *self.spark_points(view.rates, 340, y + 4, 120, 14))
+            text = (f"{view.image}  {format_bytes(view.bytes_sent)} of {format_bytes(view.size)}  "
+                    f"{format_bytes(view.rates[-1])}/s")
+            if view.retransmits:
+                text += f"  retransmits {view.retransmits}"
+            if view.result is not None and view.result != "complete":
+                text += f"  {view.result}"
+            self.canvas.itemconfigure(stats, text=text, fill=color)
+        if count:
+            self.scrollbar.set(self.top / count, min(1.0, (self.top + visible) / count))
+        else:
+            self.scrollbar.set(0, 1)
+
+# --- Devices ---
+
+INVENTORY_INTERVAL = 2.0   # Seconds between checks of the inventory file
+INVENTORY_COLUMNS = (("address", "Address", 130), ("interface", "Interface", 80),
+                     ("devtype", "Type", 50), ("version", "Version", 70),
+                     ("software", "Software", 140), ("last_seen", "Last seen", 150))
+
+class InventoryTailer(LogTailer):
+    """
+    Follows the inventory file from a background thread.
+
+    Only the records appended since the last read are parsed. Compaction
+    replaces the file, so a new file is read from the start and stands
+    for the whole table; take() says so, and hands over the records
+    changed since the last call.
+    """
+
+    def __init__(self, path, interval=INVENTORY_INTERVAL):
+        super().__init__(path, 1, interval)
+        self.records = {}         # address -> record, changed since take()
+        self.reset = False
+
+    def tail_offset(self, size):
+        with self.lock:
+            self.records.clear()
+            self.reset = True
+        return 0
+
+    def deliver(self, lines):
+        records = {}
+        for line in lines:
+            try:
+                record = json.loads(line)
+                records[record["address"]] = record
+            except (ValueError, KeyError, TypeError):
+                continue              # Left half written by a crash
+        with self.lock:
+            self.records.update(records)
+
+    def take(self):
+        """Returns whether the table was read anew, and the records read since the last call."""
+        with self.lock:
+            reset, records = self.reset, self.records
+            self.reset = False
+            self.records = {}
+        return reset, records
+
+class InventoryView(ttk.Frame):
+    """
+    The devices mopd-gemini.py keeps in its inventory file. An
+    InventoryTailer reads the file as it grows, and refresh() updates
+    only the rows that changed; the network is never polled.
+    """
+
+    def __init__(self, parent, path):
+        super().__init__(parent)
+        self.path = path
+        self.tailer = None
+        self.records = {}
+        self.order = []           # addresses, sorted as the rows are
+
+        header = ttk.Frame(self)
+        header.pack(fill='x', padx=5, pady=5)
+        self.summary = ttk.Label(header, text="No inventory")
+        self.summary.pack(side='left')
+
+        body = ttk.PanedWindow(self, orient='vertical')
+        body.pack(fill='both', expand=True, padx=5, pady=5)
+        self.tree = ttk.Treeview(body, columns=[c[0] for c in INVENTORY_COLUMNS],
+                                 show='headings', selectmode='browse')
+        for column, title, width in INVENTORY_COLUMNS:
+            self.tree.heading(column, text=title)
+            self.tree.column(column, width=width, stretch=column == 'software')
+        self.tree.bind('<<TreeviewSelect>>', self.select)
+        body.add(self.tree, weight=3)
+        self.detail = scrolledtext.ScrolledText(body, height=10, state='disabled')
+        body.add(self.detail, weight=1)
+
+    def start(self, path=None):
+        """Starts following path, or the current file again."""
+        self.stop()
+        if path is not None:
+            self.path = path
+        self.records = {}
+        self.order = []
+        self.tree.delete(*self.tree.get_children())
+        self.summary.config(text=f"No inventory   ({self.path})")
+        self.select()
+        self.tailer = InventoryTailer(self.path)
+        self.tailer.start()
+
+    def stop(self):
+        if self.tailer is not None:
+            self.tailer.stop()
+            self.tailer = None
+
+    def refresh(self):
+        """Applies the records the tailer has read since the last call."""
+        if self.tailer is None:
+            return
+        reset, records = self.tailer.take()
+        if not reset and not records:
+            return
+        selected = self.tree.selection()
+        if reset:
+            self.records = {}
+            self.order = []
+            self.tree.delete(*self.tree.get_children())
+        for address, record in records.items():
+            values = [record.get(c[0], "") for c in INVENTORY_COLUMNS]
+            values[-1] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.get("last_seen", 0)))
+            if address in self.records:
+                self.tree.item(address, values=values)
+            else:
+                index = bisect.bisect_left(self.order, address)
+                self.order.insert(index, address)
+                self.tree.insert('', index, iid=address, values=values)
+            self.records[address] = record
+        self.summary.config(text=f"Devices: {len(self.records)}   ({self.path})")
+        if reset:
+            selected = [iid for iid in selected if iid in self.records]
+            if selected:
+                self.tree.selection_set(selected)
+            self.select()
+        elif selected and selected[0] in records:
+            self.select()
+
+    def select(self, event=None):
+        selected = self.tree.selection()
+        text = mop_inventory_detail(self.records[selected[0]]) if selected else ""
+        self.detail.config(state='normal')
+        self.detail.delete(1.0, tk.END)
+        self.detail.insert(tk.END, text)
+        self.detail.config(state='disabled')
+
 class MOPDGUI:
     def __init__(self, root):
         self.root = root
@@ -186,6 +912,14 @@ class MOPDGUI:
         control_tab = ttk.Frame(tab_control)
         tab_control.add(control_tab, text='Control')
         
+        # Sessions tab
+        sessions_tab = ttk.Frame(tab_control)
+        tab_control.add(sessions_tab, text='Sessions')
+        
+        # Devices tab
+        devices_tab = ttk.Frame(tab_control)
+        tab_control.add(devices_tab, text='Devices')
+        
         # Log tab
         log_tab = ttk.Frame(tab_control)
         tab_control.add(log_tab, text='Log')
@@ -215,6 +949,15 @@ class MOPDGUI:
         self.stop_btn = ttk.Button(btn_frame, text="Stop Daemon", command=self.stop_daemon, state='disabled')
         self.stop_btn.pack(side='left', padx=5)
         
+        # Sessions tab content
+        self.dashboard = SessionDashboard(sessions_tab)
+        self.dashboard.pack(fill='both', expand=True)
+        
+        # Devices tab content
+        self.inventory = InventoryView(devices_tab, self.daemon.inventory_file)
+        self.inventory.pack(fill='both', expand=True)
+        self.inventory.start()
+        
         # Log tab content
         log_frame = ttk.LabelFrame(log_tab, text="Daemon Log")
         log_frame.pack(padx=10, pady=10, fill='both', expand=True)
@@ -258,18 +1001,45 @@ class MOPDGUI:
         welcome_entry = ttk.Entry(welcome_frame, textvariable=self.welcome_var, width=50)
         welcome_entry.pack(fill='x', padx=5, pady=2)
         
+        # Inventory file setting
+        inventory_frame = ttk.Frame(config_frame)
+        inventory_frame.pack(fill='x', padx=5, pady=5)
+        ttk.Label(inventory_frame, text="Device Inventory File:").pack(anchor='w')
+        self.inventory_var = tk.StringVar(value=self.daemon.inventory_file)
+        inventory_entry = ttk.Entry(inventory_frame, textvariable=self.inventory_var, width=50)
+        inventory_entry.pack(fill='x', padx=5, pady=2)
+        
+        # Sessions URLs setting
+        sessions_frame = ttk.Frame(config_frame)
+        sessions_frame.pack(fill='x', padx=5, pady=5)
+        ttk.Label(sessions_frame, text="Session URLs (mopd-gemini.py /sessions, space separated):").pack(anchor='w')
+        self.sessions_var = tk.StringVar(value=" ".join(self.daemon.sessions_urls))
+        sessions_entry = ttk.Entry(sessions_frame, textvariable=self.sessions_var, width=50)
+        sessions_entry.pack(fill='x', padx=5, pady=2)
+        
         # Save config button
         save_btn = ttk.Button(config_frame, text="Save Configuration", command=self.save_config)
         save_btn.pack(pady=10)
         
         # Set up log monitoring
+        self.log_tailer = LogTailer(LOG_FILE, self.daemon.log_lines)
+        self.log_tailer.start()
+        self.session_poller = SessionPoller(self.daemon.sessions_urls)
+        self.session_poller.start()
         self.update_log()
+        self.update_dashboard()
+        self.update_inventory()
     
     def save_config(self):
         self.daemon.port = self.port_var.get()
         self.daemon.host = self.host_var.get()
         self.daemon.max_clients = self.max_clients_var.get()
         self.daemon.welcome_message = self.welcome_var.get()
+        self.daemon.inventory_file = self.inventory_var.get()
+        if self.inventory.path != self.daemon.inventory_file:
+            self.inventory.start(self.daemon.inventory_file)
+        self.daemon.sessions_urls = self.sessions_var.get().split()
+        self.session_poller.urls = list(self.daemon.sessions_urls)
         self.daemon.save_config()
         messagebox.showinfo("Success", "Configuration saved successfully!")
     
@@ -315,29 +1085,44 @@ class MOPDGUI:
     
     def update_status(self):
         if self.is_running:
-            self.clients_label.config(text=f"Connected clients: {len(self.daemon.clients)}")
+            self.clients_label.config(text=f"Connected clients: {len(self.daemon.hub)}")
         self.root.after(1000, self.update_status)
     
     def update_log(self):
-        if LOG_FILE.exists():
-            try:
-                with open(LOG_FILE, 'r') as f:
-                    content = f.read()
-                
-                self.log_text.config(state='normal')
-                self.log_text.delete(1.0, tk.END)
-                self.log_text.insert(tk.END, content)
-                self.log_text.see(tk.END)
-                self.log_text.config(state='disabled')
-            except Exception as e:
-                print(f"Error reading log file: {e}")
+        lines = self.log_tailer.take()
+        if lines:
+            self.log_text.config(state='normal')
+            self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+            # Keep only the last log_lines lines in the widget
+            excess = int(self.log_text.index('end-1c').split('.')[0]) - 1 - self.log_tailer.max_lines
+            if excess > 0:
+                self.log_text.delete(1.0, f"{excess + 1}.0")
+            self.log_text.see(tk.END)
+            self.log_text.config(state='disabled')
         
-        self.root.after(2000, self.update_log)
+        self.root.after(500, self.update_log)
+
+    def update_dashboard(self):
+        events = []
+        try:
+            while len(events) < EVENT_BATCH:
+                events.append(self.session_poller.events.get_nowait())
+        except queue.Empty:
+            pass
+        self.dashboard.apply(events)
+        self.dashboard.render()
+        self.root.after(int(DASHBOARD_INTERVAL * 1000), self.update_dashboard)
+
+    def update_inventory(self):
+        self.inventory.refresh()
+        self.root.after(500, self.update_inventory)
 
 def main():
     root = tk.Tk()
     app = MOPDGUI(root)
-    root.protocol("WM_DELETE_WINDOW", lambda: (app.stop_daemon(), root.destroy()))
+    root.protocol("WM_DELETE_WINDOW", lambda: (app.stop_daemon(), app.log_tailer.stop(),
+                                                  app.session_poller.stop(), app.inventory.stop(),
+                                                  root.destroy()))
     root.mainloop()
 
 if __name__ == "__main__":
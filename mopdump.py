@@ -0,0 +1,166 @@
+"""
+Upline dump reception for the MOP daemon.
+
+A crashed VAX or VXT asks for dump service with Request Dump Service,
+naming how much memory it has. The server that takes the dump walks
+through that memory with Request Memory Dump, each answered by a Memory
+Dump Data frame, and ends with Dump Complete. The server sends the next
+request the moment the previous answer arrives, so the dump runs as
+fast as the client can answer.
+
+Each dump goes to its own file, named after the client's address and
+the time the dump started. Data is collected in a write buffer of
+MOP_DUMP_BUFSIZE bytes per dump and written out a buffer at a time.
+Pages that are all zero are skipped, leaving holes, so a machine with
+mostly idle memory makes a small file. Only the buffer is held in
+memory, however large the dump.
+"""
+
+import os
+import time
+
+from mopcodec import mop_eaddr_str
+
+# Where dumps are written, with --dump-dir
+MOP_DUMP_PATH = "/var/crash/mop"
+# Write buffer per dump; written out once it is full
+MOP_DUMP_BUFSIZE = 1024 * 1024
+# Granularity of the holes left for zero memory
+MOP_DUMP_PAGE = 4096
+# Disk space all dumps together may take up
+MOP_DUMP_QUOTA = 2048 * 1024 * 1024
+# Concurrent dumps
+MOP_DUMP_MAX_SESSIONS = 8
+# Give up on a client that has not answered for this long
+MOP_DUMP_IDLE_TIMEOUT = 30.0
+
+_ZERO_PAGE = bytes(MOP_DUMP_PAGE)
+
+class MopDumpFile:
+    """A dump file written in address order, sparse where memory is zero."""
+
+    def __init__(self, path, fd=None):
+        self.path = path
+        if fd is None:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600)
+        self.fd = fd
+        self.buf = bytearray()
+        self.start = 0            # File offset of buf[0]; always page aligned
+        self.size = 0
+        self.written = 0          # Bytes actually written, holes excluded
+
+    def write(self, data):
+        """Appends data, writing out whole pages once the buffer is full."""
+        self.buf += data
+        self.size += len(data)
+        if len(self.buf) >= MOP_DUMP_BUFSIZE:
+            self.flush(len(self.buf) // MOP_DUMP_PAGE * MOP_DUMP_PAGE)
+
+    def flush(self, length):
+        """Writes out the first length bytes of the buffer, skipping zero pages."""
+        buf = self.buf
+        with memoryview(buf) as view:
+            run = None            # Start of the current run of non-zero pages
+            for page in range(0, length, MOP_DUMP_PAGE):
+                end = min(page + MOP_DUMP_PAGE, length)
+                if buf[page:end] == _ZERO_PAGE[:end - page]:
+                    if run is not None:
+                        self.pwrite(view[run:page], run)
+                        run = None
+                elif run is None:
+                    run = page
+            if run is not None:
+                self.pwrite(view[run:length], run)
+        del buf[:length]
+        self.start += length
+
+    def pwrite(self, data, offset):
+        offset += self.start
+        while data:
+            n = os.pwrite(self.fd, data, offset)
+            data = data[n:]
+            offset += n
+            self.written += n
+
+    def suspend(self):
+        """
+        Writes out the whole pages in the buffer for a reload, and
+        returns what the new daemon needs to carry on with the file.
+        """
+        self.flush(len(self.buf) // MOP_DUMP_PAGE * MOP_DUMP_PAGE)
+        return {"path": self.path, "start": self.start, "size": self.size,
+                "written": self.written, "buf": self.buf.hex()}
+
+    def close(self):
+        """Writes out what is left and sets the length, holes and all."""
+        if self.fd < 0:
+            return
+        try:
+            self.flush(len(self.buf))
+            os.ftruncate(self.fd, self.size)
+        finally:
+            os.close(self.fd)
+            self.fd = -1
+
+class DumpSession:
+    """State of one upline dump from a single client."""
+    __slots__ = ("iface", "client", "trans", "memory_size", "count", "address",
+                 "file", "request", "message", "retries", "last_active",
+                 "started", "timer_tick")
+
+    def __init__(self, iface, client, trans, memory_size, count, file, request):
+        self.iface = iface
+        self.client = client
+        self.trans = trans
+        self.memory_size = memory_size
+        self.count = count        # Bytes asked for per Request Memory Dump
+        self.address = 0          # Next address wanted
+        self.file = file
+        self.request = request    # Request Dump Service that started the dump
+        self.message = None       # Last message sent, for retransmission
+        self.retries = 0
+        self.last_active = self.started = time.monotonic()
+        self.timer_tick = None
+
+def mop_dump_resume(fd, state):
+    """Reopens a dump file handed over by a reload, given its suspend() state."""
+    dump = MopDumpFile(state["path"], fd)
+    dump.start = state["start"]
+    dump.size = state["size"]
+    dump.written = state["written"]
+    dump.buf = bytearray.fromhex(state["buf"])
+    return dump
+
+def mop_dump_path(dump_dir, client, now=None):
+    """Returns the file name for a dump from client starting now."""
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+    return os.path.join(dump_dir, f"{client.hex()}-{stamp}.dmp")
+
+def mop_dump_usage(dump_dir):
+    """Bytes of disk the dumps in dump_dir take up."""
+    used = 0
+    try:
+        with os.scandir(dump_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith(".dmp") and entry.is_file(follow_symlinks=False):
+                    used += entry.stat(follow_symlinks=False).st_blocks * 512
+    except FileNotFoundError:
+        pass
+    return used
+
+def mop_dump_fits(dump_dir, quota, sessions, memory_size):
+    """
+    True if a dump of memory_size bytes fits the quota. Dumps in
+    progress are counted at their full size, since their holes are not
+    known yet.
+    """
+    if not quota:
+        return True
+    reserved = sum(sess.memory_size - sess.file.written for sess in sessions)
+    return mop_dump_usage(dump_dir) + reserved + memory_size <= quota
+
+def mop_dump_describe(sess):
+    """Summary of a finished or abandoned dump for the log."""
+    return (f"{mop_eaddr_str(sess.client)} ({sess.iface.name}): {sess.file.path}, "
+            f"{sess.address} of {sess.memory_size} bytes, "
+            f"{sess.file.written} on disk")
@@ -0,0 +1,253 @@
+"""
+Boot image access for the MOP daemon.
+
+This is the Python counterpart of file.c in the C mopd. Images are
+mapped into memory once and handed out as memoryview slices, so every
+load session reads the same page-cache pages and no data is copied
+until the kernel puts it on the wire.
+"""
+
+import ctypes
+import ctypes.util
+import mmap
+import os
+import struct
+from collections import OrderedDict
+
+from moploader import mop_parse_header
+
+class MopImage:
+    """A boot image mapped read-only into memory."""
+
+    def __init__(self, path):
+        self.path = path
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+            self.ident = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+            # A private mapping shares the page cache like a read-only one,
+            # but its views are writable, which ctypes needs to hand their
+            # addresses to sendmmsg(). Nothing ever writes to it.
+            self.mm = mmap.mmap(fd, 0, access=mmap.ACCESS_COPY)
+        finally:
+            os.close(fd)
+        self.mm.madvise(mmap.MADV_WILLNEED)
+        self.view = memoryview(self.mm)
+        self.header = mop_parse_header(self.view)
+        self.size = self.header.size
+        self.plans = OrderedDict()  # data size -> LoadPlan, least recently used first
+
+    def close(self):
+        """Unmaps the image; outstanding slices keep the mapping alive."""
+        try:
+            self.view.release()
+            self.mm.close()
+        except BufferError:
+            pass
+
+# Images already mapped, keyed by path
+_images = {}
+
+def mop_open_image(path):
+    """
+    Returns the MopImage for path, mapping it on first use.
+    A file replaced on disk since it was mapped is mapped again.
+    """
+    st = os.stat(path)
+    ident = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    image = _images.get(path)
+    if image is None or image.ident != ident:
+        image = MopImage(path)
+        _images[path] = image
+    return image
+
+def mop_find_image(mop_dir, name):
+    """
+    Resolves a program name (or a hex MAC address) to an image path in
+    the MOP directory, trying the name as given, upper- and lowercase.
+    The name comes off the wire, so one that could reach outside the
+    directory finds nothing.
+    """
+    if not name or "/" in name or "\0" in name or ".." in name:
+        return None
+    for candidate in (name, name.upper(), name.lower()):
+        path = os.path.join(mop_dir, f"{candidate}.SYS")
+        if os.path.isfile(path):
+            return path
+    return None
+
+# --- Directory Index ---
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+IN_WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                 IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+def _inotify_libc():
+    """Returns libc with the inotify calls, or None if unavailable."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+class MopImageEntry:
+    """An indexed image name and the mapped image it resolves to."""
+    __slots__ = ("key", "path", "realpath", "image")
+
+    def __init__(self, key, path, realpath, image):
+        self.key = key
+        self.path = path
+        self.realpath = realpath
+        self.image = image
+
+class MopDirectory:
+    """
+    In-memory index of the MOP directory.
+
+    Maps program names and hex MAC addresses (the part before .SYS,
+    uppercased) to mapped images, so a boot request never touches the
+    filesystem. Names that are symlinks to the same file share one
+    mapping. inotify on the directory, and on the directories symlink
+    targets live in, keeps the index current: a file that is replaced,
+    rewritten or removed is dropped or remapped before the next lookup
+    can see it.
+    """
+
+    def __init__(self, mop_dir):
+        self.mop_dir = os.path.abspath(mop_dir)
+        self.entries = {}
+        self.images = {}          # (st_dev, st_ino) -> MopImage
+        self.watches = {}         # wd -> watched directory
+        self.watched = {}         # watched directory -> wd
+        self.fd = -1
+        self.libc = _inotify_libc()
+        if self.libc is not None:
+            self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        self.rebuild()
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def lookup(self, name):
+        """Returns the MopImage for a program name or hex MAC, or None."""
+        if self.fd < 0:
+            # Without inotify the index cannot be trusted; go to disk
+            path = mop_find_image(self.mop_dir, name)
+            return mop_open_image(path) if path else None
+        entry = self.entries.get(name.upper())
+        return entry.image if entry is not None else None
+
+    def rebuild(self):
+        """Reindexes the whole directory."""
+        self.entries.clear()
+        self.images.clear()
+        self._watch(self.mop_dir)
+        try:
+            names = os.listdir(self.mop_dir)
+        except OSError:
+            names = []
+        for name in names:
+            self._index(name)
+
+    def _watch(self, directory):
+        if self.fd < 0 or directory in self.watched:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_WATCH_MASK)
+        if wd >= 0:
+            self.watches[wd] = directory
+            self.watched[directory] = wd
+
+    def _index(self, name):
+        """(Re)indexes one directory entry, dropping it if unusable."""
+        stem, ext = os.path.splitext(name)
+        if ext.upper() != ".SYS":
+            return
+        key = stem.upper()
+        self.entries.pop(key, None)
+        path = os.path.join(self.mop_dir, name)
+        try:
+            realpath = os.path.realpath(path)
+            st = os.stat(realpath)
+            ident = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+            image = self.images.get(ident[:2])
+            if image is None or image.ident != ident:
+                image = MopImage(realpath)
+                self.images[ident[:2]] = image
+        except (OSError, ValueError):
+            return
+        self._watch(os.path.dirname(realpath))
+        self.entries[key] = MopImageEntry(key, path, realpath, image)
+
+    def process_events(self):
+        """Applies pending inotify events to the index."""
+        if self.fd < 0:
+            return
+        try:
+            buf = os.read(self.fd, 65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        changed = set()
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = _INOTIFY_EVENT.unpack_from(buf, offset)
+            offset += _INOTIFY_EVENT.size
+            name = buf[offset:offset + length].rstrip(b"\0").decode(errors="surrogateescape")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.rebuild()
+                return
+            directory = self.watches.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                self.watched.pop(directory, None)
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                if directory == self.mop_dir:
+                    del self.watches[wd]
+                    del self.watched[directory]
+                    self.rebuild()
+                    return
+                changed.update(e.path for e in self.entries.values()
+                               if os.path.dirname(e.realpath) == directory)
+                continue
+            changed.add(os.path.join(directory, name))
+        for path in changed:
+            self._invalidate(path)
+
+    def _invalidate(self, path):
+        """Reindexes the entry at path and every name linked to it."""
+        names = {os.path.basename(e.path) for e in self.entries.values()
+                 if e.realpath == path or e.path == path}
+        if os.path.dirname(path) == self.mop_dir:
+            names.add(os.path.basename(path))
+        for name in names:
+            self._index(name)
+        # Forget mappings no entry refers to any more
+        live = {id(e.image) for e in self.entries.values()}
+        for ident, image in list(self.images.items()):
+            if id(image) not in live:
+                del self.images[ident]
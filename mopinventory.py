@@ -0,0 +1,314 @@
+"""
+Device inventory for the MOP daemon.
+
+Every MOP device announces itself every eight to twelve minutes with a
+System ID message to the Remote Console multicast address, giving its
+hardware address, device type, maintenance version and ECO level, what
+it can do and the software it runs, and answers Request Counters with
+its data link counters. MopInventory keeps what these say in a table
+of one record per device address. Devices that keep counters are polled
+for them once per interval, each at a point in the interval fixed by
+its address, and never more than a few requests per tick; a site full
+of terminals is polled evenly across the interval, whenever the daemon
+was started.
+
+The table is kept in memory and in an append-only file of one JSON
+record per line: a changed record is appended and the last line for an
+address wins, so loading it back takes milliseconds. Once the file has
+twice as many lines as devices it is rewritten with one per device.
+Records are replaced and never changed in place, so TCP sessions on
+other threads read the table as it stands without locking, and a query
+never touches the network.
+"""
+
+import heapq
+import json
+import os
+import time
+
+from mopcodec import (
+    MOP_K_CODE_CNT, MOP_K_CODE_RQC, MOP_K_CODE_SID, MOP_K_INFO_DEVTYPE, MOP_K_INFO_DLBSZ,
+    MOP_K_INFO_DLTY, MOP_K_INFO_HWA, MOP_K_INFO_MFCT, MOP_K_INFO_PRTY, MOP_K_INFO_SFID,
+    MOP_K_INFO_VER, MOP_K_PROTO_RC, MOP_K_TRANS_ETHER, MOP_COUNTER_NAMES, mop_eaddr_bytes,
+    mop_eaddr_str, mop_frame, mop_parse_counters, mop_parse_sid,
+)
+
+# Where the inventory is kept, with --inventory
+MOP_INVENTORY_PATH = "/var/lib/mop/inventory.log"
+# Seconds between counter polls of each device, with --counter-interval
+MOP_INVENTORY_POLL_INTERVAL = 3600
+# Request Counters sent per tick at most, across all devices
+MOP_INVENTORY_POLL_BATCH = 4
+MOP_INVENTORY_POLL_TICK = 1.0
+# Devices not heard from for this long are not polled until they are back
+MOP_INVENTORY_STALE = 3600
+MOP_INVENTORY_MAX_DEVICES = 4096
+# Lines per device the file may have before it is rewritten
+MOP_INVENTORY_COMPACT = 2
+MOP_INVENTORY_COMPACT_MIN = 1024
+
+# Bits of the Functions field, lowest first
+MOP_FUNCTION_NAMES = ("loop", "dump", "primary loader", "multi-block loader", "boot",
+                      "console carrier", "counters", "console reserved")
+_FUNC_COUNTERS = 0x40
+
+_SFID_NAMES = {0: "none", 0xfe: "maintenance system", 0xff: "standard operating system"}
+
+def mop_inventory_sid(info):
+    """Decodes the System ID information fields the inventory keeps."""
+    fields = {}
+    ver = info.get(MOP_K_INFO_VER)
+    if ver is not None and len(ver) == 3:
+        fields["version"] = "%d.%d.%d" % tuple(ver)  # Version, ECO, user ECO
+    for itype, name in ((MOP_K_INFO_DEVTYPE, "devtype"), (MOP_K_INFO_PRTY, "processor"),
+                        (MOP_K_INFO_DLTY, "datalink")):
+        value = info.get(itype)
+        if value is not None and len(value) == 1:
+            fields[name] = value[0]
+    for itype, name in ((MOP_K_INFO_MFCT, "functions"), (MOP_K_INFO_DLBSZ, "buffer_size")):
+        value = info.get(itype)
+        if value is not None and len(value) == 2:
+            fields[name] = int.from_bytes(value, "little")
+    hwa = info.get(MOP_K_INFO_HWA)
+    if hwa is not None and len(hwa) == 6:
+        fields["hwaddr"] = mop_eaddr_str(hwa)
+    sfid = info.get(MOP_K_INFO_SFID)
+    if sfid:
+        if sfid[0] in _SFID_NAMES:
+            fields["software"] = _SFID_NAMES[sfid[0]]
+        else:
+            fields["software"] = sfid[1:1 + sfid[0]].decode("ascii", "replace")
+    return fields
+
+def mop_inventory_load(path):
+    """
+    Reads an inventory file. Returns (records by address, lines read,
+    whether the last line was cut short).
+    """
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}, 0, False
+    devices = {}
+    lines = data.decode("utf-8", "replace").splitlines()
+    for line in lines:
+        try:
+            record = json.loads(line)
+            devices[mop_eaddr_bytes(record["address"])] = record
+        except (ValueError, KeyError, TypeError, AttributeError):
+            continue              # Left half written by a crash
+    return devices, len(lines), bool(data) and not data.endswith(b"\n")
+
+def _when(t):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t)) if t else "-"
+
+def mop_inventory_summary(record):
+    """One line about a device, for listings."""
+    return (f"{record['address']}  {record.get('interface', '-'):10} "
+            f"type {record.get('devtype', '-'):>3}  V{record.get('version', '-'):8} "
+            f"{record.get('software', '-'):20}  seen {_when(record.get('last_seen'))}")
+
+def mop_inventory_detail(record):
+    """Everything known about a device, a line per item."""
+    functions = record.get("functions")
+    if functions is not None:
+        functions = ", ".join(name for bit, name in enumerate(MOP_FUNCTION_NAMES)
+                              if functions & (1 << bit)) or "none"
+    lines = [f"Device {record['address']} on {record.get('interface', '-')}"]
+    for label, value in (("Hardware address", record.get("hwaddr")),
+                         ("Device type", record.get("devtype")),
+                         ("Maintenance version", record.get("version")),
+                         ("Functions", functions),
+                         ("Software", record.get("software")),
+                         ("Processor", record.get("processor")),
+                         ("Data link", record.get("datalink")),
+                         ("Buffer size", record.get("buffer_size")),
+                         ("First seen", _when(record.get("first_seen"))),
+                         ("Last seen", _when(record.get("last_seen")))):
+        if value is not None:
+            lines.append(f"  {label:20} {value}")
+    counters = record.get("counters")
+    if counters:
+        lines.append(f"  {'Counters at':20} {_when(record.get('counters_time'))}")
+        lines.extend(f"    {name:26} {value}" for name, value in zip(MOP_COUNTER_NAMES, counters))
+    return "\n".join(lines)
+
+class MopInventory:
+    """
+    The devices heard on the daemon's interfaces, driven from the packet
+    loop. Only report() may be called from other threads.
+    """
+
+    def __init__(self, path, interfaces, interval=MOP_INVENTORY_POLL_INTERVAL, log=None):
+        self.path = path
+        self.interfaces = interfaces  # name -> InterfaceInfo, kept current by the daemon
+        self.interval = interval
+        self.log = log
+        self.fd = -1
+        self.devices, self.lines, torn = mop_inventory_load(path)
+        self.polls = []               # heap of (due, address), one entry per device
+        self.receipts = {}            # address -> receipt of the Request Counters unanswered
+        self.receipt = 0
+        self.next_tick = 0.0
+        if torn or self.crowded():
+            self.compact()
+        else:
+            self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        now = time.time()
+        for address in self.devices:
+            self.schedule(address, now)
+
+    def __len__(self):
+        return len(self.devices)
+
+    # --- File ---
+
+    def append(self, record):
+        try:
+            os.write(self.fd, json.dumps(record, separators=(",", ":")).encode() + b"\n")
+        except OSError as e:
+            if self.log is not None:
+                self.log.error("Cannot write inventory %s: %s", self.path, e)
+            return
+        self.lines += 1
+        if self.crowded():
+            try:
+                self.compact()
+            except OSError as e:
+                if self.log is not None:
+                    self.log.error("Cannot rewrite inventory %s: %s", self.path, e)
+
+    def crowded(self):
+        return self.lines > max(MOP_INVENTORY_COMPACT_MIN, MOP_INVENTORY_COMPACT * len(self.devices))
+
+    def compact(self):
+        """Rewrites the file with one line per device."""
+        tmp = self.path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC, 0o644)
+        try:
+            data = b"".join(json.dumps(record, separators=(",", ":")).encode() + b"\n"
+                            for record in self.devices.values())
+            with memoryview(data) as view:
+                while view:
+                    view = view[os.write(fd, view):]
+            os.fsync(fd)
+            os.replace(tmp, self.path)
+        except OSError:
+            os.close(fd)
+            raise
+        if self.fd >= 0:
+            os.close(self.fd)
+        self.fd = fd
+        self.lines = len(self.devices)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    # --- Packet loop ---
+
+    def receive(self, iface, src, trans, msg):
+        """Takes in a System ID or Counters message from any device."""
+        code = msg[0]
+        if code == MOP_K_CODE_SID:
+            sid = mop_parse_sid(msg)
+            if sid is not None:
+                self.update(iface, src, trans, mop_inventory_sid(sid[1]))
+        elif code == MOP_K_CODE_CNT:
+            cnt = mop_parse_counters(msg)
+            if cnt is None or self.receipts.get(bytes(src)) != cnt[0]:
+                return
+            del self.receipts[bytes(src)]
+            # Kept as a list in MOP_COUNTER_NAMES order, to keep the file small
+            self.update(iface, src, trans, {"counters": list(cnt[1].values()),
+                                            "counters_time": int(time.time())})
+
+    def update(self, iface, src, trans, fields):
+        address = bytes(src)
+        now = int(time.time())
+        old = self.devices.get(address)
+        if old is None:
+            if len(self.devices) >= MOP_INVENTORY_MAX_DEVICES:
+                return
+            record = {"address": mop_eaddr_str(address), "first_seen": now}
+            self.schedule(address, now)
+            if self.log is not None:
+                self.log.info("%s (%s): new device, type %s, software %s", record["address"],
+                              iface.name, fields.get("devtype", "unknown"),
+                              fields.get("software", "unknown"), extra={"source": address})
+        else:
+            record = dict(old)
+        record.update(fields, interface=iface.name, trans=trans, last_seen=now)
+        self.devices[address] = record
+        self.append(record)
+
+    def schedule(self, address, now):
+        """Queues the first counter poll of a device, at its point in the interval."""
+        if not self.interval:
+            return
+        phase = int.from_bytes(address, "big") * 2654435761 % 2**32 / 2**32 * self.interval
+        due = now - now % self.interval + phase
+        if due <= now:
+            due += self.interval
+        heapq.heappush(self.polls, (due, address))
+
+    def poll(self, address, now):
+        """Sends Request Counters to a device, if it is around and keeps them."""
+        record = self.devices[address]
+        iface = self.interfaces.get(record.get("interface"))
+        if iface is None or now - record["last_seen"] > MOP_INVENTORY_STALE:
+            return False
+        if not record.get("functions", _FUNC_COUNTERS) & _FUNC_COUNTERS:
+            return False
+        self.receipt = self.receipt % 0xffff + 1
+        self.receipts[address] = self.receipt
+        iface.send(mop_frame(address, iface.hwaddr, MOP_K_PROTO_RC,
+                             record.get("trans", MOP_K_TRANS_ETHER),
+                             bytes((MOP_K_CODE_RQC,)) + self.receipt.to_bytes(2, "little")))
+        return True
+
+    def expire(self):
+        """Sends the counter polls that are due, a batch per tick."""
+        now = time.time()
+        if now < self.next_tick:
+            return
+        sent = 0
+        polls = self.polls
+        while polls and polls[0][0] <= now and sent < MOP_INVENTORY_POLL_BATCH:
+            due, address = polls[0]
+            while due <= now:
+                due += self.interval
+            heapq.heapreplace(polls, (due, address))
+            if self.poll(address, now):
+                sent += 1
+        if sent:
+            self.next_tick = now + MOP_INVENTORY_POLL_TICK
+
+    def timeout(self):
+        if not self.polls:
+            return None
+        return max(0.0, max(self.polls[0][0], self.next_tick) - time.time())
+
+    # --- Queries ---
+
+    def report(self, words):
+        """
+        Answers SHOW from a TCP client: a line per device, or all that is
+        known about the devices whose addresses are given.
+        """
+        if not words:
+            records = sorted(list(self.devices.values()), key=lambda r: r["address"])
+            lines = [mop_inventory_summary(record) for record in records]
+            lines.append(f"{len(records)} devices")
+            return "\n".join(lines) + "\n"
+        lines = []
+        for word in words:
+            try:
+                record = self.devices.get(mop_eaddr_bytes(word))
+            except ValueError:
+                record = None
+            lines.append(mop_inventory_detail(record) if record is not None
+                         else f"No device {word}")
+        return "\n".join(lines) + "\n"
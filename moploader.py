@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Boot image headers and precompiled load plans.
+
+An image header is parsed once, when the image is mapped. For every data
+size a client negotiates, the image is cut into a load plan: a table of
+(file offset, length, load address, load number) rows plus the Memory
+Load message header for each row, so serving a frame is an index into
+the plan and a memoryview slice of the mapped file. Each image keeps
+the plans for the few data sizes used most recently.
+
+Run as a script to validate images and dump their plans:
+
+    moploader.py check files/*.SYS
+    moploader.py dump -n 1000 files/VXTLDR021.SYS
+"""
+
+import argparse
+import struct
+import sys
+from array import array
+
+from mopcodec import MOP_K_CODE_MLD, MOP_DEFAULT_DATA_SIZE, MLD_HDR
+
+# Load plans cached per image; sessions keep their own plan alive
+MOP_PLAN_CACHE_SIZE = 4
+
+# VAX/VMS image header offsets (see GetVaxInfo() in the C mopd)
+IHD_W_SIZE = 0
+IHD_W_ACTIVOFF = 2
+IHD_B_HDRBLKCNT = 16
+IHA_L_TFRADR1 = 0
+ISD_W_SIZE = 0
+ISD_W_PAGCNT = 2
+ISD_V_VPN = 4
+ISD_M_VPN = 0x1fffff
+ISD_L_VBN = 12
+
+VAX_BLOCK_SIZE = 512
+
+_U8 = struct.Struct("<B")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+
+class ImageSection:
+    """One image section descriptor from a VAX image header."""
+    __slots__ = ("pagcnt", "vpn", "vbn")
+
+    def __init__(self, pagcnt, vpn, vbn):
+        self.pagcnt = pagcnt
+        self.vpn = vpn
+        self.vbn = vbn
+
+class ImageHeader:
+    """Where an image's loadable data sits and where it goes."""
+
+    def __init__(self, kind, load_addr, xfr_addr, offset, size, sections=()):
+        self.kind = kind              # "vax" or "raw"
+        self.load_addr = load_addr
+        self.xfr_addr = xfr_addr
+        self.offset = offset          # File offset of the loadable data
+        self.size = size
+        self.sections = list(sections)
+
+def mop_parse_vax_sections(view, isd):
+    """Walks the image section descriptors that start at offset isd."""
+    sections = []
+    while isd + ISD_L_VBN + 4 <= VAX_BLOCK_SIZE:
+        size = _U16.unpack_from(view, isd + ISD_W_SIZE)[0]
+        if size == 0 or size == 0xffff:
+            break
+        sections.append(ImageSection(
+            _U16.unpack_from(view, isd + ISD_W_PAGCNT)[0],
+            _U32.unpack_from(view, isd + ISD_V_VPN)[0] & ISD_M_VPN,
+            _U32.unpack_from(view, isd + ISD_L_VBN)[0]))
+        isd += size
+    return sections
+
+def mop_parse_header(view):
+    """
+    Parses the header of an image held in a buffer.
+    VAX images are laid out as the C mopd does it: the pages counted by
+    the first section descriptor, following the header blocks, load at
+    that section's address. Anything else is loaded raw at address zero.
+    """
+    raw = ImageHeader("raw", 0, 0, 0, len(view))
+    if len(view) < VAX_BLOCK_SIZE:
+        return raw
+    isd = _U16.unpack_from(view, IHD_W_SIZE)[0]
+    iha = _U16.unpack_from(view, IHD_W_ACTIVOFF)[0]
+    hbcnt = _U8.unpack_from(view, IHD_B_HDRBLKCNT)[0]
+    if isd % 2 or iha % 2 or hbcnt == 0:
+        return raw
+    if isd + 8 > VAX_BLOCK_SIZE or iha + 4 > VAX_BLOCK_SIZE:
+        return raw
+    pagcnt = _U16.unpack_from(view, isd + ISD_W_PAGCNT)[0]
+    vpn = _U32.unpack_from(view, isd + ISD_V_VPN)[0] & ISD_M_VPN
+    xfr_addr = _U32.unpack_from(view, iha + IHA_L_TFRADR1)[0] & 0x7fffffff
+    offset = hbcnt * VAX_BLOCK_SIZE
+    size = min(pagcnt * VAX_BLOCK_SIZE, len(view) - offset)
+    if size <= 0:
+        return raw
+    return ImageHeader("vax", vpn * VAX_BLOCK_SIZE, xfr_addr, offset, size,
+                       mop_parse_vax_sections(view, isd))
+
+class LoadPlan:
+    """
+    The Memory Load frames for one image at one data size.
+    Row i is sent as load number i modulo 256; after the last row the
+    client gets a Memory Load with Transfer Address for end_addr.
+    """
+    __slots__ = ("data_size", "count", "offsets", "lengths", "addresses",
+                 "loadnums", "headers", "end_addr", "xfr_addr")
+
+    def __init__(self, header, data_size):
+        self.data_size = data_size
+        self.offsets = array("I", range(header.offset, header.offset + header.size, data_size))
+        self.count = len(self.offsets)
+        self.lengths = array("I", [data_size] * self.count)
+        if self.count:
+            self.lengths[-1] = header.offset + header.size - self.offsets[-1]
+        self.addresses = array("I", (header.load_addr + off - header.offset for off in self.offsets))
+        self.loadnums = array("B", (i & 0xff for i in range(self.count)))
+        self.headers = bytearray(MLD_HDR.size * self.count)
+        for i in range(self.count):
+            MLD_HDR.pack_into(self.headers, i * MLD_HDR.size,
+                              MOP_K_CODE_MLD, self.loadnums[i], self.addresses[i])
+        self.end_addr = header.load_addr + header.size
+        self.xfr_addr = header.xfr_addr
+
+    def header(self, i):
+        """Returns the Memory Load message header for row i."""
+        return memoryview(self.headers)[i * MLD_HDR.size:(i + 1) * MLD_HDR.size]
+
+def mop_load_plan(image, data_size):
+    """Returns the cached load plan of a MopImage for a data size."""
+    plan = image.plans.get(data_size)
+    if plan is None:
+        plan = LoadPlan(image.header, data_size)
+        image.plans[data_size] = plan
+        if len(image.plans) > MOP_PLAN_CACHE_SIZE:
+            image.plans.popitem(last=False)
+    else:
+        image.plans.move_to_end(data_size)
+    return plan
+
+def mop_check_header(header, file_size):
+    """Returns a list of problems with a parsed image header."""
+    problems = []
+    if header.kind == "raw":
+        problems.append("no VAX image header, image will be loaded raw at 0")
+    if header.offset + header.size > file_size:
+        problems.append("loadable data runs past the end of the file")
+    if header.kind == "vax" and header.size % VAX_BLOCK_SIZE:
+        problems.append("image is shorter than its section descriptor says")
+    for n, section in enumerate(header.sections):
+        if section.vbn and (section.vbn - 1 + section.pagcnt) * VAX_BLOCK_SIZE > file_size:
+            problems.append(f"section {n} runs past the end of the file")
+    if header.size == 0:
+        problems.append("image is empty")
+    return problems
+
+# --- Command Line ---
+
+def cmd_check(args):
+    from mopfile import MopImage
+    status = 0
+    for path in args.images:
+        try:
+            image = MopImage(path)
+        except (OSError, ValueError) as e:
+            print(f"{path}: cannot map: {e}")
+            status = 1
+            continue
+        problems = mop_check_header(image.header, len(image.mm))
+        for problem in problems:
+            print(f"{path}: {problem}")
+        if not problems:
+            print(f"{path}: ok")
+        elif image.header.kind == "vax":
+            status = 1
+    return status
+
+def cmd_dump(args):
+    from mopfile import MopImage
+    image = MopImage(args.image)
+    header = image.header
+    plan = mop_load_plan(image, args.data_size)
+    print(f"image:     {args.image}")
+    print(f"format:    {header.kind}")
+    print(f"load:      {header.load_addr:#010x}")
+    print(f"transfer:  {header.xfr_addr:#010x}")
+    print(f"data:      {header.size} bytes at file offset {header.offset:#x}")
+    for n, section in enumerate(header.sections):
+        print(f"section {n}: {section.pagcnt} pages, vpn {section.vpn:#x}, vbn {section.vbn}")
+    print(f"plan:      {plan.count} frames of up to {plan.data_size} bytes")
+    if args.frames:
+        print(f"{'frame':>6} {'load':>4} {'offset':>10} {'length':>6} {'address':>10}")
+        for i in range(plan.count):
+            print(f"{i:6} {plan.loadnums[i]:4} {plan.offsets[i]:#10x} "
+                  f"{plan.lengths[i]:6} {plan.addresses[i]:#010x}")
+    print(f"final:     transfer to {plan.xfr_addr:#010x}, load number {plan.count & 0xff}")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate and dump MOP boot images")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("check", help="Validate image headers")
+    p.add_argument("images", nargs="+")
+    p.set_defaults(func=cmd_check)
+    p = sub.add_parser("dump", help="Print an image header and its load plan")
+    p.add_argument("-n", dest="data_size", type=int, default=MOP_DEFAULT_DATA_SIZE,
+                   help="Data size per Memory Load frame")
+    p.add_argument("-F", dest="frames", action="store_true",
+                   help="List every frame of the plan")
+    p.add_argument("image")
+    p.set_defaults(func=cmd_dump)
+    args = parser.parse_args()
+    if args.command == "dump" and args.data_size <= 0:
+        parser.error("data size must be positive")
+    sys.exit(args.func(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Logging for the MOP daemons.
+
+Both daemons log through a QueueHandler: the packet loop and the socket
+handlers only put records on an in-memory queue, and a QueueListener
+thread formats them and writes them to syslog or the log file. Records
+are formatted by the listener, so callers pass %-style arguments rather
+than f-strings and pay nothing for messages that are filtered out.
+
+Records logged with extra={"source": ...} (a client's Ethernet or IP
+address) are rate limited per source and message, so one misbehaving
+client in a boot storm cannot flood the log; the first record let
+through after a quiet spell says how many similar ones were suppressed.
+Debug mode turns the rate limit off and lets per-packet tracing through.
+"""
+
+import atexit
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+# Records waiting for the listener; more than this and new ones are dropped
+MOP_LOG_QUEUE_SIZE = 10000
+# Records let through per source and message in each interval
+MOP_LOG_RATE = 5
+MOP_LOG_INTERVAL = 10.0
+# Sources tracked before idle ones are forgotten
+MOP_LOG_MAX_SOURCES = 4096
+
+class MopRateLimitFilter(logging.Filter):
+    """
+    Lets through at most rate records per (source, message) in each
+    interval. Records without a source are never limited.
+    """
+
+    def __init__(self, rate=MOP_LOG_RATE, interval=MOP_LOG_INTERVAL,
+                 max_sources=MOP_LOG_MAX_SOURCES):
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        self.max_sources = max_sources
+        self.windows = {}         # (source, msg) -> [start, count, suppressed]
+
+    def filter(self, record):
+        source = getattr(record, "source", None)
+        if source is None:
+            return True
+        key = (source, record.msg)
+        window = self.windows.get(key)
+        if window is None or record.created - window[0] >= self.interval:
+            suppressed = window[2] if window is not None else 0
+            if window is None and len(self.windows) >= self.max_sources:
+                self.prune(record.created)
+            self.windows[key] = [record.created, 1, 0]
+            if suppressed:
+                record.msg = f"{record.getMessage()} ({suppressed} similar messages suppressed)"
+                record.args = None
+            return True
+        if window[1] < self.rate:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+    def prune(self, now):
+        """Forgets windows that have run out."""
+        for key, window in list(self.windows.items()):
+            if now - window[0] >= self.interval:
+                del self.windows[key]
+
+class MopQueueHandler(QueueHandler):
+    """
+    A QueueHandler that leaves formatting to the listener and drops
+    records rather than block when the listener falls behind.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The queue never leaves the process, so the record can travel as is
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+_handler = None
+_listener = None
+
+def _start_listener(handlers):
+    global _listener
+    _handler.queue = queue.Queue(MOP_LOG_QUEUE_SIZE)
+    _listener = QueueListener(_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+def _restart_in_child():
+    # The listener thread does not survive fork(); give the child its own
+    if _listener is not None:
+        _start_listener(_listener.handlers)
+
+def mop_log_start(handlers, level=logging.INFO, debug=False):
+    """
+    Routes all logging through a queue to handlers, written out by a
+    listener thread. With debug, everything down to DEBUG is logged and
+    nothing is rate limited.
+    """
+    global _handler
+    if _handler is not None:
+        mop_log_stop()
+    _handler = MopQueueHandler(None)
+    if not debug:
+        _handler.addFilter(MopRateLimitFilter())
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(_handler)
+    root.setLevel(logging.DEBUG if debug else level)
+    _start_listener(handlers)
+
+def mop_log_stop():
+    """Writes out the records still queued and stops the listener."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+os.register_at_fork(after_in_child=_restart_in_child)
+atexit.register(mop_log_stop)
@@ -0,0 +1,208 @@
+"""
+Counters and latency histograms for the MOP daemons.
+
+Metrics are plain Python objects bumped inline from the packet loop and
+the socket handlers: a counter increment is one attribute update and a
+histogram observation one bisect over fixed bucket bounds, so they can
+stay on at full packet rate. A labelled metric hands out one child per
+label combination; callers keep the children they use per packet rather
+than look them up every time.
+
+mop_metrics_text() renders everything in the Prometheus text format,
+which mop_metrics_serve() offers over HTTP and the daemons also log on
+SIGUSR1. State too fine-grained for metrics, such as each load in
+progress, is published with mop_metrics_document() and served as JSON
+next to them.
+"""
+
+import json
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Bucket bounds in seconds for per-message handling times
+MOP_LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                       0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+# Bucket bounds in seconds for whole operations such as an image load
+MOP_DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0,
+                        2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Every metric created, in creation order
+_metrics = []
+# JSON documents served besides the metrics, encoded, by path
+_documents = {}
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names, values, extra=""):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+class CounterValue:
+    """One counter, or one label combination of a counter."""
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+class HistogramValue:
+    """Bucket counts and sum of one histogram or label combination."""
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+class Metric:
+    """A named metric family with optional labels."""
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        _metrics.append(self)
+
+    def labels(self, *values):
+        """Returns the child for one combination of label values."""
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.new_child()
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in list(self.children.items()):
+            lines.extend(self.render_child(values, child))
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        if not self.labelnames:
+            self.inc = self.labels().inc
+
+    def new_child(self):
+        return CounterValue()
+
+    def render_child(self, values, child):
+        yield f"{self.name}{_labels(self.labelnames, values)} {_number(child.value)}"
+
+class Gauge(Metric):
+    """
+    A value that goes up and down, or one read from fn whenever the
+    metrics are rendered.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, fn=None):
+        super().__init__(name, help)
+        self.fn = fn
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def render(self):
+        value = self.fn() if self.fn is not None else self.value
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}",
+                f"{self.name} {_number(value)}"]
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=MOP_LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+        if not self.labelnames:
+            self.observe = self.labels().observe
+
+    def new_child(self):
+        return HistogramValue(self.bounds)
+
+    def render_child(self, values, child):
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), child.counts):
+            total += count
+            le = f'le="{_number(bound)}"'
+            yield f"{self.name}_bucket{_labels(self.labelnames, values, le)} {total}"
+        yield f"{self.name}_sum{_labels(self.labelnames, values)} {_number(child.sum)}"
+        yield f"{self.name}_count{_labels(self.labelnames, values)} {total}"
+
+def mop_metrics_text():
+    """Returns every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+def mop_metrics_document(path, data):
+    """
+    Publishes data to be served as JSON at path, replacing what was
+    there. It is encoded here, so the server threads never see it change.
+    """
+    _documents[path] = json.dumps(data).encode()
+
+def mop_metrics_log(logger):
+    """Writes the current metric values to a logger, one sample per record."""
+    for line in mop_metrics_text().splitlines():
+        if not line.startswith("#"):
+            logger.info("%s", line)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path in ("/", "/metrics"):
+            body = mop_metrics_text().encode()
+            content_type = "text/plain; version=0.0.4"
+        elif self.path in _documents:
+            body = _documents[self.path]
+            content_type = "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def mop_metrics_serve(port, host="127.0.0.1", sock=None):
+    """
+    Serves the metrics at http://host:port/metrics, and the published
+    documents beside them, from a background thread, out of the way of
+    the packet loop. A listening socket handed
+    over by a reload is served instead of binding a new one. Returns the
+    server.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler, bind_and_activate=sock is None)
+    if sock is not None:
+        server.socket.close()
+        server.socket = sock
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,178 @@
+"""
+Packet capture files for the MOP daemon.
+
+MopPcapWriter records frames to a ring of classic pcap files, readable
+by tcpdump and Wireshark. The capture loop only copies each frame onto
+an in-memory queue; a writer thread does the file I/O, so a slow disk
+costs recorded frames rather than boot traffic. When the current file
+would grow past max_bytes it is renamed to path.1 (path.1 to path.2,
+and so on) and a new one started, keeping at most max_files files.
+
+mop_pcap_read() reads a capture back for offline replay.
+"""
+
+import os
+import queue
+import struct
+import threading
+import time
+
+PCAP_MAGIC = 0xa1b2c3d4          # Microsecond timestamps
+PCAP_MAGIC_NSEC = 0xa1b23c4d     # Nanosecond timestamps
+PCAP_LINKTYPE_ETHERNET = 1
+PCAP_SNAPLEN = 65535
+
+# Frames waiting for the writer thread; more than this and new ones are dropped
+MOP_PCAP_QUEUE_SIZE = 10000
+# Default ring: four files of 16 MB
+MOP_PCAP_MAX_BYTES = 16 * 1024 * 1024
+MOP_PCAP_MAX_FILES = 4
+# Seconds the writer lets data sit in its buffer while the queue is idle
+MOP_PCAP_FLUSH_INTERVAL = 1.0
+# Seconds close() waits for the writer to finish
+MOP_PCAP_CLOSE_TIMEOUT = 5.0
+
+_FILE_HDR = struct.Struct("<IHHiIII")
+_REC_HDR = struct.Struct("<IIII")
+
+class MopPcapWriter:
+    """
+    A size- and count-bounded ring of pcap files, written by a thread.
+    With keep, an existing file is moved along the ring rather than
+    overwritten. A file that cannot be written or opened costs the
+    frames meant for it; the writer tries again with the next frame.
+    """
+
+    def __init__(self, path, max_bytes=MOP_PCAP_MAX_BYTES, max_files=MOP_PCAP_MAX_FILES,
+                 keep=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_files = max(1, max_files)
+        self.queue = queue.Queue(MOP_PCAP_QUEUE_SIZE)
+        self.dropped = 0
+        self.written = 0
+        self.file = None
+        self.size = 0
+        self.stopping = threading.Event()
+        if keep and os.path.exists(path):
+            self.shift()
+        self.open()
+        self.thread = threading.Thread(target=self.run, name="pcap", daemon=True)
+        self.thread.start()
+
+    def write(self, frame, ts=None):
+        """Queues a copy of frame; never blocks."""
+        try:
+            self.queue.put_nowait((time.time() if ts is None else ts, bytes(frame)))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Writes out the frames still queued and closes the file."""
+        if self.thread is not None:
+            # The writer also stops once the queue runs dry, so a full
+            # queue need not take the sentinel
+            self.stopping.set()
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                pass
+            self.thread.join(MOP_PCAP_CLOSE_TIMEOUT)
+            self.thread = None
+
+    # --- Writer thread ---
+
+    def open(self):
+        self.size = 0
+        self.file = open(self.path, "wb", buffering=256 * 1024)
+        self.file.write(_FILE_HDR.pack(PCAP_MAGIC, 2, 4, 0, 0, PCAP_SNAPLEN,
+                                       PCAP_LINKTYPE_ETHERNET))
+        self.size = _FILE_HDR.size
+
+    def shift(self):
+        names = [self.path] + [f"{self.path}.{n}" for n in range(1, self.max_files)]
+        for older, newer in zip(reversed(names[:-1]), reversed(names[1:])):
+            if os.path.exists(older):
+                os.replace(older, newer)
+
+    def rotate(self):
+        file, self.file = self.file, None
+        file.close()
+        self.shift()
+        self.open()
+
+    def record(self, ts, frame):
+        if self.file is None:
+            self.open()
+        length = _REC_HDR.size + len(frame)
+        if self.size + length > self.max_bytes and self.size > _FILE_HDR.size:
+            self.rotate()
+        sec = int(ts)
+        self.file.write(_REC_HDR.pack(sec, int((ts - sec) * 1000000), len(frame), len(frame)))
+        self.file.write(frame)
+        self.size += length
+        self.written += 1
+
+    def flush(self):
+        if self.file is not None:
+            try:
+                self.file.flush()
+            except (OSError, ValueError):
+                pass
+
+    def run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=MOP_PCAP_FLUSH_INTERVAL)
+            except queue.Empty:
+                if self.stopping.is_set():
+                    break
+                self.flush()
+                continue
+            try:
+                while item is not None:
+                    self.record(*item)
+                    item = self.queue.get_nowait()
+            except queue.Empty:
+                continue
+            except (OSError, ValueError):
+                # Disk full, a file that would not open or the like;
+                # count what is lost and carry on
+                self.dropped += 1
+                continue
+            break
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+
+def mop_pcap_read(path):
+    """
+    Yields (timestamp, frame) for every record of a pcap file of
+    Ethernet frames, in either byte order and timestamp resolution.
+    """
+    with open(path, "rb") as f:
+        hdr = f.read(_FILE_HDR.size)
+        if len(hdr) < _FILE_HDR.size:
+            raise ValueError(f"{path}: not a pcap file")
+        for order in "<>":
+            magic = struct.unpack_from(order + "I", hdr)[0]
+            if magic in (PCAP_MAGIC, PCAP_MAGIC_NSEC):
+                break
+        else:
+            raise ValueError(f"{path}: not a pcap file")
+        linktype = struct.unpack_from(order + "I", hdr, 20)[0]
+        if linktype != PCAP_LINKTYPE_ETHERNET:
+            raise ValueError(f"{path}: link type {linktype} is not Ethernet")
+        scale = 1e-9 if magic == PCAP_MAGIC_NSEC else 1e-6
+        rec = struct.Struct(order + "IIII")
+        while True:
+            data = f.read(rec.size)
+            if len(data) < rec.size:
+                return
+            sec, frac, caplen, _ = rec.unpack(data)
+            frame = f.read(caplen)
+            if len(frame) < caplen:
+                return
+            yield sec + frac * scale, frame
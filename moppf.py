@@ -0,0 +1,278 @@
+"""
+Raw packet capture and transmit for the MOP daemon.
+
+This is the Python counterpart of pf.c in the C mopd. Each interface
+gets an AF_PACKET socket with a classic BPF program attached, so the
+kernel drops everything that is not MOP before it reaches Python.
+Outbound frames queued during one loop iteration leave in a single
+sendmmsg() call.
+"""
+
+import ctypes
+import errno
+import fcntl
+import mmap
+import os
+import socket
+import struct
+
+from mopcodec import MOP_DL_MULTICAST, MOP_RC_MULTICAST
+
+ETH_P_ALL = 0x0003
+
+SOL_PACKET = 263
+PACKET_ADD_MEMBERSHIP = 1
+PACKET_MR_MULTICAST = 0
+PACKET_FANOUT = 18
+PACKET_FANOUT_DATA = 22
+PACKET_FANOUT_CBPF = 6
+PACKET_FANOUT_FLAG_UNIQUEID = 0x2000
+PACKET_IGNORE_OUTGOING = 23
+PACKET_OUTGOING = 4
+
+SO_ATTACH_FILTER = 26
+
+# Receive buffer size per socket; large enough for a jumbo-free frame
+MOP_PF_BUFSIZE = 2048
+
+# Classic BPF opcodes
+BPF_LD_H_ABS = 0x28
+BPF_LD_W_ABS = 0x20
+BPF_JEQ_K = 0x15
+BPF_JGT_K = 0x25
+BPF_RET_K = 0x06
+BPF_RET_A = 0x16
+
+# Offset base for loads relative to the Ethernet header. Fanout programs
+# run with skb->data at the network header, so plain offsets would read
+# the MOP message instead.
+SKF_LL_OFF = -0x200000
+
+# Accept Ethernet II frames of type 0x6001/0x6002, and 802.3 frames with
+# an LLC/SNAP header (aa aa 03 08 00 2b) carrying those protocol types.
+MOP_BPF_PROGRAM = (
+    (BPF_LD_H_ABS, 0, 0, 12),            # 0: A = ethertype/length
+    (BPF_JEQ_K, 8, 0, 0x6001),           # 1: DL -> accept
+    (BPF_JEQ_K, 7, 0, 0x6002),           # 2: RC -> accept
+    (BPF_JGT_K, 5, 0, 1500),             # 3: other ethertype -> reject
+    (BPF_LD_W_ABS, 0, 0, 14),            # 4: A = LLC + first SNAP byte
+    (BPF_JEQ_K, 0, 3, 0xaaaa0308),       # 5: not SNAP -> reject
+    (BPF_LD_H_ABS, 0, 0, 20),            # 6: A = SNAP protocol type
+    (BPF_JEQ_K, 2, 0, 0x6001),           # 7: DL -> accept
+    (BPF_JEQ_K, 1, 0, 0x6002),           # 8: RC -> accept
+    (BPF_RET_K, 0, 0, 0),                # 9: reject
+    (BPF_RET_K, 0, 0, 0x40000),          # 10: accept whole frame
+)
+
+# Pick the fanout member from the low 32 bits of the source address, so
+# a client always lands on the same worker. The kernel takes the result
+# modulo the number of members.
+MOP_FANOUT_PROGRAM = (
+    (BPF_LD_W_ABS, 0, 0, (SKF_LL_OFF + 8) & 0xffffffff),  # 0: A = source address bytes 2-5
+    (BPF_RET_A, 0, 0, 0),                # 1: member = A % members
+)
+
+_SOCK_FILTER = struct.Struct("HBBI")
+_PACKET_MREQ = struct.Struct("iHH8s")
+
+def _setsockopt_bpf(sock, level, option, program):
+    insns = b"".join(_SOCK_FILTER.pack(*insn) for insn in program)
+    buf = ctypes.create_string_buffer(insns, len(insns))
+    fprog = struct.pack("HL", len(program), ctypes.addressof(buf))
+    sock.setsockopt(level, option, fprog)
+
+def mop_pf_attach_filter(sock, program=MOP_BPF_PROGRAM):
+    """Attaches a classic BPF program to a socket."""
+    _setsockopt_bpf(sock, socket.SOL_SOCKET, SO_ATTACH_FILTER, program)
+
+def mop_pf_join_fanout(sock, group=None):
+    """
+    Joins a bound socket to a PACKET_FANOUT group steered by source
+    address, or with no group given, makes a new group under an id the
+    kernel picks. Returns the group id. Frames queued before the join
+    are discarded, since every member saw them.
+    """
+    if group is None:
+        sock.setsockopt(SOL_PACKET, PACKET_FANOUT,
+                        (PACKET_FANOUT_CBPF | PACKET_FANOUT_FLAG_UNIQUEID) << 16)
+        group = sock.getsockopt(SOL_PACKET, PACKET_FANOUT) & 0xffff
+    else:
+        sock.setsockopt(SOL_PACKET, PACKET_FANOUT, group | (PACKET_FANOUT_CBPF << 16))
+    _setsockopt_bpf(sock, SOL_PACKET, PACKET_FANOUT_DATA, MOP_FANOUT_PROGRAM)
+    try:
+        while sock.recv(MOP_PF_BUFSIZE, socket.MSG_DONTWAIT):
+            pass
+    except (BlockingIOError, InterruptedError):
+        pass
+    return group
+
+_FANOUT_SLOT = struct.Struct("<IH2x")  # interface index, group id
+
+class MopFanout:
+    """
+    The fanout group of each interface, shared by processes forked after
+    it is made. The first process to open an interface makes a group
+    with an id the kernel knows to be free, and the others join it, so
+    no two interfaces or daemons end up in one group.
+    """
+
+    def __init__(self, slots=512):
+        self.fd = os.memfd_create("mop-fanout", os.MFD_CLOEXEC)
+        os.ftruncate(self.fd, slots * _FANOUT_SLOT.size)
+        self.table = mmap.mmap(self.fd, slots * _FANOUT_SLOT.size)
+
+    def join(self, sock, ifindex):
+        """Joins sock, bound to interface ifindex, to the interface's group."""
+        # Record locks belong to the process, so they also exclude forked siblings
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            free = None
+            for offset in range(0, len(self.table), _FANOUT_SLOT.size):
+                index, group = _FANOUT_SLOT.unpack_from(self.table, offset)
+                if index == ifindex:
+                    try:
+                        mop_pf_join_fanout(sock, group)
+                        return
+                    except OSError:
+                        free = offset       # Group gone with the interface; make another
+                        break
+                if index == 0 and free is None:
+                    free = offset
+            if free is None:
+                raise OSError(errno.ENOSPC, "no room for another fanout group")
+            _FANOUT_SLOT.pack_into(self.table, free, ifindex, mop_pf_join_fanout(sock))
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+def mop_pf_add_multicast(sock, ifindex, eaddr):
+    """Subscribes the interface to a multicast Ethernet address."""
+    mreq = _PACKET_MREQ.pack(ifindex, PACKET_MR_MULTICAST, len(eaddr), eaddr)
+    sock.setsockopt(SOL_PACKET, PACKET_ADD_MEMBERSHIP, mreq)
+
+def mop_pf_open(ifname, fanout=None):
+    """
+    Opens a non-blocking MOP capture socket on an interface.
+    The socket is created unbound and only bound once the filter is in
+    place, so no unfiltered frame can be queued in between. With a
+    MopFanout, the socket shares the interface's traffic with the other
+    sockets on the interface that joined through it.
+    """
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+    try:
+        mop_pf_attach_filter(sock)
+        try:
+            sock.setsockopt(SOL_PACKET, PACKET_IGNORE_OUTGOING, 1)
+        except OSError:
+            pass            # Kernels before 4.20; outgoing frames are skipped in mop_pf_recv()
+        sock.bind((ifname, ETH_P_ALL))
+        ifindex = socket.if_nametoindex(ifname)
+        if fanout is not None:
+            fanout.join(sock, ifindex)
+        mop_pf_add_multicast(sock, ifindex, MOP_DL_MULTICAST)
+        mop_pf_add_multicast(sock, ifindex, MOP_RC_MULTICAST)
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+class MopPfReader:
+    """Receives frames from a capture socket into one reusable buffer."""
+
+    def __init__(self, sock, bufsize=MOP_PF_BUFSIZE):
+        self.sock = sock
+        self.buf = bytearray(bufsize)
+        self.view = memoryview(self.buf)
+
+    def recv(self):
+        """
+        Returns a memoryview of the next frame, or None when the socket
+        has nothing more to read. The view is only valid until the next
+        call.
+        """
+        while True:
+            try:
+                nbytes, addr = self.sock.recvfrom_into(self.buf)
+            except (BlockingIOError, InterruptedError):
+                return None
+            if addr[2] != PACKET_OUTGOING:
+                return self.view[:nbytes]
+
+# --- Batched Transmit ---
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IOVec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+def _libc_sendmmsg():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return sendmmsg
+
+_sendmmsg = _libc_sendmmsg()
+
+def _buffer_address(buf, keep):
+    """
+    Returns the address of a buffer's data without copying it. Views
+    must be writable (image mappings are ACCESS_COPY for this reason);
+    the ctypes objects that pin them are collected in keep.
+    """
+    if isinstance(buf, bytes):
+        ptr = ctypes.c_char_p(buf)
+        keep.append(ptr)
+        return ctypes.cast(ptr, ctypes.c_void_p).value
+    if not len(buf):
+        return None
+    pin = ctypes.c_char.from_buffer(buf)
+    keep.append(pin)
+    return ctypes.addressof(pin)
+
+def mop_pf_sendmmsg(sock, frames):
+    """
+    Transmits frames (each a list of buffers) on a packet socket with a
+    single sendmmsg() call, falling back to one sendmsg() per frame
+    where sendmmsg is unavailable. Returns the number of frames sent,
+    which falls short when the transmit queue fills up.
+    """
+    if len(frames) == 1 or _sendmmsg is None:
+        sent = 0
+        for iov in frames:
+            try:
+                sock.sendmsg(iov)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.ENOBUFS):
+                    break   # Queue full, as below
+                raise
+            sent += 1
+        return sent
+
+    keep = []
+    msgs = (_MMsgHdr * len(frames))()
+    for msg, iov in zip(msgs, frames):
+        vecs = (_IOVec * len(iov))()
+        for vec, buf in zip(vecs, iov):
+            vec.iov_base = _buffer_address(buf, keep)
+            vec.iov_len = len(buf)
+        keep.append(vecs)
+        msg.msg_hdr.msg_iov = vecs
+        msg.msg_hdr.msg_iovlen = len(iov)
+    sent = _sendmmsg(sock.fileno(), msgs, len(frames), 0)
+    if sent < 0:
+        err = ctypes.get_errno()
+        if err in (errno.EAGAIN, errno.ENOBUFS):
+            return 0        # Queue full; session retransmits cover the loss
+        raise OSError(err, os.strerror(err))
+    return sent
@@ -0,0 +1,162 @@
+"""
+Restarting the MOP daemons without dropping their clients.
+
+On SIGHUP a daemon starts a fresh copy of itself, connected to it by a
+Unix socket pair whose far end is named in MOPD_HANDOFF_FD. The new
+process starts up as usual, indexing images and so on, while the old
+one keeps serving; once ready it says so over the socket. The old
+process then stops, sends its sockets and open files across with
+SCM_RIGHTS together with a JSON snapshot of its sessions, and exits.
+The new process picks up every socket as it is, with whatever frames
+and connections are queued on it, and resumes each session where the
+old one left it. If the new process dies before it is ready, the old
+one carries on.
+
+Under systemd the new process reports itself as the main process, so
+the unit wants Type=notify and NotifyAccess=all. mop_listen_fds() takes
+listening sockets from systemd socket activation.
+"""
+
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+
+MOP_HANDOFF_ENV = "MOPD_HANDOFF_FD"
+# File descriptors sent in one message; the kernel limit is 253
+MOP_HANDOFF_MAX_FDS = 253
+SD_LISTEN_FDS_START = 3
+
+_HANDOFF_HDR = struct.Struct("<I")  # Length of the JSON that follows
+_READY = b"R"
+
+def mop_sd_notify(state):
+    """Sends a state such as READY=1 to systemd, if it is listening."""
+    path = os.environ.get("NOTIFY_SOCKET")
+    if not path:
+        return
+    if path.startswith("@"):
+        path = "\0" + path[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC) as sock:
+            sock.sendto(state.encode(), path)
+    except OSError:
+        pass
+
+def mop_listen_fds():
+    """
+    Returns the sockets passed by systemd socket activation, keyed by
+    their FileDescriptorName (or listen0, listen1, ...). The environment
+    is cleared so children do not take them too.
+    """
+    try:
+        if int(os.environ.get("LISTEN_PID", "0")) != os.getpid():
+            return {}
+        count = int(os.environ.get("LISTEN_FDS", "0"))
+    except ValueError:
+        return {}
+    names = os.environ.get("LISTEN_FDNAMES", "").split(":")
+    for var in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+        os.environ.pop(var, None)
+    sockets = {}
+    for i in range(count):
+        fd = SD_LISTEN_FDS_START + i
+        os.set_inheritable(fd, False)
+        name = names[i] if i < len(names) and names[i] else f"listen{i}"
+        sockets[name] = socket.socket(fileno=fd)
+    return sockets
+
+class MopReload:
+    """The old process's side of a handoff."""
+
+    def __init__(self, argv=None):
+        self.argv = argv or [sys.executable] + sys.argv
+        self.sock = None
+        self.process = None
+
+    def start(self):
+        """Starts the new process. Returns the descriptor to wait on for it."""
+        self.sock, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        env = dict(os.environ, **{MOP_HANDOFF_ENV: str(theirs.fileno())})
+        try:
+            self.process = subprocess.Popen(self.argv, env=env, pass_fds=(theirs.fileno(),),
+                                            stdin=subprocess.DEVNULL)
+        except OSError:
+            self.sock.close()
+            raise
+        finally:
+            theirs.close()
+        return self.sock.fileno()
+
+    def ready(self):
+        """
+        Called once the descriptor is readable: True if the new process
+        is ready to take over, False if it went away first.
+        """
+        try:
+            ok = self.sock.recv(1) == _READY
+        except OSError:
+            ok = False
+        if not ok:
+            self.sock.close()
+            self.process.wait()
+        return ok
+
+    def hand_off(self, files, state):
+        """
+        Sends files, a list of (name, socket or file descriptor), and the
+        JSON-serializable state to the new process.
+        """
+        names = [name for name, _ in files]
+        fds = [f if isinstance(f, int) else f.fileno() for _, f in files]
+        if len(fds) > MOP_HANDOFF_MAX_FDS:
+            raise ValueError(f"too many files to hand off: {len(fds)}")
+        data = json.dumps({"pid": os.getpid(), "files": names, "state": state}).encode()
+        try:
+            socket.send_fds(self.sock, [_HANDOFF_HDR.pack(len(data))], fds)
+            self.sock.sendall(data)
+        finally:
+            self.sock.close()
+
+def mop_handoff_open():
+    """
+    Returns the handoff socket if this process was started by a reload,
+    or None.
+    """
+    fd = os.environ.pop(MOP_HANDOFF_ENV, None)
+    if fd is None:
+        return None
+    sock = socket.socket(fileno=int(fd))
+    sock.set_inheritable(False)
+    return sock
+
+def mop_handoff_accept(sock):
+    """
+    Tells the old process this one is ready and takes over from it.
+    Returns (file descriptors by name, state, old process id); the
+    caller wraps the sockets among them.
+    """
+    with sock:
+        sock.sendall(_READY)
+        hdr, fds, _, _ = socket.recv_fds(sock, _HANDOFF_HDR.size, MOP_HANDOFF_MAX_FDS)
+        if len(hdr) < _HANDOFF_HDR.size:
+            for fd in fds:
+                os.close(fd)
+            raise ConnectionError("old process went away during the handoff")
+        size = _HANDOFF_HDR.unpack(hdr)[0]
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+    try:
+        handoff = json.loads(data)
+    except ValueError:
+        for fd in fds:
+            os.close(fd)
+        raise ConnectionError("incomplete handoff from the old process") from None
+    mop_sd_notify(f"MAINPID={os.getpid()}\nREADY=1")
+    return dict(zip(handoff["files"], fds)), handoff["state"], handoff["pid"]
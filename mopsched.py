@@ -0,0 +1,130 @@
+"""
+Transmit pacing for the MOP daemon.
+
+VXT terminals usually share a 10 Mbit segment, often on a hub, with
+everything else on the site. Sending frames as fast as Python can
+produce them causes collisions and drops there, and the retransmissions
+make boots slower still. A MopScheduler sits between the engine and an
+interface's socket: frames queue per client and leave in deficit round
+robin order, so every client being loaded gets an equal share of the
+segment whatever its pace, and a token bucket holds the total to a set
+bitrate so interactive traffic keeps its room.
+"""
+
+import time
+from collections import deque
+
+from mopcodec import ETH_ALEN, mop_frame_len
+
+# Preamble, frame check sequence and interframe gap: line time a frame
+# costs on top of its bytes
+MOP_SCHED_OVERHEAD = 8 + 4 + 12
+# Bytes a client may send per round; one full frame
+MOP_SCHED_QUANTUM = 1518
+# Default bucket depth in bytes: how far above the rate a burst may go
+MOP_SCHED_BURST = 8192
+# Frames held across all clients before new ones are refused
+MOP_SCHED_MAX_FRAMES = 4096
+
+_RATE_UNITS = {"": 1, "k": 1000, "m": 1000000, "g": 1000000000}
+
+def mop_parse_rate(text):
+    """Parses a bitrate such as 10M, 2.5m or 512k into bits per second."""
+    text = text.strip().lower()
+    unit = text[-1:] if text[-1:] in _RATE_UNITS else ""
+    try:
+        rate = float(text[:len(text) - len(unit)]) * _RATE_UNITS[unit]
+    except ValueError:
+        raise ValueError(f"invalid bitrate: {text!r}") from None
+    if rate <= 0:
+        raise ValueError(f"bitrate must be positive: {text!r}")
+    return int(rate)
+
+class MopScheduler:
+    """
+    Deficit round robin over per-client queues, paced by a token bucket
+    of rate bits per second and burst bytes.
+    """
+
+    def __init__(self, rate, burst=MOP_SCHED_BURST, quantum=MOP_SCHED_QUANTUM,
+                 max_frames=MOP_SCHED_MAX_FRAMES):
+        self.rate = rate / 8.0            # bytes per second
+        self.burst = max(burst, quantum + MOP_SCHED_OVERHEAD)
+        self.quantum = quantum
+        self.max_frames = max_frames
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.queues = {}                  # client -> deque of (iov, cost)
+        self.deficit = {}                 # client -> bytes it may still send
+        self.active = deque()             # clients with frames, in service order
+        self.credited = False             # active[0] has had its quantum this round
+        self.queued = 0
+
+    def __len__(self):
+        return self.queued
+
+    def enqueue(self, iov):
+        """
+        Queues a frame behind the earlier ones for the same destination.
+        Returns False if the scheduler is full and the frame was refused.
+        """
+        if self.queued >= self.max_frames:
+            return False
+        client = bytes(iov[0][:ETH_ALEN])
+        queue = self.queues.get(client)
+        if queue is None:
+            queue = self.queues[client] = deque()
+            self.deficit[client] = 0
+            self.active.append(client)
+        queue.append((iov, mop_frame_len(iov) + MOP_SCHED_OVERHEAD))
+        self.queued += 1
+        return True
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def dequeue(self, now=None):
+        """Returns the frames that may be sent now, in order."""
+        if now is None:
+            now = time.monotonic()
+        self.refill(now)
+        frames = []
+        active = self.active
+        while active:
+            client = active[0]
+            queue = self.queues[client]
+            if not self.credited:
+                self.deficit[client] += self.quantum
+                self.credited = True
+            iov, cost = queue[0]
+            if cost > self.deficit[client]:
+                active.rotate(-1)
+                self.credited = False
+                continue
+            if cost > self.tokens:
+                break           # This client goes first once tokens are back
+            self.tokens -= cost
+            self.deficit[client] -= cost
+            queue.popleft()
+            self.queued -= 1
+            frames.append(iov)
+            if not queue:
+                del self.queues[client]
+                del self.deficit[client]
+                active.popleft()
+                self.credited = False
+        return frames
+
+    def timeout(self, now=None):
+        """
+        Seconds until the next queued frame may be sent, or None if
+        nothing is queued.
+        """
+        if not self.active:
+            return None
+        if now is None:
+            now = time.monotonic()
+        self.refill(now)
+        cost = self.queues[self.active[0]][0][1]
+        return max(0.0, (cost - self.tokens) / self.rate)
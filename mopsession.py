@@ -0,0 +1,220 @@
+"""
+Dump/Load session state for the MOP daemon.
+
+Every client being loaded has one slotted DLSession in a SessionTable
+keyed by its Ethernet address. All deadlines (retransmit, then idle
+expiry) live in a single hashed timer wheel that the event loop advances,
+so there is no thread or timer object per session and the cost of a
+tick depends only on the sessions that are actually due.
+"""
+
+import math
+import time
+
+from mopcodec import MOP_K_CODE_MLT, MOP_K_PROTO_DL, MLD_HDR, XFR_ADDR, mop_frame
+
+# Resend the last frame if the client has not asked for the next one
+MOP_RETRANSMIT_TIMEOUT = 2.0
+MOP_MAX_RETRIES = 5
+# Forget a session this long after the client was last heard from
+MOP_IDLE_TIMEOUT = 60.0
+MOP_MAX_SESSIONS = 1000
+# Copies of a request seen again within this many seconds are dropped
+MOP_DEDUPE_WINDOW = 0.5
+MOP_DEDUPE_ENTRIES = 4096
+
+class DLSession:
+    """State of one program load to a single client."""
+    __slots__ = ("iface", "client", "trans", "image", "plan", "request", "index",
+                 "loadnum", "frame", "retries", "retransmits", "last_active", "started",
+                 "timer_tick")
+
+    def __init__(self, iface, client, trans, image, plan, request=None):
+        self.iface = iface
+        self.client = client
+        self.trans = trans
+        self.image = image
+        self.plan = plan
+        self.request = request    # Request Program message that started the load
+        self.index = 0
+        self.loadnum = 0
+        self.frame = None
+        self.retries = 0
+        self.retransmits = 0      # Frames sent again over the whole load
+        self.last_active = self.started = time.monotonic()
+        self.timer_tick = None
+
+    def build_frame(self):
+        """
+        Builds the frame for the current plan row: a Memory Load while
+        rows remain, then a Memory Load with Transfer Address. Image
+        data is a memoryview slice of the mapped file.
+        """
+        plan = self.plan
+        i = self.index
+        if i < plan.count:
+            offset = plan.offsets[i]
+            parts = (plan.header(i), self.image.view[offset:offset + plan.lengths[i]])
+        else:
+            parts = (MLD_HDR.pack(MOP_K_CODE_MLT, self.loadnum, plan.end_addr),
+                     XFR_ADDR.pack(plan.xfr_addr))
+        self.frame = mop_frame(self.client, self.iface.hwaddr,
+                               MOP_K_PROTO_DL, self.trans, *parts)
+        return self.frame
+
+class TimerWheel:
+    """
+    A hashed timer wheel holding at most one deadline per session.
+    Scheduling and cancelling are O(1); advancing visits one slot per
+    elapsed tick and only fires the sessions whose tick has come.
+    """
+
+    def __init__(self, tick=0.1, slots=1024):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.current = int(time.monotonic() / tick)
+        self.count = 0
+
+    def schedule(self, sess, deadline):
+        self.cancel(sess)
+        t = max(math.ceil(deadline / self.tick), self.current + 1)
+        sess.timer_tick = t
+        self.slots[t % len(self.slots)].add(sess)
+        self.count += 1
+
+    def cancel(self, sess):
+        if sess.timer_tick is not None:
+            self.slots[sess.timer_tick % len(self.slots)].discard(sess)
+            sess.timer_tick = None
+            self.count -= 1
+
+    def advance(self, now):
+        """Returns the sessions whose deadline has passed, unscheduled."""
+        due = []
+        target = int(now / self.tick)
+        if self.count:
+            # A full turn visits every slot; no need to go round twice
+            start = max(self.current + 1, target - len(self.slots) + 1)
+            for t in range(start, target + 1):
+                slot = self.slots[t % len(self.slots)]
+                for sess in [s for s in slot if s.timer_tick <= target]:
+                    slot.discard(sess)
+                    sess.timer_tick = None
+                    self.count -= 1
+                    due.append(sess)
+        self.current = max(self.current, target)
+        return due
+
+    def timeout(self):
+        """Seconds until the next tick, or None if nothing is scheduled."""
+        return self.tick if self.count else None
+
+class RequestWindow:
+    """
+    Remembers the requests answered in the last window seconds, so the
+    copies a client sends while its answer is still in flight can be
+    dropped before any work is done for them. Keys are whatever
+    identifies a request; entries leave in arrival order.
+    """
+
+    def __init__(self, window=MOP_DEDUPE_WINDOW, max_entries=MOP_DEDUPE_ENTRIES):
+        self.window = window
+        self.max_entries = max_entries
+        self.seen = {}            # key -> when it was last answered
+
+    def __len__(self):
+        return len(self.seen)
+
+    def duplicate(self, key, now):
+        """
+        True if key was answered within the window; otherwise records it
+        as answered now.
+        """
+        when = self.seen.get(key)
+        if when is not None:
+            if now - when < self.window:
+                return True
+            del self.seen[key]
+        self.prune(now)
+        self.seen[key] = now
+        return False
+
+    def prune(self, now):
+        seen = self.seen
+        while seen:
+            key = next(iter(seen))
+            if now - seen[key] < self.window and len(seen) < self.max_entries:
+                break
+            del seen[key]
+
+    def clear(self):
+        self.seen.clear()
+
+class SessionTable:
+    """Active loads keyed by client Ethernet address."""
+
+    def __init__(self, max_sessions=MOP_MAX_SESSIONS,
+                 retransmit_timeout=MOP_RETRANSMIT_TIMEOUT,
+                 max_retries=MOP_MAX_RETRIES, idle_timeout=MOP_IDLE_TIMEOUT):
+        self.sessions = {}
+        self.wheel = TimerWheel()
+        self.max_sessions = max_sessions
+        self.retransmit_timeout = retransmit_timeout
+        self.max_retries = max_retries
+        self.idle_timeout = idle_timeout
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(self.sessions.values())
+
+    def get(self, client):
+        return self.sessions.get(client)
+
+    def full(self, client):
+        """True if a new session for client would exceed the table size."""
+        return client not in self.sessions and len(self.sessions) >= self.max_sessions
+
+    def add(self, sess):
+        """Adds a session, replacing any previous one for the same client."""
+        old = self.sessions.get(sess.client)
+        if old is not None:
+            self.wheel.cancel(old)
+        self.sessions[sess.client] = sess
+        self.touch(sess)
+
+    def remove(self, sess):
+        if self.sessions.get(sess.client) is sess:
+            del self.sessions[sess.client]
+        self.wheel.cancel(sess)
+
+    def touch(self, sess):
+        """Records client activity and arms the retransmit deadline."""
+        sess.last_active = time.monotonic()
+        sess.retries = 0
+        self.wheel.schedule(sess, sess.last_active + self.retransmit_timeout)
+
+    def expire(self, retransmit, now=None):
+        """
+        Runs the deadlines that are due: sessions still within their retry
+        budget get retransmit(sess) called, the rest are reclaimed once
+        idle for idle_timeout. Returns the reclaimed sessions.
+        """
+        if now is None:
+            now = time.monotonic()
+        reclaimed = []
+        for sess in self.wheel.advance(now):
+            if now - sess.last_active >= self.idle_timeout:
+                self.remove(sess)
+                reclaimed.append(sess)
+            elif sess.retries < self.max_retries:
+                sess.retries += 1
+                retransmit(sess)
+                self.wheel.schedule(sess, now + self.retransmit_timeout)
+            else:
+                self.wheel.schedule(sess, sess.last_active + self.idle_timeout)
+        return reclaimed
+
+    def timeout(self):
+        return self.wheel.timeout()